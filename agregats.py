@@ -0,0 +1,269 @@
+import click
+from datetime import datetime
+from flask.cli import with_appcontext
+from sqlalchemy import func, extract, select
+from sqlalchemy.dialects import postgresql, sqlite
+from . import db
+from .models import Produit, Client, Vente, LigneVente, VenteMensuelle, ClassementProduit, ClassementClient
+
+# Cumuls des ventes confirmées.
+# La table ventes_mensuelles est tenue à jour à chaque vente, ce qui permet
+# au rapport de lire une ligne par mois au lieu de parcourir la table ventes.
+# Les classements (classement_produits, classement_clients) cumulent de même
+# les ventes de chaque produit et de chaque client par mois, par année et
+# depuis l'origine, dans la transaction de chaque vente, de chaque import et
+# de chaque annulation : les meilleurs d'une période sont lus par un
+# parcours de l'index (période, total) limité aux lignes affichées.
+
+TOUT = 'tout'  # période des classements depuis l'origine
+TAILLE_LOT = 500  # lignes par INSERT ... ON CONFLICT des classements
+LIMITE_CLASSEMENT_MAX = 100
+
+CLASSEMENTS = {
+    # nom: (modèle, colonnes de tri, la première par défaut)
+    'produits': (ClassementProduit, ('quantite', 'total_ht')),
+    'clients': (ClassementClient, ('total_ttc', 'nb_ventes')),
+}
+
+def cle_mois(date):
+    """Clé AAAA-MM d'une date"""
+    return date.strftime('%Y-%m')
+
+def derniers_mois(nombre=12, reference=None):
+    """Clés des `nombre` derniers mois, du plus ancien au plus récent"""
+    reference = reference or datetime.now()
+    annee, mois = reference.year, reference.month
+    cles = []
+    for _ in range(nombre):
+        cles.insert(0, f"{annee}-{mois:02d}")
+        mois -= 1
+        if mois <= 0:
+            mois += 12
+            annee -= 1
+    return cles
+
+def _inserer(table):
+    """Construit un INSERT supportant ON CONFLICT pour le dialecte courant"""
+    dialecte = db.session.get_bind().dialect.name
+    if dialecte == 'postgresql':
+        return postgresql.insert(table)
+    if dialecte == 'sqlite':
+        return sqlite.insert(table)
+    raise NotImplementedError(f'Dialecte non supporté: {dialecte}')
+
+def comptabiliser_vente(vente, sens=1):
+    """Ajoute une vente confirmée au cumul de son mois (sens=-1 pour la retirer)"""
+    comptabiliser_mois(vente.date_vente or datetime.utcnow(),
+                       sens * (vente.total_ht or 0),
+                       sens * (vente.total_ttc or 0),
+                       sens)
+
+def comptabiliser_mois(date, total_ht, total_ttc, nb_ventes):
+    """Ajoute des totaux au cumul du mois de `date`
+
+    La mise à jour est un seul INSERT ... ON CONFLICT DO UPDATE qui
+    incrémente les totaux en base : deux ventes simultanées du même mois
+    ne peuvent pas s'écraser mutuellement.
+    """
+    table = VenteMensuelle.__table__
+    stmt = _inserer(table).values(
+        mois=cle_mois(date),
+        total_ht=total_ht,
+        total_ttc=total_ttc,
+        nb_ventes=nb_ventes
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.mois],
+        set_={
+            'total_ht': table.c.total_ht + stmt.excluded.total_ht,
+            'total_ttc': table.c.total_ttc + stmt.excluded.total_ttc,
+            'nb_ventes': table.c.nb_ventes + stmt.excluded.nb_ventes,
+        }
+    )
+    db.session.execute(stmt)
+
+def periodes(date):
+    """Périodes des classements couvrant `date` : mois, année et depuis l'origine"""
+    return (cle_mois(date), date.strftime('%Y'), TOUT)
+
+def lire_periode(texte):
+    """Période d'un classement (AAAA-MM, AAAA ou tout) ; ValueError si elle est invalide"""
+    if not texte or texte == TOUT:
+        return TOUT
+    if len(texte) not in (4, 7):
+        raise ValueError(f'Période invalide : {texte}')
+    datetime.strptime(texte, '%Y-%m' if len(texte) == 7 else '%Y')
+    return texte
+
+def periodes_recentes(nombre_mois=12, reference=None):
+    """Périodes proposées pour les classements : origine, deux dernières années, derniers mois"""
+    reference = reference or datetime.now()
+    annees = [str(reference.year), str(reference.year - 1)]
+    return [TOUT] + annees + derniers_mois(nombre_mois, reference)[::-1]
+
+def _cumuler(modele, cle, cumuls):
+    """Ajoute `cumuls` {(période, id): [valeurs]} aux lignes du classement `modele`
+
+    Les lignes sont écrites dans l'ordre des clés : deux transactions
+    concurrentes verrouillent les mêmes lignes dans le même ordre.
+    """
+    table = modele.__table__
+    colonnes = [c.name for c in table.c if not c.primary_key]
+    lignes = [dict(zip(colonnes, valeurs), periode=periode, **{cle: identifiant})
+              for (periode, identifiant), valeurs in sorted(cumuls.items())]
+    for debut in range(0, len(lignes), TAILLE_LOT):
+        stmt = _inserer(table).values(lignes[debut:debut + TAILLE_LOT])
+        db.session.execute(stmt.on_conflict_do_update(
+            index_elements=[table.c.periode, table.c[cle]],
+            set_={colonne: table.c[colonne] + stmt.excluded[colonne] for colonne in colonnes}
+        ))
+
+def comptabiliser_classements(ventes, sens=1):
+    """Ajoute des ventes confirmées aux classements (sens=-1 pour les retirer)
+
+    `ventes` : (date, client_id, total_ttc, lignes), les lignes étant des
+    dictionnaires avec produit_id, quantite et sous_total.
+    """
+    produits, clients = {}, {}
+    for date, client_id, total_ttc, lignes in ventes:
+        for periode in periodes(date or datetime.utcnow()):
+            client = clients.setdefault((periode, client_id), [0, 0.0])
+            client[0] += sens
+            client[1] += sens * (total_ttc or 0)
+            for ligne in lignes:
+                produit = produits.setdefault((periode, ligne['produit_id']), [0, 0.0])
+                produit[0] += sens * ligne['quantite']
+                produit[1] += sens * (ligne['sous_total'] or 0)
+    # Colonnes dans l'ordre des modèles : (quantite, total_ht) et (nb_ventes, total_ttc)
+    _cumuler(ClassementProduit, 'produit_id', produits)
+    _cumuler(ClassementClient, 'client_id', clients)
+
+def meilleurs_produits(periode=TOUT, limite=10, tri='quantite'):
+    """Produits les plus vendus de la période : (nom, quantite, total_ht, produit_id)"""
+    colonne = getattr(ClassementProduit, tri)
+    return db.session.execute(
+        select(Produit.nom, ClassementProduit.quantite, ClassementProduit.total_ht, Produit.id)
+        .join(Produit, Produit.id == ClassementProduit.produit_id)
+        .where(ClassementProduit.periode == periode, colonne > 0)
+        .order_by(colonne.desc(), ClassementProduit.produit_id.desc())
+        .limit(limite)
+    ).all()
+
+def meilleurs_clients(periode=TOUT, limite=10, tri='total_ttc'):
+    """Clients les plus actifs de la période : (nom, nb_ventes, total_ttc, client_id)"""
+    colonne = getattr(ClassementClient, tri)
+    return db.session.execute(
+        select(Client.nom, ClassementClient.nb_ventes, ClassementClient.total_ttc, Client.id)
+        .join(Client, Client.id == ClassementClient.client_id)
+        .where(ClassementClient.periode == periode, colonne > 0)
+        .order_by(colonne.desc(), ClassementClient.client_id.desc())
+        .limit(limite)
+    ).all()
+
+def rang(modele, identifiant, periode=TOUT, tri=None):
+    """Rang (à partir de 1) d'un produit ou d'un client dans le classement, ou None s'il n'y figure pas"""
+    cle = 'produit_id' if modele is ClassementProduit else 'client_id'
+    colonne = getattr(modele, tri or ('quantite' if modele is ClassementProduit else 'total_ttc'))
+    valeur = db.session.execute(
+        select(colonne).where(modele.periode == periode, getattr(modele, cle) == identifiant)
+    ).scalar()
+    if not valeur or valeur <= 0:
+        return None
+    # Comptage sur l'index (période, total, id) : les mieux classés seulement
+    devant = db.session.execute(
+        select(func.count()).select_from(modele).where(
+            modele.periode == periode,
+            (colonne > valeur) | ((colonne == valeur) & (getattr(modele, cle) > identifiant)))
+    ).scalar()
+    return devant + 1
+
+def ventes_par_mois(nombre=12):
+    """Totaux TTC des `nombre` derniers mois pour le rapport"""
+    cles = derniers_mois(nombre)
+    totaux = dict(
+        db.session.query(VenteMensuelle.mois, VenteMensuelle.total_ttc)
+        .filter(VenteMensuelle.mois.in_(cles))
+        .all()
+    )
+    return [{'mois': cle, 'total': totaux.get(cle, 0)} for cle in cles]
+
+def remplir_ventes_mensuelles(connexion):
+    """Recalcule entièrement ventes_mensuelles à partir de l'historique (sans commit)"""
+    annee = extract('year', Vente.date_vente)
+    mois = extract('month', Vente.date_vente)
+    lignes = connexion.execute(
+        select(annee, mois, func.sum(Vente.total_ht), func.sum(Vente.total_ttc), func.count(Vente.id))
+        .where(Vente.statut == 'confirmée', Vente.date_vente.isnot(None))
+        .group_by(annee, mois)
+    ).all()
+
+    table = VenteMensuelle.__table__
+    connexion.execute(table.delete())
+    if lignes:
+        connexion.execute(table.insert(), [
+            {'mois': f"{int(a)}-{int(m):02d}", 'total_ht': total_ht or 0, 'total_ttc': total_ttc or 0,
+             'nb_ventes': nb}
+            for a, m, total_ht, total_ttc, nb in lignes
+        ])
+    return len(lignes)
+
+def reconstruire_ventes_mensuelles():
+    """Recalcule entièrement ventes_mensuelles à partir de l'historique"""
+    nombre = remplir_ventes_mensuelles(db.session)
+    db.session.commit()
+    return nombre
+
+def remplir_classements(connexion):
+    """Recalcule entièrement les classements à partir de l'historique (sans commit)"""
+    annee = extract('year', Vente.date_vente)
+    mois = extract('month', Vente.date_vente)
+    confirmees = (Vente.statut == 'confirmée', Vente.date_vente.isnot(None))
+    # Cumuls mensuels calculés en base, années et origine cumulées ici
+    par_mois = {
+        ClassementProduit: connexion.execute(
+            select(annee, mois, LigneVente.produit_id, func.sum(LigneVente.quantite), func.sum(LigneVente.sous_total))
+            .join(Vente, Vente.id == LigneVente.vente_id).where(*confirmees)
+            .group_by(annee, mois, LigneVente.produit_id)
+        ).all(),
+        ClassementClient: connexion.execute(
+            select(annee, mois, Vente.client_id, func.count(Vente.id), func.sum(Vente.total_ttc))
+            .where(*confirmees).group_by(annee, mois, Vente.client_id)
+        ).all(),
+    }
+    nombre = 0
+    for modele, lignes in par_mois.items():
+        cle = 'produit_id' if modele is ClassementProduit else 'client_id'
+        premiere, seconde = [c.name for c in modele.__table__.c if not c.primary_key]
+        cumuls = {}
+        for a, m, identifiant, nb, total in lignes:
+            for periode in (f'{int(a)}-{int(m):02d}', str(int(a)), TOUT):
+                cumul = cumuls.setdefault((periode, identifiant), [0, 0.0])
+                cumul[0] += nb or 0
+                cumul[1] += total or 0
+        connexion.execute(modele.__table__.delete())
+        valeurs = [{'periode': periode, cle: identifiant, premiere: nb, seconde: total}
+                   for (periode, identifiant), (nb, total) in cumuls.items()]
+        for debut in range(0, len(valeurs), TAILLE_LOT * 10):
+            connexion.execute(modele.__table__.insert(), valeurs[debut:debut + TAILLE_LOT * 10])
+        nombre += len(valeurs)
+    return nombre
+
+def reconstruire_classements():
+    """Recalcule entièrement les classements des produits et des clients"""
+    nombre = remplir_classements(db.session)
+    db.session.commit()
+    return nombre
+
+@click.command('reconstruire-ventes-mensuelles')
+@with_appcontext
+def reconstruire_ventes_mensuelles_commande():
+    """Recalcule la table ventes_mensuelles depuis l'historique des ventes"""
+    nombre = reconstruire_ventes_mensuelles()
+    click.echo(f'{nombre} mois recalculés.')
+
+@click.command('reconstruire-classements')
+@with_appcontext
+def reconstruire_classements_commande():
+    """Recalcule les classements des produits et des clients depuis l'historique des ventes"""
+    nombre = reconstruire_classements()
+    click.echo(f'{nombre} lignes de classement recalculées.')
@@ -0,0 +1,457 @@
+import click
+import json
+import os
+import shutil
+import threading
+import time
+from datetime import date, datetime
+import numpy as np
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import select, func, text
+from . import db
+from .models import Produit, Client, Vente, LigneVente
+
+# Entrepôt d'analyse des ventes.
+# Les lignes de vente sont exportées périodiquement (tâche exporter-analyses)
+# dans un entrepôt en colonnes : un fichier NumPy (.npy) par colonne, lu en
+# mmap par chaque worker. Les agrégats des rapports, sur une période
+# quelconque et par jour, semaine, mois, catégorie, produit, client ou ville,
+# sont calculés en mémoire (np.bincount) sans requête sur la base des ventes :
+# moins d'une seconde pour 20 millions de lignes sur un seul cœur.
+# - L'export est incrémental et suit l'ordre des commits, comme la
+#   synchronisation du catalogue : chaque export note sa position (sous
+#   SQLite, qui sérialise les écritures, l'identifiant suivant la dernière
+#   ligne ; sous PostgreSQL, la plus ancienne transaction encore en cours,
+#   pg_snapshot_xmin, comparée à la transaction de chaque ligne) et le
+#   suivant relit les lignes écrites depuis. Une ligne validée en retard est
+#   ainsi toujours relue ; les lignes déjà exportées mais relues (écrites à
+#   partir de la position) sont notées dans l'instantané et écartées. Les
+#   colonnes sont recopiées dans un nouvel instantané, publié par le
+#   remplacement atomique du fichier `courant` ; les workers passent au
+#   nouvel instantané à leur requête suivante.
+# - Les annulations et les dimensions (catégorie des produits, ville des
+#   clients) sont relues à chaque export ; les noms des produits et des
+#   clients sont lus en base pour les seuls groupes affichés.
+# - L'entrepôt est en retard d'au plus une période de la tâche (15 min).
+
+TAILLE_PAQUET = 50000  # lignes lues par paquet à l'export
+INSTANTANES_GARDES = 2
+LIMITE = 50  # groupes retournés par défaut
+LIMITE_MAX = 1000
+GROUPES_DENSES_MAX = 50_000_000  # au-delà, les groupes sont numérotés par np.unique
+
+EPOQUE = date(1970, 1, 1).toordinal()
+LUNDI = 4  # le 1970-01-05, jour 4, est un lundi
+
+COLONNES = {
+    # nom: type
+    'ligne': np.int64,  # identifiant de la ligne de vente
+    'vente': np.int64,
+    'jour': np.int32,  # jours depuis le 1970-01-01 (date de la vente)
+    'produit': np.int32,
+    'client': np.int32,
+    'quantite': np.int32,
+    'montant_ht': np.float64,
+    'montant_ttc': np.float64,
+    'premiere': np.bool_,  # première ligne de sa vente : compte des ventes
+    'confirmee': np.bool_,  # vente non annulée, recalculé à chaque export
+}
+
+DIMENSIONS = ('jour', 'semaine', 'mois', 'categorie', 'produit', 'client', 'ville')
+DIMENSIONS_TEMPS = ('jour', 'semaine', 'mois')
+# Dimensions de la vente elle-même : le nombre de ventes par groupe y a un sens
+DIMENSIONS_VENTE = ('jour', 'semaine', 'mois', 'client', 'ville')
+MESURES = ('montant_ttc', 'montant_ht', 'quantite', 'lignes', 'ventes')
+FILTRES = ('categorie', 'ville', 'produit', 'client')
+
+def dossier_analyses():
+    """Dossier de l'entrepôt (ANALYSES_DIR, par défaut dans le dossier instance)"""
+    dossier = current_app.config.get('ANALYSES_DIR') or \
+        os.path.join(current_app.instance_path, 'analyses')
+    os.makedirs(dossier, exist_ok=True)
+    return dossier
+
+def _instantane_courant(dossier):
+    try:
+        with open(os.path.join(dossier, 'courant'), encoding='utf-8') as fichier:
+            return fichier.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+class Entrepot:
+    """Instantané de l'entrepôt : colonnes des lignes (mmap) et dimensions"""
+
+    def __init__(self, dossier, nom):
+        self.nom = nom
+        chemin = os.path.join(dossier, nom)
+        with open(os.path.join(chemin, 'meta.json'), encoding='utf-8') as fichier:
+            self.meta = json.load(fichier)
+        # Tableaux ordinaires sur le mmap : les opérations ne passent pas par np.memmap
+        # Un instantané d'une version précédente peut manquer de colonnes : il est réexporté en entier
+        self.colonnes = {colonne: np.asarray(np.load(os.path.join(chemin, f'{colonne}.npy'), mmap_mode='r'))
+                         for colonne in COLONNES if os.path.exists(os.path.join(chemin, f'{colonne}.npy'))}
+        self.categorie_produit = np.load(os.path.join(chemin, 'categorie_produit.npy'))
+        self.ville_client = np.load(os.path.join(chemin, 'ville_client.npy'))
+
+    def __len__(self):
+        return len(self.colonnes['vente'])
+
+_entrepot = None
+_verrou = threading.Lock()
+
+def entrepot():
+    """Dernier instantané publié, ou None si l'entrepôt n'a jamais été exporté"""
+    global _entrepot
+    dossier = dossier_analyses()
+    nom = _instantane_courant(dossier)
+    if nom is None:
+        return None
+    with _verrou:
+        if _entrepot is None or _entrepot.nom != nom:
+            _entrepot = Entrepot(dossier, nom)
+        return _entrepot
+
+# Export
+
+def _colonne_position():
+    """Colonne des lignes de vente qui suit l'ordre des commits"""
+    if db.engine.dialect.name == 'postgresql':
+        return LigneVente.transaction_id
+    return LigneVente.id
+
+def _position_export():
+    """Position de l'export : les lignes validées ensuite seront en deçà"""
+    if db.engine.dialect.name == 'postgresql':
+        return db.session.execute(text('SELECT pg_snapshot_xmin(pg_current_snapshot())::text::bigint')).scalar()
+    return (db.session.execute(select(func.max(LigneVente.id))).scalar() or 0) + 1
+
+def _lire_nouvelles_lignes(depuis):
+    """Lignes de vente écrites à partir de la position `depuis` (toutes si None) ;
+    retourne leurs colonnes et leurs positions"""
+    position = _colonne_position()
+    stmt = select(
+        LigneVente.id, LigneVente.vente_id, Vente.date_vente, LigneVente.produit_id, Vente.client_id,
+        LigneVente.quantite, LigneVente.sous_total, Vente.taux_tva, position
+    ).join(Vente, Vente.id == LigneVente.vente_id).order_by(LigneVente.id)
+    if depuis is not None:
+        stmt = stmt.where(position >= depuis)
+
+    paquets = {colonne: [] for colonne in ('ligne', 'vente', 'jour', 'produit', 'client', 'quantite',
+                                           'montant_ht', 'tva', 'position')}
+    maintenant = datetime.utcnow()
+    for lot in db.session.execute(stmt.execution_options(yield_per=TAILLE_PAQUET)).partitions():
+        ids, ventes, dates, produits, clients, quantites, sous_totaux, tvas, positions = zip(*lot)
+        paquets['position'].append(np.array(positions, dtype=np.int64))
+        paquets['ligne'].append(np.array(ids, dtype=np.int64))
+        paquets['vente'].append(np.array(ventes, dtype=np.int64))
+        paquets['jour'].append(np.array([(d or maintenant).toordinal() - EPOQUE for d in dates], dtype=np.int32))
+        paquets['produit'].append(np.array(produits, dtype=np.int32))
+        paquets['client'].append(np.array(clients, dtype=np.int32))
+        paquets['quantite'].append(np.array(quantites, dtype=np.int32))
+        paquets['montant_ht'].append(np.array([s or 0 for s in sous_totaux], dtype=np.float64))
+        paquets['tva'].append(np.array([t or 0 for t in tvas], dtype=np.float64))
+
+    colonnes = {colonne: np.concatenate(p) if p else np.empty(0, COLONNES.get(colonne, np.float64))
+                for colonne, p in paquets.items()}
+    colonnes['montant_ttc'] = colonnes['montant_ht'] * (1 + colonnes.pop('tva') / 100)
+    # Les lignes d'une vente sont créées dans la même transaction : toutes
+    # dans cet export, la première est celle de plus petit identifiant
+    colonnes['premiere'] = np.zeros(len(colonnes['vente']), dtype=np.bool_)
+    colonnes['premiere'][np.unique(colonnes['vente'], return_index=True)[1]] = True
+    return colonnes, colonnes.pop('position')
+
+def _table_codes(lignes, taille_min):
+    """Table identifiant -> code des valeurs distinctes ; retourne (table, valeurs)"""
+    valeurs = sorted({valeur or '' for _, valeur in lignes})
+    codes = {valeur: code for code, valeur in enumerate(valeurs)}
+    table = np.zeros(max([taille_min] + [identifiant + 1 for identifiant, _ in lignes]), dtype=np.int32)
+    for identifiant, valeur in lignes:
+        table[identifiant] = codes[valeur or '']
+    return table, valeurs
+
+def exporter_analyses(complet=False):
+    """Exporte les nouvelles lignes de vente dans un nouvel instantané ; retourne leur nombre"""
+    dossier = dossier_analyses()
+    precedent = None if complet else entrepot()
+    if precedent is not None and 'position' not in precedent.meta:
+        # Instantané antérieur au suivi des commits : export complet
+        precedent = None
+    # Position lue avant les lignes : celles validées entre les deux sont relues au suivant
+    position = _position_export()
+    nouvelles, positions = _lire_nouvelles_lignes(precedent.meta['position'] if precedent else None)
+    relues = nouvelles['ligne'][positions >= position]
+    if precedent is not None:
+        # Lignes relues déjà exportées par l'export précédent
+        gardees = ~np.isin(nouvelles['ligne'], precedent.meta['relues'])
+        nouvelles = {colonne: valeurs[gardees] for colonne, valeurs in nouvelles.items()}
+    annulees = np.array(db.session.execute(select(Vente.id).where(Vente.statut != 'confirmée')).scalars().all(),
+                        dtype=np.int64)
+    # Dimensions relues après les lignes : elles couvrent tous les produits et clients exportés
+    ancien = len(precedent) if precedent else 0
+    total = ancien + len(nouvelles['vente'])
+
+    def taille(colonne):
+        # Identifiants des lignes exportées, au cas où un produit ou un client aurait été supprimé
+        return int(max(precedent.colonnes[colonne].max(initial=0) if precedent else 0,
+                       nouvelles[colonne].max(initial=0))) + 1
+
+    categorie_produit, categories = _table_codes(
+        db.session.execute(select(Produit.id, Produit.categorie)).all(), taille('produit'))
+    ville_client, villes = _table_codes(
+        db.session.execute(select(Client.id, Client.ville)).all(), taille('client'))
+
+    nom = f'instantane-{datetime.utcnow():%Y%m%d%H%M%S%f}'
+    temporaire = os.path.join(dossier, '.' + nom)
+    os.makedirs(temporaire)
+    for colonne, type_ in COLONNES.items():
+        cible = np.lib.format.open_memmap(os.path.join(temporaire, f'{colonne}.npy'),
+                                          mode='w+', dtype=type_, shape=(total,))
+        if colonne == 'confirmee':
+            ventes = np.load(os.path.join(temporaire, 'vente.npy'), mmap_mode='r')
+            cible[:] = ~np.isin(ventes, annulees, kind='table') if len(annulees) else True
+        else:
+            if ancien:
+                cible[:ancien] = precedent.colonnes[colonne]
+            cible[ancien:] = nouvelles[colonne]
+        cible.flush()
+        del cible
+    np.save(os.path.join(temporaire, 'categorie_produit.npy'), categorie_produit)
+    np.save(os.path.join(temporaire, 'ville_client.npy'), ville_client)
+    with open(os.path.join(temporaire, 'meta.json'), 'w', encoding='utf-8') as fichier:
+        json.dump({
+            'date_export': datetime.utcnow().isoformat(timespec='seconds'),
+            'position': int(position),
+            'relues': relues.tolist(),
+            'lignes': total,
+            'categories': categories,
+            'villes': villes,
+        }, fichier, ensure_ascii=False)
+
+    # Publication atomique, puis suppression des instantanés trop anciens
+    os.rename(temporaire, os.path.join(dossier, nom))
+    with open(os.path.join(dossier, 'courant.tmp'), 'w', encoding='utf-8') as fichier:
+        fichier.write(nom)
+    os.replace(os.path.join(dossier, 'courant.tmp'), os.path.join(dossier, 'courant'))
+    anciens = sorted(n for n in os.listdir(dossier) if n.startswith('instantane-'))[:-INSTANTANES_GARDES]
+    for ancien_nom in anciens:
+        shutil.rmtree(os.path.join(dossier, ancien_nom), ignore_errors=True)
+    return len(nouvelles['vente'])
+
+# Requêtes
+
+def _jour(valeur):
+    return valeur.toordinal() - EPOQUE
+
+def _codes_dimension(e, dimension, colonne):
+    """Code entier de la dimension pour chaque ligne (`colonne` lit une colonne des lignes retenues)"""
+    if dimension == 'jour':
+        return colonne('jour')
+    if dimension == 'semaine':
+        return (colonne('jour') - LUNDI) // 7
+    if dimension == 'mois':
+        # Table jour -> mois sur la plage des jours lus : la conversion
+        # datetime64 de chaque ligne serait dix fois plus lente
+        jours = colonne('jour')
+        premier = int(jours.min()) if len(jours) else 0
+        mois = np.arange(premier, int(jours.max()) + 1 if len(jours) else 1) \
+            .astype('datetime64[D]').astype('datetime64[M]').astype(np.int64)
+        return mois[jours - premier]
+    if dimension == 'categorie':
+        return e.categorie_produit[colonne('produit')]
+    if dimension == 'ville':
+        return e.ville_client[colonne('client')]
+    return colonne(dimension)
+
+def _libelle(e, dimension, code, noms):
+    if dimension == 'jour':
+        return date.fromordinal(code + EPOQUE).isoformat()
+    if dimension == 'semaine':
+        annee, semaine, _ = date.fromordinal(code * 7 + LUNDI + EPOQUE).isocalendar()
+        return f'{annee}-S{semaine:02d}'
+    if dimension == 'mois':
+        return f'{1970 + code // 12}-{code % 12 + 1:02d}'
+    if dimension == 'categorie':
+        return e.meta['categories'][code] or 'Sans catégorie'
+    if dimension == 'ville':
+        return e.meta['villes'][code] or 'Non renseignée'
+    return noms[dimension].get(code, f'#{code}')
+
+def lire_dimensions(texte):
+    """Dimensions d'une liste séparée par des virgules ; ValueError si l'une est inconnue ou répétée"""
+    dimensions = [d.strip() for d in (texte or '').split(',') if d.strip()]
+    if not dimensions or len(set(dimensions)) != len(dimensions) \
+            or any(d not in DIMENSIONS for d in dimensions):
+        raise ValueError(f'Dimensions attendues parmi : {", ".join(DIMENSIONS)}')
+    return dimensions
+
+def analyser(dimensions, debut=None, fin=None, tri='montant_ttc', limite=LIMITE, filtres=None):
+    """Agrège les lignes des ventes confirmées par `dimensions` sur la période [debut, fin]
+
+    Retourne None si l'entrepôt n'a jamais été exporté. Les groupes sont
+    triés par ordre chronologique si toutes les dimensions sont des périodes,
+    sinon par `tri` décroissant. Le nombre de ventes n'est calculé que pour
+    les dimensions et filtres propres à la vente (période, client, ville).
+    """
+    if tri not in MESURES or any(d not in DIMENSIONS for d in dimensions) \
+            or any(f not in FILTRES for f in (filtres or {})):
+        raise ValueError('Dimension, filtre ou mesure inconnu')
+    e = entrepot()
+    if e is None:
+        return None
+    chrono = time.perf_counter()
+    c = e.colonnes
+
+    masque = np.array(c['confirmee'])
+    if debut:
+        masque &= c['jour'] >= _jour(debut)
+    if fin:
+        masque &= c['jour'] <= _jour(fin)
+    for dimension, valeur in (filtres or {}).items():
+        if dimension in ('categorie', 'ville'):
+            valeurs = e.meta['categories' if dimension == 'categorie' else 'villes']
+            code = valeurs.index(valeur) if valeur in valeurs else -1
+        else:
+            code = int(valeur)
+        masque &= _codes_dimension(e, dimension, lambda colonne: c[colonne]) == code
+    nombre_retenues = int(np.count_nonzero(masque))
+    if nombre_retenues * 2 >= len(masque):
+        # Peu de lignes écartées : calcul sur les colonnes entières, sans
+        # copie, les lignes écartées allant dans un groupe de rebut
+        retenues = None
+
+        def colonne(nom):
+            return c[nom]
+    else:
+        retenues = np.flatnonzero(masque)
+        lues = {}
+
+        def colonne(nom):
+            if nom not in lues:
+                lues[nom] = c[nom][retenues]
+            return lues[nom]
+
+    ventes_comptees = set(dimensions) | set(filtres or {}) <= set(DIMENSIONS_VENTE)
+    resultat = {'groupes': [], 'total_groupes': 0, 'lignes': nombre_retenues,
+                'export': e.meta['date_export'], 'ventes_comptees': ventes_comptees}
+    if nombre_retenues:
+        codes = [np.asarray(_codes_dimension(e, d, colonne), dtype=np.int64) for d in dimensions]
+        minimums = [int(x.min()) for x in codes]
+        tailles = [int(x.max()) - m + 1 for x, m in zip(codes, minimums)]
+        if np.prod(tailles, dtype=np.float64) <= GROUPES_DENSES_MAX:
+            # Codes déjà copiés (int64) : clé calculée en place
+            cle = codes[0]
+            cle -= minimums[0]
+            for x, m, t in zip(codes[1:], minimums[1:], tailles[1:]):
+                cle *= t
+                cle += x
+                cle -= m
+            nombre = int(np.prod(tailles))
+            cles_groupes = None
+        else:
+            cles_groupes, cle = np.unique(np.stack(codes, axis=1), axis=0, return_inverse=True)
+            cle = cle.ravel()
+            nombre = len(cles_groupes)
+        if retenues is None and nombre_retenues < len(masque):
+            cle[~masque] = nombre
+
+        if ventes_comptees:
+            # Lignes et ventes en un seul passage : clé doublée, +1 pour la
+            # première ligne de chaque vente
+            double = cle * 2
+            double += colonne('premiere')
+            comptes = np.bincount(double, minlength=2 * nombre + 2)[:2 * nombre].reshape(nombre, 2)
+            mesures = {'lignes': comptes.sum(axis=1), 'ventes': comptes[:, 1]}
+        else:
+            mesures = {'lignes': np.bincount(cle, minlength=nombre + 1)[:nombre]}
+        for mesure in ('quantite', 'montant_ht', 'montant_ttc'):
+            mesures[mesure] = np.bincount(cle, weights=colonne(mesure), minlength=nombre + 1)[:nombre]
+        groupes = np.flatnonzero(mesures['lignes'])
+        if not all(d in DIMENSIONS_TEMPS for d in dimensions):
+            groupes = groupes[np.argsort(-mesures.get(tri, mesures['lignes'])[groupes], kind='stable')]
+        resultat['total_groupes'] = len(groupes)
+        groupes = groupes[:limite] if limite else groupes
+
+        # Codes des dimensions de chaque groupe retenu
+        valeurs = []
+        for g in groupes.tolist():
+            if cles_groupes is not None:
+                valeurs.append([int(v) for v in cles_groupes[g]])
+                continue
+            codes_groupe = []
+            for m, t in zip(reversed(minimums), reversed(tailles)):
+                codes_groupe.insert(0, g % t + m)
+                g //= t
+            valeurs.append(codes_groupe)
+
+        noms = {}
+        for dimension, modele in (('produit', Produit), ('client', Client)):
+            if dimension in dimensions:
+                ids = {v[dimensions.index(dimension)] for v in valeurs}
+                noms[dimension] = dict(db.session.execute(
+                    select(modele.id, modele.nom).where(modele.id.in_(ids))).all())
+
+        for g, codes_groupe in zip(groupes.tolist(), valeurs):
+            groupe = {}
+            for dimension, code in zip(dimensions, codes_groupe):
+                groupe[dimension] = _libelle(e, dimension, code, noms)
+                if dimension in ('produit', 'client'):
+                    groupe[f'{dimension}_id'] = code
+            for mesure, totaux in mesures.items():
+                groupe[mesure] = int(totaux[g]) if mesure in ('lignes', 'quantite', 'ventes') \
+                    else round(float(totaux[g]), 2)
+            resultat['groupes'].append(groupe)
+
+    resultat['duree_ms'] = round((time.perf_counter() - chrono) * 1000, 1)
+    return resultat
+
+def lire_criteres_analyse(args):
+    """Critères d'analyse des paramètres d'une requête ; ValueError s'ils sont invalides
+
+    dimensions=mois,categorie (ou répété), debut=AAAA-MM-JJ, fin=AAAA-MM-JJ
+    (incluse), tri, limite, et filtres categorie, ville, produit_id, client_id.
+    """
+    criteres = {
+        # Une dimension choisie deux fois dans le formulaire ne compte qu'une fois
+        'dimensions': lire_dimensions(','.join(dict.fromkeys(args.getlist('dimensions'))) or 'categorie'),
+        'tri': args.get('tri') or 'montant_ttc',
+        'limite': min(max(int(args.get('limite') or LIMITE), 1), LIMITE_MAX),
+        'filtres': {},
+    }
+    for cle in ('debut', 'fin'):
+        criteres[cle] = datetime.strptime(args[cle], '%Y-%m-%d') if args.get(cle) else None
+    for filtre in FILTRES:
+        valeur = args.get(f'{filtre}_id' if filtre in ('produit', 'client') else filtre)
+        if valeur:
+            criteres['filtres'][filtre] = valeur
+    return criteres
+
+@click.command('exporter-analyses')
+@click.option('--complet', is_flag=True, help='Réexporte toutes les lignes au lieu des seules nouvelles.')
+@with_appcontext
+def exporter_analyses_commande(complet):
+    """Exporte les lignes de vente dans l'entrepôt d'analyse"""
+    debut = time.perf_counter()
+    nombre = exporter_analyses(complet)
+    click.echo(f'{nombre} ligne(s) exportée(s) en {time.perf_counter() - debut:.1f} s '
+               f'({len(entrepot())} lignes dans l\'entrepôt).')
+
+@click.command('analyser')
+@click.argument('dimensions')
+@click.option('--debut', type=click.DateTime(formats=['%Y-%m-%d']), help='Premier jour (AAAA-MM-JJ).')
+@click.option('--fin', type=click.DateTime(formats=['%Y-%m-%d']), help='Dernier jour inclus (AAAA-MM-JJ).')
+@click.option('--tri', type=click.Choice(MESURES), default='montant_ttc', show_default=True)
+@click.option('--limite', default=LIMITE, show_default=True)
+@with_appcontext
+def analyser_commande(dimensions, debut, fin, tri, limite):
+    """Agrège les ventes de l'entrepôt par DIMENSIONS (ex. mois,categorie)"""
+    try:
+        resultat = analyser(lire_dimensions(dimensions), debut, fin, tri, limite)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    if resultat is None:
+        raise click.ClickException('Entrepôt vide : lancez d\'abord `flask exporter-analyses`.')
+    for groupe in resultat['groupes']:
+        click.echo('  '.join(str(valeur) for valeur in groupe.values()))
+    click.echo(f"{resultat['total_groupes']} groupe(s), {resultat['lignes']} lignes en "
+               f"{resultat['duree_ms']} ms (export du {resultat['export']} UTC).")
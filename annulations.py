@@ -0,0 +1,122 @@
+from datetime import datetime, timedelta
+from sqlalchemy import select, insert, update, func, literal
+from . import db
+from .models import Produit, Vente, LigneVente, Facture, MouvementStock
+from .agregats import comptabiliser_mois, comptabiliser_classements, cle_mois
+from .pdf_factures import invalider_pdfs
+from .reapprovisionnement import surveiller_stocks
+
+# Annulation des ventes.
+# Les ventes sont annulées par requêtes ensemblistes, quel que soit leur
+# nombre : un UPDATE ... RETURNING bascule les ventes encore confirmées
+# (une vente déjà annulée n'est jamais restituée deux fois), puis, par
+# paquets de ventes, les mouvements d'annulation sont insérés depuis les
+# lignes de vente et le stock de chaque produit est remonté de la somme
+# de ses lignes par un seul UPDATE.
+
+TAILLE_PAQUET = 500  # ventes par requête de restitution
+
+def _paquets(ids, taille=TAILLE_PAQUET):
+    for debut in range(0, len(ids), taille):
+        yield ids[debut:debut + taille]
+
+def _restituer_stocks(ventes_ids, motif):
+    """Remet en stock les lignes des ventes `ventes_ids` et l'inscrit au registre"""
+    lignes = select(LigneVente.produit_id, LigneVente.quantite, LigneVente.vente_id,
+                    literal('annulation'), literal(motif), literal(datetime.utcnow(), db.DateTime)) \
+        .where(LigneVente.vente_id.in_(ventes_ids))
+    db.session.execute(insert(MouvementStock).from_select(
+        ['produit_id', 'quantite', 'vente_id', 'type_mouvement', 'motif', 'date_mouvement'], lignes
+    ))
+
+    # Quantité à restituer par produit, calculée en base
+    restitution = select(func.sum(LigneVente.quantite)) \
+        .where(LigneVente.produit_id == Produit.id, LigneVente.vente_id.in_(ventes_ids)) \
+        .scalar_subquery()
+    produits = select(LigneVente.produit_id).where(LigneVente.vente_id.in_(ventes_ids))
+    db.session.execute(
+        update(Produit).where(Produit.id.in_(produits))
+        .values(stock_actuel=Produit.stock_actuel + restitution)
+        .execution_options(synchronize_session=False)
+    )
+
+def lire_criteres(donnees):
+    """Critères d'annulation d'une requête JSON ; ValueError s'ils sont invalides
+
+    {"ids": [1, 2]} ou {"date_debut": "AAAA-MM-JJ", "date_fin": "AAAA-MM-JJ"}
+    (date de fin incluse), avec un "motif" facultatif.
+    """
+    if not isinstance(donnees, dict):
+        raise ValueError('Objet JSON attendu')
+    criteres = {'motif': donnees.get('motif')}
+    if donnees.get('ids') is not None:
+        criteres['ids'] = [int(i) for i in donnees['ids']]
+    if donnees.get('date_debut'):
+        criteres['date_debut'] = datetime.strptime(donnees['date_debut'], '%Y-%m-%d')
+    if donnees.get('date_fin'):
+        criteres['date_fin'] = datetime.strptime(donnees['date_fin'], '%Y-%m-%d') + timedelta(days=1)
+    if len(criteres) == 1:
+        raise ValueError('Aucune vente désignée')
+    return criteres
+
+def annuler_ventes(ids=None, date_debut=None, date_fin=None, motif=None):
+    """Annule les ventes confirmées désignées par `ids` ou par période ; retourne leurs ids
+
+    Statut des ventes et de leurs factures, stock, registre des mouvements,
+    cumuls mensuels et classements sont mis à jour dans une seule transaction.
+    """
+    if ids is None and date_debut is None and date_fin is None:
+        raise ValueError('Aucune vente désignée')
+
+    stmt = update(Vente).where(Vente.statut == 'confirmée')
+    if ids is not None:
+        stmt = stmt.where(Vente.id.in_(ids))
+    if date_debut:
+        stmt = stmt.where(Vente.date_vente >= date_debut)
+    if date_fin:
+        stmt = stmt.where(Vente.date_vente < date_fin)
+    annulees = db.session.execute(
+        stmt.values(statut='annulée')
+        .returning(Vente.id, Vente.date_vente, Vente.client_id, Vente.total_ht, Vente.total_ttc)
+        .execution_options(synchronize_session=False)
+    ).all()
+    if not annulees:
+        db.session.rollback()
+        return []
+
+    ventes_ids = sorted(vente.id for vente in annulees)
+    motif = motif or 'Annulation de la vente'
+    factures_ids = []
+    lignes = {}
+    for paquet in _paquets(ventes_ids):
+        _restituer_stocks(paquet, motif)
+        for ligne in db.session.execute(
+                select(LigneVente.vente_id, LigneVente.produit_id, LigneVente.quantite, LigneVente.sous_total)
+                .where(LigneVente.vente_id.in_(paquet))).mappings():
+            lignes.setdefault(ligne['vente_id'], []).append(ligne)
+        factures_ids += db.session.execute(
+            update(Facture).where(Facture.vente_id.in_(paquet))
+            .values(statut='annulée')
+            .returning(Facture.id)
+            .execution_options(synchronize_session=False)
+        ).scalars().all()
+
+    # Cumuls mensuels : une requête par mois concerné
+    mois = {}
+    for vente in annulees:
+        cumul = mois.setdefault(cle_mois(vente.date_vente), [vente.date_vente, 0, 0, 0])
+        cumul[1] -= vente.total_ht or 0
+        cumul[2] -= vente.total_ttc or 0
+        cumul[3] -= 1
+    for date, total_ht, total_ttc, nb in mois.values():
+        comptabiliser_mois(date, total_ht, total_ttc, nb)
+    comptabiliser_classements([(vente.date_vente, vente.client_id, vente.total_ttc, lignes.get(vente.id, []))
+                               for vente in annulees], sens=-1)
+    # Produits revenus au-dessus de leur stock minimum
+    surveiller_stocks({ligne['produit_id'] for lignes_vente in lignes.values() for ligne in lignes_vente},
+                      entrees=False)
+
+    db.session.commit()
+    # Le statut est imprimé sur le PDF
+    invalider_pdfs(factures_ids)
+    return ventes_ids
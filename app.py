@@ -4,6 +4,10 @@ from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.orm import DeclarativeBase
 from werkzeug.middleware.proxy_fix import ProxyFix
+from cache import cache
+from metriques import metriques
+from moteurs import options_moteur, configurer_moteur
+from replicas import routage, SessionRoutee, CLE_REPLICA
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)
@@ -11,7 +15,7 @@ logging.basicConfig(level=logging.DEBUG)
 class Base(DeclarativeBase):
     pass
 
-db = SQLAlchemy(model_class=Base)
+db = SQLAlchemy(model_class=Base, session_options={'class_': SessionRoutee})
 
 # Create the app
 app = Flask(__name__)
@@ -20,24 +24,90 @@ app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
 
 # Configure the database
 app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL", "sqlite:///gestion_commerciale.db")
-app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
-    "pool_recycle": 300,
-    "pool_pre_ping": True,
-}
+# Options propres au dialecte (PRAGMA de SQLite, pool et délais de PostgreSQL)
+reglages_moteur = dict(
+    pool=int(os.environ.get("DB_POOL", 5)),
+    debordement=int(os.environ.get("DB_POOL_DEBORDEMENT", 10)),
+    delai_requete=int(os.environ.get("DB_DELAI_REQUETE", 30)),
+)
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = options_moteur(app.config["SQLALCHEMY_DATABASE_URI"], **reglages_moteur)
+
+# Réplica pour les pages en lecture seule (facultatif) et délai de lecture de ses propres écritures
+app.config["SQLALCHEMY_BINDS"] = {}
+if os.environ.get("DATABASE_REPLICA_URL"):
+    app.config["SQLALCHEMY_BINDS"][CLE_REPLICA] = {
+        "url": os.environ["DATABASE_REPLICA_URL"],
+        **options_moteur(os.environ["DATABASE_REPLICA_URL"], **reglages_moteur),
+    }
+app.config["REPLICA_DELAI_COLLANT"] = float(os.environ.get("REPLICA_DELAI_COLLANT", 10))
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 
+# Cache des statistiques (mémoire par défaut, redis://... pour le partager entre workers)
+app.config["CACHE_URL"] = os.environ.get("CACHE_URL")
+
+# PDF des factures : dossier du magasin et processus de pré-rendu (0 = rendu à la demande)
+app.config["PDF_FACTURES_DIR"] = os.environ.get("PDF_FACTURES_DIR")
+app.config["PDF_PROCESSUS"] = int(os.environ.get("PDF_PROCESSUS", 2))
+
+# Entrepôt d'analyse des ventes (par défaut dans le dossier instance)
+app.config["ANALYSES_DIR"] = os.environ.get("ANALYSES_DIR")
+
+# Notifications des alertes de stock faible (POST JSON ; sans URL, elles sont écrites au journal)
+app.config["ALERTES_WEBHOOK_URL"] = os.environ.get("ALERTES_WEBHOOK_URL")
+
+# Mesures des requêtes (/metrics, METRIQUES=0 pour les désactiver) et seuil du journal des requêtes lentes
+app.config["METRIQUES"] = os.environ.get("METRIQUES", "1") != "0"
+app.config["METRIQUES_SEUIL_LENT"] = float(os.environ.get("METRIQUES_SEUIL_LENT", 0.5))
+app.config["METRIQUES_JETON"] = os.environ.get("METRIQUES_JETON")
+
 # Initialize the app with the extension
 db.init_app(app)
+cache.init_app(app)
+metriques.init_app(app)
+routage.init_app(app)
 
 with app.app_context():
-    # Import models to ensure tables are created
+    for cle, moteur in db.engines.items():
+        configurer_moteur(moteur, lecture_seule=cle == CLE_REPLICA)
+
+    # Import models (the schema is created by `flask migrer`)
     import models  # noqa: F401
     
-    # Create all tables
-    db.create_all()
-    
     # Import routes
     import routes  # noqa: F401
 
+# Commandes CLI
+from agregats import reconstruire_ventes_mensuelles_commande, reconstruire_classements_commande
+from importation import importer_ventes_commande, mesurer_import_commande
+from importation_produits import importer_produits_commande
+from migrations import migrer_commande
+from mouvements import cloturer_stocks_commande
+from numerotation import mesurer_numerotation_commande
+from taches import taches_commande
+from generation import generer_donnees_commande
+from performances import mesurer_performances_commande
+from moteurs import mesurer_concurrence_commande
+from stocks import mesurer_survente_commande
+from replicas import copier_replica_commande
+from analyses import exporter_analyses_commande, analyser_commande
+from reapprovisionnement import reapprovisionnement_commande
+app.cli.add_command(reconstruire_ventes_mensuelles_commande)
+app.cli.add_command(reconstruire_classements_commande)
+app.cli.add_command(migrer_commande)
+app.cli.add_command(importer_ventes_commande)
+app.cli.add_command(mesurer_import_commande)
+app.cli.add_command(importer_produits_commande)
+app.cli.add_command(cloturer_stocks_commande)
+app.cli.add_command(mesurer_numerotation_commande)
+app.cli.add_command(taches_commande)
+app.cli.add_command(generer_donnees_commande)
+app.cli.add_command(mesurer_performances_commande)
+app.cli.add_command(mesurer_concurrence_commande)
+app.cli.add_command(mesurer_survente_commande)
+app.cli.add_command(copier_replica_commande)
+app.cli.add_command(exporter_analyses_commande)
+app.cli.add_command(analyser_commande)
+app.cli.add_command(reapprovisionnement_commande)
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True)
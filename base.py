@@ -1,92 +1,100 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify, make_response
-from datetime import datetime, timedelta
-from sqlalchemy import func, and_, extract
+import hmac
+from flask import Blueprint, current_app, render_template, request, redirect, url_for, flash, jsonify, make_response, abort, send_file
 from .. import db
-from ..models import Produit, Client, Vente, LigneVente, Facture
-from .. import utils
+from ..models import Facture
+from ..agregats import ventes_par_mois, meilleurs_produits, meilleurs_clients, lire_periode, periodes_recentes
+from ..agregats import rang, CLASSEMENTS, LIMITE_CLASSEMENT_MAX
+from ..statistiques import statistiques
+from ..recherche import rechercher_produits, rechercher_clients, LIMITE_SUGGESTIONS, LIMITE_SUGGESTIONS_MAX
+from ..pdf_factures import donnees_facture, empreinte, obtenir_pdf, invalider_pdf, prerendre_facture
+from ..requetes import requete_factures, compter_factures, paginer, TRIS_FACTURES
+from ..requetes import requete_export_factures, ENTETES_FACTURES
+from ..exports import reponse_csv, RAPPORTS
+from ..metriques import metriques
+from ..replicas import lecture_seule
+from ..analyses import analyser, lire_criteres_analyse, DIMENSIONS, MESURES
 
 base_bp = Blueprint('base', __name__)
 
 @base_bp.route('/')
+@lecture_seule
 def index():
     """Page d'accueil avec statistiques générales"""
-    # Statistiques générales
-    total_produits = Produit.query.filter_by(actif=True).count()
-    total_clients = Client.query.filter_by(actif=True).count()
-    
-    # Produits en stock faible
-    produits_stock_faible = Produit.query.filter(
-        and_(Produit.stock_actuel <= Produit.stock_minimum, Produit.actif == True)
-    ).all()
-    
-    # Ventes du mois en cours
-    debut_mois = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-    ventes_mois = db.session.query(func.sum(Vente.total_ttc)).filter(
-        and_(Vente.date_vente >= debut_mois, Vente.statut == 'confirmée')
-    ).scalar() or 0
-    
-    # Ventes du jour
-    debut_jour = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
-    ventes_jour = db.session.query(func.sum(Vente.total_ttc)).filter(
-        and_(Vente.date_vente >= debut_jour, Vente.statut == 'confirmée')
-    ).scalar() or 0
-    
-    return render_template('index.html',
-                         total_produits=total_produits,
-                         total_clients=total_clients,
-                         produits_stock_faible=produits_stock_faible,
-                         ventes_mois=ventes_mois,
-                         ventes_jour=ventes_jour)
+    return render_template('index.html', **statistiques())
 
 @base_bp.route('/factures')
+@lecture_seule
 def factures():
     """Liste des factures"""
     statut = request.args.get('statut')
     
-    query = Facture.query
-    
-    if statut:
-        query = query.filter_by(statut=statut)
-    
-    factures = query.order_by(Facture.date_facture.desc()).all()
+    try:
+        page = paginer(requete_factures(statut=statut), TRIS_FACTURES,
+                       request.args.get('tri'), request.args.get('ordre', 'desc'),
+                       apres=request.args.get('apres'), taille=request.args.get('taille'))
+    except ValueError:
+        abort(400)
     
-    return render_template('factures.html', factures=factures)
+    return render_template('factures.html', factures=page, page=page,
+                         comptes=compter_factures(statut=statut))
+
+@base_bp.route('/factures/export')
+@lecture_seule
+def exporter_factures():
+    """Exporter la liste des factures (CSV ou Excel)"""
+    stmt = requete_export_factures(statut=request.args.get('statut'))
+    try:
+        return reponse_csv('factures', ENTETES_FACTURES, stmt, request.args.get('format', 'csv'))
+    except ValueError:
+        abort(400)
 
 @base_bp.route('/factures/<int:id>')
+@lecture_seule
 def facture_detail(id):
-    """Détail d'une facture"""
+    """Détail d'une facture (une seule ligne : son instantané)"""
     facture = Facture.query.get_or_404(id)
-    return render_template('facture_detail.html', facture=facture)
+    return render_template('facture_detail.html', facture=facture, lignes=facture.liste_lignes())
 
 @base_bp.route('/factures/<int:id>/pdf')
 def facture_pdf(id):
     """Générer le PDF d'une facture"""
-    facture = Facture.query.get_or_404(id)
+    donnees = donnees_facture(id)
+    if donnees is None:
+        abort(404)
     
-    try:
-        pdf_content = utils.generer_facture_pdf(facture)
-        
-        response = make_response(pdf_content)
-        response.headers['Content-Type'] = 'application/pdf'
-        response.headers['Content-Disposition'] = f'inline; filename="facture_{facture.numero_facture}.pdf"'
-        
+    # L'empreinte du contenu sert d'ETag : une réimpression ne renvoie rien
+    hachage = empreinte(donnees)
+    if hachage in request.if_none_match:
+        response = make_response('', 304)
+        response.set_etag(hachage)
         return response
-        
+    
+    try:
+        chemin = obtenir_pdf(donnees, hachage)
     except Exception as e:
         flash(f'Erreur lors de la génération du PDF: {str(e)}', 'error')
         return redirect(url_for('base.facture_detail', id=id))
+    
+    response = send_file(chemin, mimetype='application/pdf',
+                         download_name=f"facture_{donnees['numero_facture']}.pdf",
+                         etag=hachage, conditional=True)
+    response.cache_control.no_cache = True
+    return response
 
 @base_bp.route('/factures/<int:id>/statut', methods=['POST'])
 def modifier_statut_facture(id):
     """Modifier le statut d'une facture"""
+    modifie = False
     try:
         facture = Facture.query.get_or_404(id)
         nouveau_statut = request.form['statut']
         
-        if nouveau_statut in ['impayée', 'payée', 'en_retard']:
+        if facture.statut == 'annulée':
+            flash('Une facture annulée ne peut plus changer de statut.', 'error')
+        elif nouveau_statut in ['impayée', 'payée', 'en_retard']:
             facture.statut = nouveau_statut
             db.session.commit()
-            flash('Statut de la facture modifié avec succès!', 'success')
+            modifie = True
         else:
             flash('Statut invalide!', 'error')
             
@@ -94,60 +102,126 @@ def modifier_statut_facture(id):
         db.session.rollback()
         flash(f'Erreur lors de la modification du statut: {str(e)}', 'error')
     
+    if modifie:
+        # Après le commit : le statut est imprimé sur le PDF
+        invalider_pdf(id)
+        prerendre_facture(id)
+        flash('Statut de la facture modifié avec succès!', 'success')
+    
     return redirect(url_for('base.facture_detail', id=id))
 
 @base_bp.route('/rapports')
+@lecture_seule
 def rapports():
     """Page des rapports et statistiques"""
-    # Rapport mensuel
-    mois_actuel = datetime.now().month
-    annee_actuelle = datetime.now().year
+    # Ventes par mois (12 derniers mois), lues dans la table des cumuls
+    ventes_mensuelles = ventes_par_mois(12)
     
-    # Ventes par mois (12 derniers mois)
-    ventes_mensuelles = []
-    for i in range(12):
-        mois = mois_actuel - i
-        annee = annee_actuelle
-        
-        if mois <= 0:
-            mois += 12
-            annee -= 1
-        
-        total = db.session.query(func.sum(Vente.total_ttc)).filter(
-            and_(
-                extract('month', Vente.date_vente) == mois,
-                extract('year', Vente.date_vente) == annee,
-                Vente.statut == 'confirmée'
-            )
-        ).scalar() or 0
-        
-        ventes_mensuelles.insert(0, {
-            'mois': f"{annee}-{mois:02d}",
-            'total': total
-        })
-    
-    # Produits les plus vendus
-    produits_vendus = db.session.query(
-        Produit.nom,
-        func.sum(LigneVente.quantite).label('total_vendu')
-    ).join(LigneVente).join(Vente).filter(
-        Vente.statut == 'confirmée'
-    ).group_by(Produit.id, Produit.nom).order_by(
-        func.sum(LigneVente.quantite).desc()
-    ).limit(10).all()
+    try:
+        # Période des classements et analyse à la demande (entrepôt d'analyse)
+        periode = lire_periode(request.args.get('periode'))
+        criteres = lire_criteres_analyse(request.args)
+        analyse = analyser(**criteres)
+    except ValueError:
+        abort(400)
     
-    # Clients les plus actifs
-    clients_actifs = db.session.query(
-        Client.nom,
-        func.count(Vente.id).label('nb_ventes'),
-        func.sum(Vente.total_ttc).label('total_achats')
-    ).join(Vente).filter(
-        Vente.statut == 'confirmée'
-    ).group_by(Client.id, Client.nom).order_by(
-        func.sum(Vente.total_ttc).desc()
-    ).limit(10).all()
+    # Produits les plus vendus et clients les plus actifs de la période :
+    # lus dans les classements, tenus à jour à chaque vente
+    produits_vendus = meilleurs_produits(periode, 10)
+    clients_actifs = meilleurs_clients(periode, 10)
     
     return render_template('rapports.html',
                          ventes_mensuelles=ventes_mensuelles,
                          produits_vendus=produits_vendus,
-                         clients_actifs=clients_actifs)
\ No newline at end of file
+                         clients_actifs=clients_actifs,
+                         periode=periode, periodes=periodes_recentes(),
+                         analyse=analyse, criteres=criteres,
+                         dimensions=DIMENSIONS, mesures=MESURES)
+
+@base_bp.route('/rapports/export/<rapport>')
+@lecture_seule
+def exporter_rapport(rapport):
+    """Exporter un rapport complet (ventes-mensuelles, produits ou clients)"""
+    if rapport not in RAPPORTS:
+        abort(404)
+    entetes, requete = RAPPORTS[rapport]
+    try:
+        return reponse_csv(f'rapport_{rapport}', entetes, requete(), request.args.get('format', 'csv'))
+    except ValueError:
+        abort(400)
+
+# API endpoints pour AJAX
+@base_bp.route('/api/stats')
+@lecture_seule
+def api_stats():
+    """API des statistiques du tableau de bord"""
+    return jsonify(statistiques())
+
+@base_bp.route('/api/analyses')
+@lecture_seule
+def api_analyses():
+    """API d'analyse des ventes : agrégats par dimensions sur une période"""
+    try:
+        resultat = analyser(**lire_criteres_analyse(request.args))
+    except ValueError:
+        abort(400)
+    if resultat is None:
+        # Entrepôt pas encore exporté (tâche exporter-analyses)
+        abort(503)
+    return jsonify(resultat)
+
+@base_bp.route('/api/classements/<classement>')
+@lecture_seule
+def api_classements(classement):
+    """API des classements des produits ou des clients d'une période, et rang de l'un d'eux"""
+    if classement not in CLASSEMENTS:
+        abort(404)
+    modele, tris = CLASSEMENTS[classement]
+    tri = request.args.get('tri', tris[0])
+    try:
+        periode = lire_periode(request.args.get('periode'))
+    except ValueError:
+        abort(400)
+    if tri not in tris:
+        abort(400)
+    limite = min(max(request.args.get('limite', 10, type=int), 1), LIMITE_CLASSEMENT_MAX)
+    
+    meilleurs = meilleurs_produits if classement == 'produits' else meilleurs_clients
+    resultat = {'classement': classement, 'periode': periode, 'tri': tri,
+                'resultats': [dict(ligne._mapping, rang=position)
+                              for position, ligne in enumerate(meilleurs(periode, limite, tri), 1)]}
+    identifiant = request.args.get('id', type=int)
+    if identifiant is not None:
+        resultat['id'] = identifiant
+        resultat['rang'] = rang(modele, identifiant, periode, tri)
+    return jsonify(resultat)
+
+@base_bp.route('/metrics')
+def metrics():
+    """Mesures des requêtes au format texte Prometheus"""
+    jeton = current_app.config.get('METRIQUES_JETON')
+    if jeton and not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {jeton}'):
+        abort(401)
+    reponse = make_response(metriques.exposition())
+    reponse.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    return reponse
+
+@base_bp.route('/api/search')
+@lecture_seule
+def api_recherche():
+    """API d'autocomplétion des produits et des clients"""
+    texte = request.args.get('q', '').strip()
+    type_ = request.args.get('type', 'produits')
+    limite = min(max(request.args.get('limite', LIMITE_SUGGESTIONS, type=int), 1), LIMITE_SUGGESTIONS_MAX)
+    
+    if type_ == 'produits':
+        resultats = rechercher_produits(texte, limite)
+    elif type_ == 'clients':
+        resultats = rechercher_clients(texte, limite)
+    else:
+        abort(400)
+    
+    reponse = jsonify({'q': texte, 'type': type_, 'resultats': resultats})
+    reponse.cache_control.private = True
+    reponse.cache_control.max_age = 30
+    return reponse
\ No newline at end of file
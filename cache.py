@@ -0,0 +1,116 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+# Cache applicatif à backend interchangeable.
+# Par défaut les valeurs sont gardées en mémoire dans chaque processus ; avec
+# CACHE_URL=redis://... tous les workers gunicorn partagent le même cache.
+# Les valeurs doivent être sérialisables en JSON.
+
+TAILLE_CACHE = 1024
+DUREE_CACHE = 300  # secondes
+
+class CacheMemoire:
+    """Cache LRU en mémoire, propre à un processus"""
+
+    def __init__(self, taille=TAILLE_CACHE):
+        self.taille = taille
+        self._entrees = OrderedDict()
+        self._verrou = threading.Lock()
+
+    def get(self, cle):
+        with self._verrou:
+            entree = self._entrees.get(cle)
+            if entree is None:
+                return None
+            valeur, expiration = entree
+            if expiration is not None and expiration <= time.monotonic():
+                del self._entrees[cle]
+                return None
+            self._entrees.move_to_end(cle)
+            return valeur
+
+    def set(self, cle, valeur, duree=None):
+        expiration = time.monotonic() + duree if duree else None
+        with self._verrou:
+            self._entrees[cle] = (valeur, expiration)
+            self._entrees.move_to_end(cle)
+            while len(self._entrees) > self.taille:
+                self._entrees.popitem(last=False)
+
+    def delete(self, *cles):
+        with self._verrou:
+            for cle in cles:
+                self._entrees.pop(cle, None)
+
+    def clear(self):
+        with self._verrou:
+            self._entrees.clear()
+
+class CacheRedis:
+    """Cache partagé dans un serveur compatible Redis"""
+
+    def __init__(self, url, prefixe='gc:'):
+        try:
+            import redis
+        except ImportError as e:
+            raise RuntimeError('Le paquet redis est requis pour CACHE_URL=redis://...') from e
+        self.client = redis.Redis.from_url(url)
+        self.prefixe = prefixe
+
+    def get(self, cle):
+        brut = self.client.get(self.prefixe + cle)
+        return json.loads(brut) if brut is not None else None
+
+    def set(self, cle, valeur, duree=None):
+        self.client.set(self.prefixe + cle, json.dumps(valeur), ex=duree or None)
+
+    def delete(self, *cles):
+        if cles:
+            self.client.delete(*(self.prefixe + cle for cle in cles))
+
+    def clear(self):
+        cles = list(self.client.scan_iter(self.prefixe + '*'))
+        if cles:
+            self.client.delete(*cles)
+
+def creer_backend(url=None):
+    """Backend correspondant à CACHE_URL (mémoire si absent)"""
+    if not url or url == 'memoire':
+        return CacheMemoire()
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return CacheRedis(url)
+    raise ValueError(f'Backend de cache inconnu: {url}')
+
+class Cache:
+    """Extension Flask donnant accès au backend configuré"""
+
+    def __init__(self):
+        self.backend = CacheMemoire()
+
+    def init_app(self, app):
+        self.backend = creer_backend(app.config.get('CACHE_URL'))
+        app.extensions['cache'] = self
+
+    def get(self, cle):
+        return self.backend.get(cle)
+
+    def set(self, cle, valeur, duree=DUREE_CACHE):
+        self.backend.set(cle, valeur, duree)
+
+    def delete(self, *cles):
+        self.backend.delete(*cles)
+
+    def clear(self):
+        self.backend.clear()
+
+    def memoriser(self, cle, calcul, duree=DUREE_CACHE):
+        """Valeur en cache de `cle`, calculée par `calcul()` si absente"""
+        valeur = self.get(cle)
+        if valeur is None:
+            valeur = calcul()
+            self.set(cle, valeur, duree)
+        return valeur
+
+cache = Cache()
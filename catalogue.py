@@ -0,0 +1,89 @@
+from sqlalchemy import select, func, text
+from . import db
+from .models import Produit
+
+# Catalogue des produits du formulaire de vente.
+# Le formulaire charge une fois le catalogue complet (id, nom, prix, stock),
+# puis ne redemande que les produits modifiés depuis le jeton qu'il a reçu :
+# chaque écriture sur un produit lui attribue un nouveau numéro de version
+# (Produit.version, colonne indexée), et le jeton garantit que toutes les
+# versions inférieures ont déjà été envoyées. Les versions suivent donc
+# l'ordre des commits, pas celui des écritures :
+# - SQLite sérialise les écritures : une version (max + 1) est validée
+#   avant que la suivante soit tirée ; le jeton est max + 1 ;
+# - PostgreSQL : la version est l'identifiant de la transaction qui écrit,
+#   et le jeton le plus ancien identifiant encore en cours dans l'instantané
+#   de la lecture (pg_snapshot_xmin). Une transaction validée en retard a
+#   un identifiant au moins égal au jeton : elle est renvoyée à la
+#   synchronisation suivante, quel que soit le nombre d'écritures validées
+#   entre-temps.
+# Un produit peut ainsi être renvoyé deux fois ; le formulaire le remplace.
+# Le stock affiché reste indicatif : il est vérifié au moment de la vente
+# (stocks.reserver_stocks), et le formulaire le contrôle avant l'envoi.
+
+COLONNES_CATALOGUE = ('id', 'nom', 'prix_unitaire', 'stock_actuel')
+
+STOCKS_MAX = 200  # produits par vérification de stock
+
+def etat_catalogue():
+    """Jeton de synchronisation et ETag du catalogue, lus dans un même instantané
+
+    L'ETag change dès qu'une écriture a pu être validée : sous PostgreSQL,
+    c'est l'instantané lui-même (transactions en cours et suivante).
+    """
+    if db.session.get_bind().dialect.name == 'postgresql':
+        jeton, instantane = db.session.execute(text(
+            'SELECT pg_snapshot_xmin(s)::text::bigint, s::text FROM pg_current_snapshot() s')).one()
+        return jeton, instantane
+    jeton = (db.session.execute(select(func.max(Produit.version))).scalar() or 0) + 1
+    return jeton, str(jeton)
+
+def catalogue(depuis=None):
+    """Produits actifs du catalogue, ou ceux modifiés depuis le jeton `depuis`
+
+    Les produits sont renvoyés sous forme de listes dans l'ordre de
+    COLONNES_CATALOGUE ; `supprimes` liste les produits désactivés depuis
+    `depuis`, à retirer du formulaire ; `version` est le jeton de la
+    synchronisation suivante.
+    """
+    # Lu avant les produits : une écriture validée entre les deux lectures
+    # sera renvoyée par la synchronisation suivante plutôt que perdue
+    jeton, _ = etat_catalogue()
+    if depuis and depuis > jeton:
+        # Jeton inconnu (base restaurée...) : le catalogue est renvoyé en entier
+        depuis = None
+
+    colonnes = [getattr(Produit, c) for c in COLONNES_CATALOGUE]
+    stmt = select(*colonnes, Produit.actif)
+    if depuis:
+        stmt = stmt.where(Produit.version >= depuis).order_by(Produit.version)
+    else:
+        stmt = stmt.where(Produit.actif == True).order_by(Produit.nom)
+
+    produits, supprimes = [], []
+    for ligne in db.session.execute(stmt):
+        if ligne.actif:
+            produits.append(list(ligne[:len(COLONNES_CATALOGUE)]))
+        else:
+            supprimes.append(ligne.id)
+
+    return {
+        'version': jeton,
+        'complet': not depuis,
+        'colonnes': list(COLONNES_CATALOGUE),
+        'produits': produits,
+        'supprimes': supprimes,
+    }
+
+def details_produits(ids):
+    """Prix et stock actuels des produits `ids`, en une requête"""
+    stmt = select(Produit.id, Produit.nom, Produit.prix_unitaire, Produit.stock_actuel, Produit.actif) \
+        .where(Produit.id.in_(ids))
+    return [dict(ligne._mapping) for ligne in db.session.execute(stmt)]
+
+def lire_ids(texte, maximum=STOCKS_MAX):
+    """Identifiants d'une liste « 1,2,3 » ; ValueError si elle est invalide"""
+    ids = {int(i) for i in texte.split(',') if i.strip()}
+    if len(ids) > maximum:
+        raise ValueError(f'Au plus {maximum} produits par requête')
+    return ids
@@ -1,22 +1,38 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash
+from flask import Blueprint, render_template, request, redirect, url_for, flash, abort
 from .. import db
 from ..models import Client
+from ..statistiques import invalider_clients
+from ..requetes import requete_clients, paginer, TRIS_CLIENTS
+from ..requetes import requete_export_clients, ENTETES_CLIENTS
+from ..exports import reponse_csv
+from ..replicas import lecture_seule
 
 clients_bp = Blueprint('clients', __name__, url_prefix='/clients')
 
 @clients_bp.route('/')
+@lecture_seule
 def clients():
     """Liste des clients"""
     search = request.args.get('search', '')
     
-    query = Client.query.filter_by(actif=True)
-    
-    if search:
-        query = query.filter(Client.nom.contains(search))
-    
-    clients = query.order_by(Client.nom).all()
+    try:
+        page = paginer(requete_clients(search=search), TRIS_CLIENTS,
+                       request.args.get('tri'), request.args.get('ordre', 'asc'),
+                       apres=request.args.get('apres'), taille=request.args.get('taille'))
+    except ValueError:
+        abort(400)
     
-    return render_template('clients.html', clients=clients)
+    return render_template('clients.html', clients=page, page=page)
+
+@clients_bp.route('/export')
+@lecture_seule
+def exporter_clients():
+    """Exporter la liste des clients (CSV ou Excel)"""
+    stmt = requete_export_clients(search=request.args.get('search', ''))
+    try:
+        return reponse_csv('clients', ENTETES_CLIENTS, stmt, request.args.get('format', 'csv'))
+    except ValueError:
+        abort(400)
 
 @clients_bp.route('/ajouter', methods=['GET', 'POST'])
 def ajouter_client():
@@ -34,6 +50,7 @@ def ajouter_client():
             
             db.session.add(client)
             db.session.commit()
+            invalider_clients()
             flash('Client ajouté avec succès!', 'success')
             return redirect(url_for('clients.clients'))
             
@@ -50,6 +67,7 @@ def supprimer_client(id):
         client = Client.query.get_or_404(id)
         client.actif = False
         db.session.commit()
+        invalider_clients()
         flash('Client supprimé avec succès!', 'success')
     except Exception as e:
         db.session.rollback()
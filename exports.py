@@ -0,0 +1,89 @@
+import csv
+import io
+from datetime import datetime
+from flask import Response, stream_with_context
+from sqlalchemy import select
+from . import db
+from .models import Produit, Client, VenteMensuelle, ClassementProduit, ClassementClient
+from .agregats import TOUT
+
+# Exports CSV des listes et des rapports, générés au fil de l'eau.
+# Les lignes sont lues par paquets (yield_per, curseur serveur sous
+# PostgreSQL) et envoyées dès qu'un morceau est prêt : la mémoire utilisée
+# ne dépend pas du nombre de lignes exportées.
+# Le format « excel » produit un CSV séparé par des points-virgules avec
+# BOM UTF-8, que le tableur ouvre directement avec les accents.
+
+TAILLE_PAQUET = 1000  # lignes lues par aller-retour
+TAILLE_MORCEAU = 16 * 1024  # caractères envoyés par morceau
+
+FORMATS = ('csv', 'excel')
+
+def _valeur(valeur):
+    if isinstance(valeur, datetime):
+        return valeur.strftime('%Y-%m-%d %H:%M:%S')
+    return valeur
+
+def _encoder_csv(entetes, lignes, format_='csv'):
+    """Encode `lignes` en CSV, morceau par morceau"""
+    tampon = io.StringIO()
+    writer = csv.writer(tampon, delimiter=';' if format_ == 'excel' else ',')
+    if format_ == 'excel':
+        tampon.write('\ufeff')
+    writer.writerow(entetes)
+    # Le premier morceau part tout de suite
+    yield tampon.getvalue()
+    tampon.seek(0)
+    tampon.truncate()
+
+    for ligne in lignes:
+        writer.writerow([_valeur(v) for v in ligne])
+        if tampon.tell() >= TAILLE_MORCEAU:
+            yield tampon.getvalue()
+            tampon.seek(0)
+            tampon.truncate()
+
+    yield tampon.getvalue()
+
+def _lire(stmt):
+    """Exécute `stmt` et produit ses lignes par paquets de TAILLE_PAQUET"""
+    return db.session.execute(stmt.execution_options(yield_per=TAILLE_PAQUET))
+
+def reponse_csv(nom, entetes, stmt, format_='csv'):
+    """Réponse HTTP diffusant le résultat de `stmt` en CSV"""
+    if format_ not in FORMATS:
+        raise ValueError(f'Format inconnu: {format_}')
+    nom_fichier = f"{nom}_{datetime.now().strftime('%Y%m%d_%H%M')}.csv"
+    return Response(
+        stream_with_context(_encoder_csv(entetes, _lire(stmt), format_)),
+        mimetype='text/csv',
+        headers={'Content-Disposition': f'attachment; filename="{nom_fichier}"'}
+    )
+
+# Rapports : agrégats complets (le rapport à l'écran n'affiche que le top 10)
+
+def _rapport_ventes_mensuelles():
+    return select(VenteMensuelle.mois, VenteMensuelle.nb_ventes,
+                  VenteMensuelle.total_ht, VenteMensuelle.total_ttc).order_by(VenteMensuelle.mois)
+
+def _rapport_produits():
+    # Classement depuis l'origine : parcours de l'index (période, quantité)
+    return select(
+        Produit.code_produit, Produit.nom, ClassementProduit.quantite, ClassementProduit.total_ht
+    ).join(Produit, Produit.id == ClassementProduit.produit_id) \
+     .filter(ClassementProduit.periode == TOUT, ClassementProduit.quantite > 0) \
+     .order_by(ClassementProduit.quantite.desc(), ClassementProduit.produit_id.desc())
+
+def _rapport_clients():
+    return select(
+        Client.nom, ClassementClient.nb_ventes, ClassementClient.total_ttc
+    ).join(Client, Client.id == ClassementClient.client_id) \
+     .filter(ClassementClient.periode == TOUT, ClassementClient.total_ttc > 0) \
+     .order_by(ClassementClient.total_ttc.desc(), ClassementClient.client_id.desc())
+
+# Nom du rapport -> (en-têtes, requête)
+RAPPORTS = {
+    'ventes-mensuelles': (['mois', 'nb_ventes', 'total_ht', 'total_ttc'], _rapport_ventes_mensuelles),
+    'produits': (['code_produit', 'produit', 'quantite_vendue', 'chiffre_affaires_ht'], _rapport_produits),
+    'clients': (['client', 'nb_ventes', 'total_achats'], _rapport_clients),
+}
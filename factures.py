@@ -0,0 +1,77 @@
+import json
+from collections import defaultdict
+from sqlalchemy import select, update, bindparam
+from .models import Produit, Client, Vente, LigneVente, Facture
+
+# Instantané des factures.
+# À l'émission, la facture reçoit une copie du client (nom, coordonnées),
+# des lignes de la vente (produit, code, quantité, prix) et des totaux.
+# La liste, le détail et le PDF d'une facture lisent cette seule ligne de
+# la table factures, sans jointure vers ventes, clients, lignes_vente et
+# produits ; et la facture reste telle qu'émise si un produit ou un client
+# est renommé ensuite.
+
+TAILLE_LOT = 1000
+COLONNES_INSTANTANE = ('client_nom', 'client_email', 'client_telephone', 'client_adresse',
+                       'client_ville', 'client_code_postal', 'lignes', 'total_ht', 'taux_tva',
+                       'total_ttc', 'notes_vente')
+
+def instantanes(connexion, ventes_ids):
+    """Colonnes de l'instantané de la facture de chaque vente : {vente_id: valeurs}
+
+    Deux requêtes quel que soit le nombre de ventes ; `connexion` est une
+    connexion ou la session.
+    """
+    ventes_ids = list(ventes_ids)
+    lignes = defaultdict(list)
+    for vente_id, produit, code_produit, quantite, prix_unitaire, sous_total in connexion.execute(
+        select(LigneVente.vente_id, Produit.nom, Produit.code_produit, LigneVente.quantite,
+               LigneVente.prix_unitaire, LigneVente.sous_total)
+        .join(Produit, Produit.id == LigneVente.produit_id)
+        .where(LigneVente.vente_id.in_(ventes_ids)).order_by(LigneVente.id)
+    ):
+        lignes[vente_id].append({'produit': produit, 'code_produit': code_produit, 'quantite': quantite,
+                                 'prix_unitaire': prix_unitaire, 'sous_total': sous_total})
+
+    return {
+        vente.id: {
+            'client_nom': vente.nom,
+            'client_email': vente.email,
+            'client_telephone': vente.telephone,
+            'client_adresse': vente.adresse,
+            'client_ville': vente.ville,
+            'client_code_postal': vente.code_postal,
+            'lignes': json.dumps(lignes[vente.id], ensure_ascii=False),
+            'total_ht': vente.total_ht,
+            'taux_tva': vente.taux_tva,
+            'total_ttc': vente.total_ttc,
+            'notes_vente': vente.notes,
+        }
+        for vente in connexion.execute(
+            select(Vente.id, Vente.total_ht, Vente.taux_tva, Vente.total_ttc, Vente.notes,
+                   Client.nom, Client.email, Client.telephone, Client.adresse, Client.ville,
+                   Client.code_postal)
+            .join(Client, Client.id == Vente.client_id).where(Vente.id.in_(ventes_ids))
+        )
+    }
+
+def remplir_instantanes(connexion):
+    """Instantané des factures existantes, par lots (sans commit) ; retourne leur nombre"""
+    factures = Facture.__table__
+    maj = update(factures).where(factures.c.id == bindparam('p_id')).values(
+        {colonne: bindparam(f'p_{colonne}') for colonne in COLONNES_INSTANTANE})
+    nombre, dernier = 0, 0
+    while True:
+        lot = connexion.execute(
+            select(factures.c.id, factures.c.vente_id).where(factures.c.id > dernier)
+            .order_by(factures.c.id).limit(TAILLE_LOT)
+        ).all()
+        if not lot:
+            return nombre
+        valeurs = instantanes(connexion, [vente_id for _, vente_id in lot])
+        connexion.execute(maj, [
+            dict({f'p_{colonne}': valeur for colonne, valeur in valeurs[vente_id].items()}, p_id=facture_id)
+            for facture_id, vente_id in lot
+        ])
+        nombre += len(lot)
+        dernier = lot[-1].id
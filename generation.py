@@ -0,0 +1,223 @@
+import click
+import random
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from flask.cli import with_appcontext
+from sqlalchemy import select, insert, update, bindparam, literal, func
+from . import db
+from .models import Produit, Client, Vente, LigneVente, Facture, MouvementStock, CompteurNumero
+from .agregats import reconstruire_ventes_mensuelles, reconstruire_classements
+from .mouvements import cloturer_stocks
+from .reapprovisionnement import remplir_alertes
+from .factures import instantanes
+
+# Génération de données de test.
+# Remplit une base vide (après `flask migrer`) de produits, clients, ventes,
+# lignes et factures en volumes réalistes, pour les mesures de performance
+# (`flask mesurer-performances`). Le tirage est reproductible : une même
+# graine donne les mêmes données. Les données dérivées sont cohérentes :
+# registre des mouvements de stock, compteurs de numérotation, cumuls
+# mensuels, classements, alertes de stock, solde de stock et instantané des
+# factures.
+
+TAILLE_LOT = 5000  # lignes par INSERT
+TVA = 20.0
+DELAI_ECHEANCE = timedelta(days=30)
+
+CATEGORIES = {
+    'Alimentation': ['Riz', 'Huile', 'Sucre', 'Farine', 'Sel', 'Lait', 'Café', 'Pâtes', 'Haricots', 'Lentilles'],
+    'Boissons': ['Eau minérale', 'Jus', 'Soda', 'Bière', 'Thé', 'Sirop'],
+    'Hygiène': ['Savon', 'Dentifrice', 'Shampooing', 'Lessive', 'Papier toilette', 'Javel'],
+    'Quincaillerie': ['Clous', 'Vis', 'Ciment', 'Peinture', 'Tôle', 'Fil électrique', 'Ampoule'],
+    'Papeterie': ['Cahier', 'Stylo', 'Crayon', 'Rame de papier', 'Classeur', 'Enveloppes'],
+    'Électroménager': ['Ventilateur', 'Fer à repasser', 'Bouilloire', 'Radio', 'Lampe torche'],
+}
+QUALITES = ['standard', 'premium', 'économique', 'local', 'importé', 'bio', 'familial', 'pro']
+FORMATS = ['250 g', '500 g', '1 kg', '5 kg', '25 kg', '50 kg', '1 L', '5 L', 'lot de 6', 'lot de 12', 'unité']
+
+PRENOMS = ['Hery', 'Fara', 'Rivo', 'Lova', 'Tiana', 'Mialy', 'Andry', 'Nirina', 'Haja', 'Voahangy',
+           'Toky', 'Fanja', 'Jean', 'Marie', 'Paul', 'Sarah', 'Rado', 'Onja', 'Zo', 'Fidy']
+NOMS = ['Rakoto', 'Rabe', 'Rasoa', 'Randria', 'Razafy', 'Rajaonarison', 'Andrianasolo', 'Ravelo',
+        'Rasolofo', 'Rakotomalala', 'Razanakoto', 'Ramanantsoa', 'Rafidison', 'Rabearivelo']
+VILLES = ['Antananarivo', 'Toamasina', 'Antsirabe', 'Fianarantsoa', 'Mahajanga', 'Toliara',
+          'Antsiranana', 'Morondava', 'Ambatondrazaka', 'Nosy Be']
+
+def _lots(elements, taille=TAILLE_LOT):
+    for debut in range(0, len(elements), taille):
+        yield elements[debut:debut + taille]
+
+def _inserer(modele, lignes):
+    """Insère les lignes par lots ; retourne les identifiants dans l'ordre des lignes"""
+    ids = []
+    for lot in _lots(lignes):
+        ids += db.session.execute(
+            insert(modele).returning(modele.id, sort_by_parameter_order=True), lot
+        ).scalars().all()
+        db.session.commit()
+    return ids
+
+def _rang(rng, nombre):
+    """Rang tiré au hasard, les premiers rangs étant les plus fréquents (meilleures ventes)"""
+    return int(nombre * rng.random() ** 2)
+
+def generer_produits(rng, nombre, date):
+    lignes = []
+    categories = list(CATEGORIES)
+    for i in range(nombre):
+        categorie = rng.choice(categories)
+        nom = f'{rng.choice(CATEGORIES[categorie])} {rng.choice(QUALITES)} {rng.choice(FORMATS)}'
+        lignes.append(dict(
+            nom=nom, code_produit=f'P{i + 1:07d}', categorie=categorie,
+            description=f'{nom} ({categorie.lower()})',
+            prix_unitaire=max(100.0, round(rng.lognormvariate(8.5, 1.2), -2)),
+            stock_actuel=0, stock_minimum=rng.choice([0, 5, 10, 20]),
+            date_creation=date, actif=True, version=i + 1,
+        ))
+    return _inserer(Produit, lignes), [ligne['prix_unitaire'] for ligne in lignes]
+
+def generer_clients(rng, nombre, date):
+    lignes = []
+    for i in range(nombre):
+        prenom, nom = rng.choice(PRENOMS), rng.choice(NOMS)
+        lignes.append(dict(
+            nom=f'{prenom} {nom}', email=f'{prenom.lower()}.{nom.lower()}{i + 1}@exemple.mg',
+            telephone=f'+261 3{rng.choice("2348")} {rng.randint(10, 99)} {rng.randint(100, 999)} {rng.randint(10, 99)}',
+            adresse=f'Lot {rng.randint(1, 999)} {rng.choice("ABCDEFGH")}', ville=rng.choice(VILLES),
+            code_postal=str(rng.randint(101, 619)), date_creation=date, actif=True,
+        ))
+    return _inserer(Client, lignes)
+
+def generer_ventes(rng, nb_lignes, produits_ids, prix, clients_ids, debut, fin):
+    """Ventes, lignes et factures en ordre chronologique ; retourne (ventes, vendus par produit, compteurs)"""
+    # Nombre de lignes de chaque vente, puis dates tirées dans [debut, fin] et triées
+    tailles = []
+    lignes_restantes = nb_lignes
+    while lignes_restantes > 0:
+        tailles.append(min(lignes_restantes, rng.randint(1, 5), len(produits_ids)))
+        lignes_restantes -= tailles[-1]
+    duree = fin - debut
+    dates = sorted(debut + duree * rng.random() for _ in tailles)
+    vendus = Counter()
+    compteurs = Counter()
+    total_ventes = 0
+
+    while total_ventes < len(tailles):
+        ventes, lignes_lot, factures = [], [], []
+        for taille, date in zip(tailles[total_ventes:total_ventes + TAILLE_LOT],
+                                dates[total_ventes:total_ventes + TAILLE_LOT]):
+            jour, annee = date.strftime('%Y%m%d'), date.strftime('%Y')
+            compteurs[('vente', jour)] += 1
+            compteurs[('facture', annee)] += 1
+
+            # `taille` produits distincts, une ligne chacun
+            quantites = Counter()
+            while len(quantites) < taille:
+                quantites[_rang(rng, len(produits_ids))] += rng.randint(1, 4)
+            lignes = [dict(produit_id=produits_ids[rang], quantite=quantite, prix_unitaire=prix[rang],
+                           sous_total=prix[rang] * quantite)
+                      for rang, quantite in quantites.items()]
+            for rang, quantite in quantites.items():
+                vendus[produits_ids[rang]] += quantite
+
+            total_ht = sum(ligne['sous_total'] for ligne in lignes)
+            ventes.append(dict(
+                numero_vente=f"VTE-{jour}-{compteurs[('vente', jour)]:06d}",
+                client_id=clients_ids[_rang(rng, len(clients_ids))], date_vente=date,
+                total_ht=total_ht, taux_tva=TVA, total_ttc=total_ht * (1 + TVA / 100),
+                statut='confirmée', notes='',
+            ))
+            lignes_lot.append(lignes)
+            echeance = date + DELAI_ECHEANCE
+            if echeance > fin:
+                statut = 'payée' if rng.random() < 0.3 else 'impayée'
+            else:
+                statut = 'payée' if rng.random() < 0.9 else 'en_retard'
+            factures.append(dict(
+                numero_facture=f"FACT-{annee}-{compteurs[('facture', annee)]:06d}",
+                date_facture=date, date_echeance=echeance, statut=statut,
+            ))
+
+        ventes_ids = db.session.execute(
+            insert(Vente).returning(Vente.id, sort_by_parameter_order=True), ventes
+        ).scalars().all()
+        db.session.execute(insert(LigneVente), [
+            dict(ligne, vente_id=vente_id)
+            for vente_id, lignes in zip(ventes_ids, lignes_lot) for ligne in lignes
+        ])
+        valeurs = instantanes(db.session, ventes_ids)
+        db.session.execute(insert(Facture), [
+            dict(facture, vente_id=vente_id, **valeurs[vente_id])
+            for vente_id, facture in zip(ventes_ids, factures)
+        ])
+        db.session.commit()
+        total_ventes += len(ventes)
+
+    return total_ventes, vendus, compteurs
+
+def generer_donnees(nb_produits, nb_clients, nb_lignes, jours, graine=0):
+    """Remplit une base vide ; retourne le nombre de lignes créées par table"""
+    if db.session.execute(select(func.count()).select_from(Produit)).scalar():
+        raise ValueError('La base contient déjà des produits : la génération exige une base vide')
+    if nb_produits < 1 or nb_clients < 1:
+        raise ValueError('La génération exige au moins un produit et un client')
+    rng = random.Random(graine)
+    # Dates arrondies : deux générations avec la même graine sont identiques à la journée près
+    fin = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    debut = fin - timedelta(days=jours)
+    creation = debut - timedelta(days=1)
+
+    produits_ids, prix = generer_produits(rng, nb_produits, creation)
+    clients_ids = generer_clients(rng, nb_clients, creation)
+    nb_ventes, vendus, compteurs = generer_ventes(rng, nb_lignes, produits_ids, prix, clients_ids, debut, fin)
+
+    # Stock : stock initial = vendu + restant, au registre dès la création des produits
+    restants = {produit_id: rng.randint(0, 200) for produit_id in produits_ids}
+    for lot in _lots(produits_ids):
+        db.session.execute(
+            update(Produit.__table__).where(Produit.__table__.c.id == bindparam('p_id'))
+            .values(stock_actuel=bindparam('stock')),
+            [dict(p_id=produit_id, stock=restants[produit_id]) for produit_id in lot]
+        )
+        db.session.execute(insert(MouvementStock), [
+            dict(produit_id=produit_id, quantite=restants[produit_id] + vendus[produit_id],
+                 type_mouvement='reapprovisionnement', motif='Stock initial', date_mouvement=creation)
+            for produit_id in lot
+        ])
+        db.session.commit()
+    db.session.execute(insert(MouvementStock).from_select(
+        ['produit_id', 'quantite', 'vente_id', 'type_mouvement', 'date_mouvement'],
+        select(LigneVente.produit_id, -LigneVente.quantite, LigneVente.vente_id,
+               literal('vente'), Vente.date_vente)
+        .join(Vente, Vente.id == LigneVente.vente_id)
+    ))
+
+    db.session.execute(insert(CompteurNumero), [
+        dict(serie=serie, periode=periode, valeur=valeur) for (serie, periode), valeur in compteurs.items()
+    ])
+    db.session.commit()
+
+    reconstruire_ventes_mensuelles()
+    reconstruire_classements()
+    remplir_alertes(db.session)
+    db.session.commit()
+    cloturer_stocks(fin)
+    return {'produits': nb_produits, 'clients': nb_clients, 'ventes': nb_ventes,
+            'lignes_vente': nb_lignes, 'factures': nb_ventes}
+
+@click.command('generer-donnees')
+@click.option('--produits', 'nb_produits', default=1000, show_default=True)
+@click.option('--clients', 'nb_clients', default=5000, show_default=True)
+@click.option('--lignes', 'nb_lignes', default=50000, show_default=True, help='Lignes de vente (trois par vente en moyenne).')
+@click.option('--jours', default=730, show_default=True, help='Période couverte par les ventes.')
+@click.option('--graine', default=0, show_default=True, help='Graine du tirage (données reproductibles).')
+@with_appcontext
+def generer_donnees_commande(nb_produits, nb_clients, nb_lignes, jours, graine):
+    """Remplit une base vide de données de test en volumes réalistes"""
+    debut = time.perf_counter()
+    try:
+        volumes = generer_donnees(nb_produits, nb_clients, nb_lignes, jours, graine)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo(', '.join(f'{nombre} {table}' for table, nombre in volumes.items())
+               + f' générés en {time.perf_counter() - debut:.0f} s.')
@@ -0,0 +1,420 @@
+import csv
+import json
+import random
+import time
+import click
+from collections import defaultdict
+from datetime import datetime, timedelta
+from flask.cli import with_appcontext
+from sqlalchemy import insert, select
+from sqlalchemy.exc import DBAPIError, IntegrityError
+from . import db
+from .models import Produit, Client, Vente, LigneVente, Facture
+from .agregats import comptabiliser_mois, comptabiliser_classements, cle_mois
+from .statistiques import invalider_ventes
+from .stocks import reserver_stocks, reessayer_transaction, StockInsuffisant, TENTATIVES
+from .mouvements import enregistrer_mouvements
+from .numerotation import numeros
+from .reapprovisionnement import surveiller_stocks
+from .factures import instantanes
+
+# Import en masse des ventes (synchronisation des caisses hors ligne).
+# Les ventes sont lues au fil du flux et traitées par lots : pour chaque lot,
+# clients, produits et stocks sont lus en une requête, puis ventes, lignes et
+# factures (avec leur instantané) sont insérées en bloc dans une seule
+# transaction.
+# La référence d'une vente de caisse est enregistrée avec la vente (index
+# unique) : une caisse qui renvoie un flux après un délai dépassé ou un
+# échec partiel ne crée pas de doublon, les ventes des lots déjà validés
+# sont signalées « déjà importée » avec leur vente et leur facture.
+#
+# JSON-lines : une vente par ligne
+#   {"reference": "CAISSE1-42", "client_id": 3, "date_vente": "2024-05-02T10:15:00",
+#    "taux_tva": 20, "notes": "", "lignes": [{"produit_id": 7, "quantite": 2}]}
+# CSV : une ligne de vente par ligne, les lignes consécutives de même
+# `reference` forment une vente
+#   reference,client_id,date_vente,taux_tva,notes,produit_id,quantite,prix_unitaire
+# `flask mesurer-import` mesure le débit de l'import sur la base configurée
+# (base de test uniquement : le banc crée des produits et des ventes).
+
+TAILLE_LOT = 500
+LONGUEUR_REFERENCE = 100
+DELAI_ECHEANCE = timedelta(days=30)
+
+class ErreurImport(ValueError):
+    """Enregistrement d'import invalide"""
+
+# Lecture
+
+def lire_jsonl(flux):
+    """Enregistrements (numéro de ligne, données) d'un flux JSON-lines"""
+    for numero, texte in enumerate(flux, start=1):
+        if not texte.strip():
+            continue
+        try:
+            yield numero, json.loads(texte)
+        except ValueError as e:
+            yield numero, ErreurImport(f'JSON invalide: {e}')
+
+def lire_csv(flux):
+    """Enregistrements (numéro de ligne, données) d'un flux CSV"""
+    courant = None
+    for numero, ligne in enumerate(csv.DictReader(flux), start=2):
+        reference = (ligne.get('reference') or '').strip()
+        if courant and reference and reference == courant[1]['reference']:
+            courant[1]['lignes'].append(ligne)
+            continue
+        if courant:
+            yield courant
+        courant = (numero, {
+            'reference': reference or None,
+            'client_id': ligne.get('client_id'),
+            'date_vente': ligne.get('date_vente') or None,
+            'taux_tva': ligne.get('taux_tva') or None,
+            'notes': ligne.get('notes') or '',
+            'lignes': [ligne],
+        })
+    if courant:
+        yield courant
+
+def lire_ventes(flux, format_):
+    """Enregistrements d'un flux au format 'jsonl' ou 'csv'"""
+    if format_ == 'csv':
+        return lire_csv(flux)
+    if format_ == 'jsonl':
+        return lire_jsonl(flux)
+    raise ValueError(f'Format inconnu: {format_}')
+
+def _entier(valeur, champ):
+    try:
+        return int(valeur)
+    except (TypeError, ValueError):
+        raise ErreurImport(f'{champ} invalide: {valeur!r}')
+
+def _reel(valeur, champ):
+    try:
+        return float(valeur)
+    except (TypeError, ValueError):
+        raise ErreurImport(f'{champ} invalide: {valeur!r}')
+
+def normaliser_vente(donnees):
+    """Vérifie et convertit un enregistrement ; lève ErreurImport"""
+    if not isinstance(donnees, dict):
+        raise ErreurImport('Une vente doit être un objet')
+
+    date_vente = donnees.get('date_vente')
+    if date_vente:
+        try:
+            date_vente = datetime.fromisoformat(date_vente)
+        except (TypeError, ValueError):
+            raise ErreurImport(f'date_vente invalide: {date_vente!r}')
+
+    # Les lignes d'un même produit sont regroupées, comme dans le formulaire
+    quantites = {}
+    prix = {}
+    for ligne in donnees.get('lignes') or []:
+        if not isinstance(ligne, dict):
+            raise ErreurImport('Une ligne de vente doit être un objet')
+        produit_id = _entier(ligne.get('produit_id'), 'produit_id')
+        quantite = _entier(ligne.get('quantite'), 'quantite')
+        if quantite <= 0:
+            raise ErreurImport(f'quantite invalide: {quantite}')
+        quantites[produit_id] = quantites.get(produit_id, 0) + quantite
+        if ligne.get('prix_unitaire') not in (None, ''):
+            prix[produit_id] = _reel(ligne['prix_unitaire'], 'prix_unitaire')
+    if not quantites:
+        raise ErreurImport('Vente sans ligne')
+
+    reference = donnees.get('reference')
+    reference = None if reference in (None, '') else str(reference).strip() or None
+    if reference and len(reference) > LONGUEUR_REFERENCE:
+        raise ErreurImport(f'reference trop longue (au plus {LONGUEUR_REFERENCE} caractères)')
+
+    taux_tva = donnees.get('taux_tva')
+    return {
+        'reference': reference,
+        'client_id': _entier(donnees.get('client_id'), 'client_id'),
+        'date_vente': date_vente or datetime.utcnow(),
+        'taux_tva': 20.0 if taux_tva in (None, '') else _reel(taux_tva, 'taux_tva'),
+        'notes': donnees.get('notes') or '',
+        'quantites': quantites,
+        'prix': prix,
+    }
+
+# Traitement par lots
+
+def _rejet(numero, reference, erreur):
+    return {'ligne': numero, 'reference': reference, 'statut': 'rejetée', 'erreur': str(erreur)}
+
+def _importer_lot(lot):
+    """Importe un lot de ventes normalisées dans une transaction
+
+    `lot` est une liste de (numéro, vente). Retourne les résultats dans
+    l'ordre du lot. Lève StockInsuffisant si une vente concurrente a
+    consommé le stock entre la lecture et la réservation.
+    """
+    clients_ids = {vente['client_id'] for _, vente in lot}
+    produits_ids = {pid for _, vente in lot for pid in vente['quantites']}
+
+    # Ventes déjà importées (lot renvoyé par la caisse), avec leur facture
+    references = {vente['reference'] for _, vente in lot if vente['reference']}
+    importees = {
+        reference: (vente_id, facture_id) for reference, vente_id, facture_id in db.session.execute(
+            select(Vente.reference, Vente.id, Facture.id)
+            .outerjoin(Facture, Facture.vente_id == Vente.id)
+            .where(Vente.reference.in_(references))
+        )
+    } if references else {}
+
+    clients = set(db.session.scalars(
+        select(Client.id).where(Client.id.in_(clients_ids), Client.actif == True)
+    ))
+    produits = {
+        p.id: p for p in db.session.execute(
+            select(Produit.id, Produit.nom, Produit.prix_unitaire, Produit.stock_actuel)
+            .where(Produit.id.in_(produits_ids), Produit.actif == True)
+        )
+    }
+
+    # Affectation du stock disponible aux ventes, dans l'ordre du flux
+    disponible = {pid: p.stock_actuel or 0 for pid, p in produits.items()}
+    reserve = defaultdict(int)
+    resultats = []
+    acceptees = []
+    acceptees_references = set()
+    doublons = []
+    for numero, vente in lot:
+        reference = vente['reference']
+        if reference in importees:
+            vente_id, facture_id = importees[reference]
+            resultats.append({'ligne': numero, 'reference': reference, 'statut': 'déjà importée',
+                              'vente_id': vente_id, 'facture_id': facture_id})
+            continue
+        if reference in acceptees_references:
+            # Répétée dans le flux : renvoie à la vente de sa première occurrence
+            resultat = {'ligne': numero, 'reference': reference, 'statut': 'déjà importée'}
+            resultats.append(resultat)
+            doublons.append(resultat)
+            continue
+        try:
+            if vente['client_id'] not in clients:
+                raise ErreurImport(f"Client introuvable ou inactif: {vente['client_id']}")
+            for produit_id, quantite in vente['quantites'].items():
+                if produit_id not in produits:
+                    raise ErreurImport(f'Produit introuvable ou inactif: {produit_id}')
+                if disponible[produit_id] < quantite:
+                    raise ErreurImport(f'Stock insuffisant pour {produits[produit_id].nom}. '
+                                       f'Stock disponible: {disponible[produit_id]}')
+        except ErreurImport as e:
+            resultats.append(_rejet(numero, vente['reference'], e))
+            continue
+
+        for produit_id, quantite in vente['quantites'].items():
+            disponible[produit_id] -= quantite
+            reserve[produit_id] += quantite
+        resultat = {'ligne': numero, 'reference': vente['reference'], 'statut': 'importée'}
+        resultats.append(resultat)
+        acceptees.append((vente, resultat))
+        if reference:
+            acceptees_references.add(reference)
+
+    if not acceptees:
+        db.session.rollback()
+        return resultats
+
+    # Numéros de vente pris avant les écritures (blocs réservés hors transaction)
+    for (vente, resultat), numero in zip(acceptees, numeros('vente', [vente['date_vente'] for vente, _ in acceptees])):
+        vente['numero_vente'] = resultat['numero_vente'] = numero
+
+    # Garde atomique contre les ventes passées depuis la lecture du stock
+    reserver_stocks(dict(reserve))
+    surveiller_stocks(reserve, sorties=False)
+
+    lignes_par_vente = {}
+    lignes_vente = []
+    for vente, _ in acceptees:
+        lignes = [
+            dict(produit_id=produit_id, quantite=quantite,
+                 prix_unitaire=vente['prix'].get(produit_id, produits[produit_id].prix_unitaire))
+            for produit_id, quantite in vente['quantites'].items()
+        ]
+        for ligne in lignes:
+            ligne['sous_total'] = ligne['prix_unitaire'] * ligne['quantite']
+        vente['total_ht'] = sum(ligne['sous_total'] for ligne in lignes)
+        vente['total_ttc'] = vente['total_ht'] * (1 + vente['taux_tva'] / 100)
+        lignes_par_vente[vente['numero_vente']] = lignes
+
+    ids_ventes = dict(db.session.execute(
+        insert(Vente).returning(Vente.numero_vente, Vente.id),
+        [dict(numero_vente=vente['numero_vente'], client_id=vente['client_id'],
+              date_vente=vente['date_vente'], total_ht=vente['total_ht'],
+              taux_tva=vente['taux_tva'], total_ttc=vente['total_ttc'],
+              statut='confirmée', notes=vente['notes'], reference=vente['reference'])
+         for vente, _ in acceptees]
+    ).all())
+
+    for numero_vente, lignes in lignes_par_vente.items():
+        for ligne in lignes:
+            ligne['vente_id'] = ids_ventes[numero_vente]
+            lignes_vente.append(ligne)
+    db.session.execute(insert(LigneVente), lignes_vente)
+    enregistrer_mouvements('vente', [(ligne['produit_id'], -ligne['quantite'], ligne['vente_id'])
+                                     for ligne in lignes_vente])
+
+    # Numéros de factures sans trou : un UPDATE du compteur par année du lot
+    numeros_factures = numeros('facture', [vente['date_vente'] for vente, _ in acceptees])
+    valeurs = instantanes(db.session, ids_ventes.values())
+    ids_factures = dict(db.session.execute(
+        insert(Facture).returning(Facture.vente_id, Facture.id),
+        [dict(valeurs[ids_ventes[vente['numero_vente']]],
+              numero_facture=numero,
+              vente_id=ids_ventes[vente['numero_vente']],
+              date_facture=vente['date_vente'],
+              date_echeance=vente['date_vente'] + DELAI_ECHEANCE,
+              statut='impayée')
+         for (vente, _), numero in zip(acceptees, numeros_factures)]
+    ).all())
+
+    # Cumuls mensuels : une requête par mois présent dans le lot
+    mois = {}
+    for vente, _ in acceptees:
+        cumul = mois.setdefault(cle_mois(vente['date_vente']), [vente['date_vente'], 0, 0, 0])
+        cumul[1] += vente['total_ht']
+        cumul[2] += vente['total_ttc']
+        cumul[3] += 1
+    for date, total_ht, total_ttc, nb in mois.values():
+        comptabiliser_mois(date, total_ht, total_ttc, nb)
+    comptabiliser_classements([(vente['date_vente'], vente['client_id'], vente['total_ttc'],
+                                lignes_par_vente[vente['numero_vente']]) for vente, _ in acceptees])
+
+    db.session.commit()
+
+    for vente, resultat in acceptees:
+        resultat['vente_id'] = ids_ventes[vente['numero_vente']]
+        resultat['facture_id'] = ids_factures[resultat['vente_id']]
+    premieres = {resultat['reference']: resultat for _, resultat in acceptees if resultat['reference']}
+    for resultat in doublons:
+        resultat['vente_id'] = premieres[resultat['reference']]['vente_id']
+        resultat['facture_id'] = premieres[resultat['reference']]['facture_id']
+    return resultats
+
+def _importer_lot_avec_reessais(lot):
+    erreur = 'Conflit de stock persistant, réessayer'
+    for _ in range(TENTATIVES):
+        try:
+            return reessayer_transaction(lambda: _importer_lot(lot))
+        except StockInsuffisant:
+            # Le stock a changé entre la lecture et la réservation : on relit
+            db.session.rollback()
+        except IntegrityError:
+            # Même référence importée en même temps par un autre envoi : on relit,
+            # ses ventes seront alors « déjà importée »
+            db.session.rollback()
+            erreur = 'Conflit d\'import persistant, réessayer'
+        except DBAPIError as e:
+            # Le lot entier est annulé ; les lots précédents restent importés
+            db.session.rollback()
+            erreur = f'Erreur de base de données, lot annulé: {e.orig}'
+            break
+    return [_rejet(numero, vente['reference'], erreur) for numero, vente in lot]
+
+def importer_ventes(enregistrements, taille_lot=TAILLE_LOT):
+    """Importe les enregistrements par lots ; produit un résultat par enregistrement
+
+    Les résultats sont produits dans l'ordre des enregistrements.
+    """
+    lot = []
+    rejets = []
+    for numero, donnees in enregistrements:
+        reference = donnees.get('reference') if isinstance(donnees, dict) else None
+        try:
+            if isinstance(donnees, Exception):
+                raise donnees
+            lot.append((numero, normaliser_vente(donnees)))
+        except ErreurImport as e:
+            rejets.append(_rejet(numero, reference, e))
+
+        if len(lot) >= taille_lot:
+            yield from sorted(rejets + _importer_lot_avec_reessais(lot), key=lambda r: r['ligne'])
+            lot, rejets = [], []
+
+    resultats = _importer_lot_avec_reessais(lot) if lot else []
+    yield from sorted(rejets + resultats, key=lambda r: r['ligne'])
+
+def rapport_import(resultats, duree):
+    """Synthèse d'un import : compteurs, débit et résultats détaillés"""
+    importees = sum(1 for r in resultats if r['statut'] == 'importée')
+    deja_importees = sum(1 for r in resultats if r['statut'] == 'déjà importée')
+    return {
+        'importees': importees,
+        'deja_importees': deja_importees,
+        'rejetees': len(resultats) - importees - deja_importees,
+        'duree': round(duree, 3),
+        'ventes_par_seconde': round(importees / duree) if duree else None,
+        'resultats': resultats,
+    }
+
+@click.command('importer-ventes')
+@click.argument('fichier', type=click.File('r', encoding='utf-8'))
+@click.option('--format', 'format_', type=click.Choice(['jsonl', 'csv']),
+              help='Format du fichier (déduit de son extension par défaut)')
+@click.option('--taille-lot', default=TAILLE_LOT, show_default=True,
+              help='Nombre de ventes par transaction')
+@with_appcontext
+def importer_ventes_commande(fichier, format_, taille_lot):
+    """Importe un fichier de ventes JSON-lines ou CSV"""
+    format_ = format_ or ('csv' if fichier.name.endswith('.csv') else 'jsonl')
+    debut = time.perf_counter()
+    resultats = []
+    for resultat in importer_ventes(lire_ventes(fichier, format_), taille_lot):
+        resultats.append(resultat)
+        if resultat['statut'] == 'rejetée':
+            click.echo(f"Ligne {resultat['ligne']}: {resultat['erreur']}", err=True)
+    rapport = rapport_import(resultats, time.perf_counter() - debut)
+    if rapport['importees']:
+        invalider_ventes()
+    click.echo(f"{rapport['importees']} ventes importées, {rapport['deja_importees']} déjà importées, "
+               f"{rapport['rejetees']} rejetées "
+               f"en {rapport['duree']} s ({rapport['ventes_par_seconde']} ventes/s).")
+
+@click.command('mesurer-import')
+@click.option('--ventes', 'nombre', default=20000, show_default=True, help='Ventes importées.')
+@click.option('--lignes', default=3, show_default=True, help='Lignes par vente.')
+@click.option('--produits', 'nb_produits', default=200, show_default=True, help='Produits du banc.')
+@click.option('--taille-lot', default=TAILLE_LOT, show_default=True, help='Nombre de ventes par transaction.')
+@click.option('--minimum', default=0, show_default=True,
+              help='Débit minimal attendu (ventes/s) ; la commande échoue en deçà.')
+@click.option('--graine', default=0, show_default=True, help='Graine du tirage des lignes.')
+@with_appcontext
+def mesurer_import_commande(nombre, lignes, nb_produits, taille_lot, minimum, graine):
+    """Mesure le débit de l'import en masse des ventes (base de test uniquement)"""
+    rng = random.Random(graine)
+    banc = f'BANC-{datetime.utcnow():%Y%m%d%H%M%S}'
+    client = Client(nom=f'Client {banc}')
+    produits = [Produit(nom=f'Produit {banc} {i}', prix_unitaire=rng.randint(1, 100) * 100,
+                        stock_actuel=nombre * lignes, stock_minimum=0)
+                for i in range(nb_produits)]
+    db.session.add_all([client] + produits)
+    db.session.commit()
+    produits_ids = [produit.id for produit in produits]
+
+    # Flux JSON-lines préparé d'avance : seul l'import est mesuré
+    flux = [
+        json.dumps({'reference': f'{banc}-{i}', 'client_id': client.id,
+                    'lignes': [{'produit_id': rng.choice(produits_ids), 'quantite': rng.randint(1, 3)}
+                               for _ in range(lignes)]}) + '\n'
+        for i in range(nombre)
+    ]
+    debut = time.perf_counter()
+    resultats = list(importer_ventes(lire_ventes(flux, 'jsonl'), taille_lot))
+    rapport = rapport_import(resultats, time.perf_counter() - debut)
+    invalider_ventes()
+
+    click.echo(f"{db.engine.dialect.name} : {rapport['importees']} ventes de {lignes} ligne(s) importées "
+               f"par lots de {taille_lot} en {rapport['duree']} s ({rapport['ventes_par_seconde']} ventes/s), "
+               f"{rapport['rejetees']} rejetée(s).")
+    if rapport['rejetees']:
+        erreur = next(r['erreur'] for r in resultats if r['statut'] == 'rejetée')
+        raise click.ClickException(f'Ventes du banc rejetées : {erreur}')
+    if rapport['ventes_par_seconde'] < minimum:
+        raise click.ClickException(f"Débit inférieur au minimum de {minimum} ventes/s.")
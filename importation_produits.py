@@ -0,0 +1,420 @@
+import csv
+import io
+import itertools
+import tempfile
+import time
+import zipfile
+import click
+from collections import Counter
+from xml.etree.ElementTree import iterparse, ParseError
+from flask.cli import with_appcontext
+from sqlalchemy import select, update, bindparam, case, func
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import DBAPIError
+from . import db
+from .models import Produit, prochaine_version
+from .importation import ErreurImport
+from .mouvements import enregistrer_mouvements
+from .reapprovisionnement import surveiller_stocks
+from .statistiques import invalider_produits
+from .stocks import reessayer_transaction
+
+# Import en masse du catalogue des produits (tarifs et inventaires des fournisseurs).
+# Le fichier, CSV ou XLSX (première feuille), est lu au fil de l'eau et
+# traité par lots : les produits existants du lot sont lus en une requête
+# par leur code_produit, les nouveaux sont créés par un INSERT ... ON
+# CONFLICT (code_produit) DO UPDATE groupé, les autres mis à jour par un
+# UPDATE groupé sur leur clé. Un produit dont aucun champ ne change n'est
+# pas réécrit : sa version du catalogue ne bouge pas.
+# - Mise à jour partielle : seuls les champs présents dans le fichier (ou
+#   ceux de `champs`) sont modifiés, et une cellule vide laisse le champ
+#   inchangé. Un nouveau produit exige un nom et un prix.
+# - Le stock importé est un inventaire : l'écart avec le stock actuel est
+#   inscrit au registre des mouvements (ajustement, ou stock initial d'un
+#   nouveau produit) et les alertes de stock sont mises à jour. L'écart est
+#   calculé sur le stock que l'UPDATE remplace, vente concurrente comprise.
+# - Simulation : le rapport des différences est produit sans rien écrire.
+#
+#   code_produit,nom,description,prix_unitaire,stock_actuel,stock_minimum,categorie,actif
+# Les colonnes inconnues sont ignorées : un export de la liste des produits
+# peut être modifié puis réimporté. Séparateur , ou ; (format « excel »).
+
+TAILLE_LOT = 1000
+TAILLE_TAMPON = 16 * 1024 * 1024  # octets d'un XLSX reçu gardés en mémoire avant le disque
+
+MIMETYPE_XLSX = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+FORMATS = ('csv', 'xlsx')
+
+CHAMPS = ('nom', 'description', 'prix_unitaire', 'stock_actuel', 'stock_minimum', 'categorie', 'actif')
+OBLIGATOIRES = ('nom', 'prix_unitaire')  # pour créer un produit
+DEFAUTS = {'description': '', 'stock_actuel': 0, 'stock_minimum': 5, 'categorie': '', 'actif': True}
+MOTIF = 'Import du catalogue'
+
+_UPSERT = {'postgresql': postgresql.insert, 'sqlite': sqlite.insert}
+
+# Lecture
+
+def lire_csv(flux):
+    """Enregistrements (numéro de ligne, données) d'un flux CSV texte"""
+    entete = flux.readline()
+    delimiteur = ';' if entete.count(';') > entete.count(',') else ','
+    lecteur = csv.DictReader(itertools.chain([entete], flux), delimiter=delimiteur)
+    lecteur.fieldnames = [(nom or '').strip().lower() for nom in lecteur.fieldnames or []]
+    for numero, ligne in enumerate(lecteur, start=2):
+        yield numero, ligne
+
+_NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+_NS_REL = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+
+def _texte_xml(element):
+    # Texte simple (<t>) ou enrichi (<r><t>) ; la transcription phonétique (<rPh>) est ignorée
+    return ''.join((enfant.text if enfant.tag == _NS + 't' else enfant.findtext(_NS + 't')) or ''
+                   for enfant in element if enfant.tag in (_NS + 't', _NS + 'r'))
+
+def _colonne(reference):
+    """Indice de la colonne d'une référence de cellule (B12 -> 1)"""
+    indice = 0
+    for lettre in reference:
+        if lettre.isdigit():
+            break
+        indice = indice * 26 + ord(lettre.upper()) - 64
+    return indice - 1
+
+def _premiere_feuille(classeur):
+    """Chemin de la première feuille du classeur dans l'archive"""
+    with classeur.open('xl/workbook.xml') as xml:
+        feuille = next(e for _, e in iterparse(xml) if e.tag == _NS + 'sheet')
+    with classeur.open('xl/_rels/workbook.xml.rels') as xml:
+        cible = next(e.get('Target') for _, e in iterparse(xml) if e.get('Id') == feuille.get(_NS_REL + 'id'))
+    return cible.lstrip('/') if cible.startswith('/') else 'xl/' + cible
+
+def lire_xlsx(fichier):
+    """Enregistrements (numéro de ligne, données) de la première feuille d'un classeur XLSX
+
+    Lu au fil de l'eau (iterparse) : seules les chaînes partagées sont
+    gardées en mémoire. ErreurImport si le fichier n'est pas un classeur.
+    """
+    try:
+        classeur = zipfile.ZipFile(fichier)
+        partages = []
+        if 'xl/sharedStrings.xml' in classeur.namelist():
+            with classeur.open('xl/sharedStrings.xml') as xml:
+                for _, element in iterparse(xml):
+                    if element.tag == _NS + 'si':
+                        partages.append(_texte_xml(element))
+                        element.clear()
+        feuille = classeur.open(_premiere_feuille(classeur))
+    except (zipfile.BadZipFile, KeyError, StopIteration, ParseError) as e:
+        raise ErreurImport(f'Classeur XLSX illisible: {e}')
+
+    with classeur, feuille:
+        entetes = None
+        for _, element in iterparse(feuille):
+            if element.tag != _NS + 'row':
+                continue
+            valeurs = {}
+            indice = -1
+            for cellule in element.iter(_NS + 'c'):
+                reference = cellule.get('r')
+                indice = _colonne(reference) if reference else indice + 1
+                type_ = cellule.get('t')
+                if type_ == 'inlineStr':
+                    valeurs[indice] = _texte_xml(cellule.find(_NS + 'is'))
+                elif type_ == 's':
+                    valeurs[indice] = partages[int(cellule.findtext(_NS + 'v'))]
+                else:
+                    # Nombre, booléen (0/1) ou résultat de formule, converti comme le texte d'un CSV
+                    valeurs[indice] = cellule.findtext(_NS + 'v')
+            numero = int(element.get('r') or 0)
+            element.clear()
+            if entetes is None:
+                entetes = {i: str(nom).strip().lower() for i, nom in valeurs.items() if nom}
+            elif any(valeur not in (None, '') for valeur in valeurs.values()):
+                yield numero, {entetes[i]: valeur for i, valeur in valeurs.items() if i in entetes}
+
+def lire_catalogue(flux, format_):
+    """Enregistrements d'un flux binaire au format 'csv' ou 'xlsx'"""
+    if format_ == 'csv':
+        # utf-8-sig : le BOM des exports « excel » est retiré
+        return lire_csv(io.TextIOWrapper(flux, encoding='utf-8-sig', newline=''))
+    if format_ == 'xlsx':
+        if not flux.seekable():
+            # L'archive ZIP se lit depuis sa fin : le corps de la requête est d'abord copié
+            tampon = tempfile.SpooledTemporaryFile(max_size=TAILLE_TAMPON)
+            while morceau := flux.read(1024 * 1024):
+                tampon.write(morceau)
+            tampon.seek(0)
+            flux = tampon
+        return lire_xlsx(flux)
+    raise ValueError(f'Format inconnu: {format_}')
+
+def lire_champs(texte):
+    """Champs à mettre à jour d'une liste séparée par des virgules (tous si vide) ; ValueError"""
+    if not texte:
+        return CHAMPS
+    champs = tuple(champ.strip() for champ in texte.split(',') if champ.strip())
+    inconnus = [champ for champ in champs if champ not in CHAMPS]
+    if inconnus or not champs:
+        raise ValueError(f"Champ(s) inconnu(s): {', '.join(inconnus)}")
+    return champs
+
+# Conversion
+
+def _texte(longueur):
+    def convertir(valeur, champ):
+        texte = str(valeur).strip()
+        if longueur and len(texte) > longueur:
+            raise ErreurImport(f'{champ} trop long ({len(texte)} caractères, {longueur} au plus)')
+        return texte
+    return convertir
+
+def _nombre(valeur, champ):
+    try:
+        nombre = float(str(valeur).replace(',', '.').replace(' ', ''))
+    except ValueError:
+        raise ErreurImport(f'{champ} invalide: {valeur!r}')
+    if nombre < 0 or nombre != nombre:
+        raise ErreurImport(f'{champ} invalide: {valeur!r}')
+    return nombre
+
+def _entier(valeur, champ):
+    nombre = _nombre(valeur, champ)
+    if not nombre.is_integer():
+        raise ErreurImport(f'{champ} invalide: {valeur!r}')
+    return int(nombre)
+
+def _booleen(valeur, champ):
+    texte = str(valeur).strip().lower()
+    if texte in ('1', 'oui', 'o', 'vrai', 'true', 'yes'):
+        return True
+    if texte in ('0', 'non', 'n', 'faux', 'false', 'no'):
+        return False
+    raise ErreurImport(f'{champ} invalide: {valeur!r}')
+
+CONVERSIONS = {
+    'nom': _texte(100),
+    'description': _texte(None),
+    'prix_unitaire': _nombre,
+    'stock_actuel': _entier,
+    'stock_minimum': _entier,
+    'categorie': _texte(50),
+    'actif': _booleen,
+}
+
+def normaliser_produit(donnees):
+    """Code et champs renseignés {champ: valeur} d'un enregistrement ; lève ErreurImport"""
+    if not isinstance(donnees, dict):
+        raise ErreurImport('Un produit doit être un objet')
+    code = _texte(50)(donnees.get('code_produit') or '', 'code_produit')
+    if not code:
+        raise ErreurImport('code_produit manquant')
+    valeurs = {}
+    for champ, convertir in CONVERSIONS.items():
+        valeur = donnees.get(champ)
+        if valeur is not None and str(valeur).strip() != '':
+            valeurs[champ] = convertir(valeur, champ)
+    return code, valeurs
+
+# Traitement par lots
+
+def _rejet(numero, code, erreur):
+    return {'ligne': numero, 'code_produit': code, 'statut': 'rejeté', 'erreur': str(erreur)}
+
+def _importer_lot(lot, simulation):
+    """Crée ou met à jour un lot de produits [(numéro, code, valeurs)] dans une transaction
+
+    Retourne les résultats dans l'ordre du lot ; en simulation, rien n'est écrit.
+    """
+    # Lignes verrouillées (PostgreSQL) : le stock lu est celui qui sera remplacé
+    stmt = select(Produit.id, Produit.code_produit, *(getattr(Produit, champ) for champ in CHAMPS)) \
+        .where(Produit.code_produit.in_([code for _, code, _ in lot]))
+    if not simulation:
+        stmt = stmt.with_for_update()
+    existants = {produit.code_produit: produit for produit in db.session.execute(stmt)}
+
+    resultats, creations, modifies = [], [], {}
+    for numero, code, valeurs in lot:
+        ancien = existants.get(code)
+        if ancien is None:
+            manquants = [champ for champ in OBLIGATOIRES if champ not in valeurs]
+            if manquants:
+                resultats.append(_rejet(numero, code, f"Produit inconnu, {' et '.join(manquants)} requis "
+                                                      f"pour le créer"))
+                continue
+            resultats.append({'ligne': numero, 'code_produit': code, 'statut': 'créé'})
+            creations.append({**DEFAUTS, **valeurs, 'code_produit': code})
+            continue
+
+        modifications = {champ: [getattr(ancien, champ), valeur] for champ, valeur in valeurs.items()
+                         if getattr(ancien, champ) != valeur}
+        if not modifications:
+            resultats.append({'ligne': numero, 'code_produit': code, 'statut': 'inchangé'})
+            continue
+        resultats.append({'ligne': numero, 'code_produit': code, 'statut': 'modifié',
+                          'modifications': modifications})
+        modifies[code] = (ancien, valeurs)
+
+    if simulation or not (creations or modifies):
+        db.session.rollback()
+        return resultats
+
+    table = Produit.__table__
+    ids = {code: ancien.id for code, (ancien, _) in modifies.items()}
+    if creations:
+        # Un produit créé entre-temps sous le même code est mis à jour au lieu de faire échouer le lot
+        stmt = _UPSERT[db.session.get_bind().dialect.name](table)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.c.code_produit],
+            set_={**{champ: stmt.excluded[champ] for champ in CHAMPS}, 'version': prochaine_version()},
+        ).returning(table.c.id, table.c.code_produit)
+        ids.update((code, produit_id) for produit_id, code in db.session.execute(stmt, creations))
+
+    # Seuls les champs fournis sont réécrits, par clé primaire : un stock
+    # absent du fichier n'écrase pas une vente concurrente
+    fournis = [champ for champ in CHAMPS if any(champ in valeurs for _, valeurs in modifies.values())]
+    autres = [champ for champ in fournis if champ != 'stock_actuel']
+    lignes = [(ancien, valeurs) for ancien, valeurs in modifies.values() if set(autres) & set(valeurs)]
+    if lignes:
+        db.session.execute(
+            update(table).where(table.c.id == bindparam('p_id'))
+            .values({**{champ: bindparam(f'p_{champ}') for champ in autres}, 'version': prochaine_version()}),
+            [{'p_id': ancien.id, **{f'p_{champ}': valeurs.get(champ, getattr(ancien, champ)) for champ in autres}}
+             for ancien, valeurs in lignes]
+        )
+    ecarts = _remplacer_stocks({ancien.id: (ancien.stock_actuel or 0, valeurs['stock_actuel'])
+                                for ancien, valeurs in modifies.values() if 'stock_actuel' in valeurs})
+
+    # Stock initial des nouveaux produits, écart d'inventaire des autres
+    enregistrer_mouvements('reapprovisionnement', [
+        (ids[ligne['code_produit']], ligne['stock_actuel'], None) for ligne in creations
+    ], 'Stock initial (import du catalogue)')
+    enregistrer_mouvements('ajustement', [
+        (produit_id, nouveau - ancien, None) for produit_id, (ancien, nouveau) in ecarts.items() if nouveau != ancien
+    ], MOTIF)
+    if creations or {'stock_actuel', 'stock_minimum', 'actif'} & set(fournis):
+        surveiller_stocks(ids.values())
+    db.session.commit()
+
+    for resultat in resultats:
+        if resultat['statut'] in ('créé', 'modifié'):
+            resultat['produit_id'] = ids[resultat['code_produit']]
+        if resultat.get('produit_id') in ecarts and 'stock_actuel' in resultat['modifications']:
+            # Stock effectivement remplacé, après une éventuelle vente concurrente
+            resultat['modifications']['stock_actuel'] = list(ecarts[resultat['produit_id']])
+    return resultats
+
+def _remplacer_stocks(stocks):
+    """Remplace les stocks {produit_id: (stock lu, stock importé)} ; retourne {produit_id: (ancien, nouveau)}
+
+    Un seul UPDATE ... WHERE stock_actuel = <stock lu> RETURNING pour tous
+    les produits : l'ancien stock de chaque produit servi est celui que
+    l'UPDATE a remplacé. Un produit dont le stock a changé depuis la
+    lecture (vente concurrente ; SQLite ignore FOR UPDATE) est relu, puis
+    remplacé au tour suivant.
+    """
+    table = Produit.__table__
+    remplaces = {}
+    while stocks:
+        lus = {produit_id: lu for produit_id, (lu, _) in stocks.items()}
+        servis = db.session.execute(
+            table.update()
+            .where(table.c.id.in_(stocks),
+                   func.coalesce(table.c.stock_actuel, 0) == case(lus, value=table.c.id))
+            .values(stock_actuel=case({produit_id: nouveau for produit_id, (_, nouveau) in stocks.items()},
+                                      value=table.c.id),
+                    version=prochaine_version())
+            .returning(table.c.id, table.c.stock_actuel)
+        ).all()
+        for produit_id, nouveau in servis:
+            remplaces[produit_id] = (lus[produit_id], nouveau)
+        restants = set(stocks) - set(remplaces)
+        stocks = {produit_id: (stock or 0, stocks[produit_id][1]) for produit_id, stock in db.session.execute(
+            select(Produit.id, Produit.stock_actuel).where(Produit.id.in_(restants))
+        )} if restants else {}
+    return remplaces
+
+def _importer_lot_avec_reessais(lot, simulation):
+    try:
+        return reessayer_transaction(lambda: _importer_lot(lot, simulation))
+    except DBAPIError as e:
+        # Le lot entier est annulé ; les lots précédents restent importés
+        db.session.rollback()
+        return [_rejet(numero, code, f'Erreur de base de données, lot annulé: {e.orig}') for numero, code, _ in lot]
+
+def importer_produits(enregistrements, champs=CHAMPS, simulation=False, taille_lot=TAILLE_LOT):
+    """Importe les enregistrements par lots ; produit un résultat par enregistrement
+
+    Les résultats sont produits dans l'ordre des enregistrements. Seuls les
+    `champs` sont lus dans le fichier.
+    """
+    vus = set()
+    lot = []
+    rejets = []
+    for numero, donnees in enregistrements:
+        code = donnees.get('code_produit') if isinstance(donnees, dict) else None
+        try:
+            code, valeurs = normaliser_produit(donnees)
+            if code in vus:
+                raise ErreurImport('code_produit en double dans le fichier')
+            vus.add(code)
+            lot.append((numero, code, {champ: valeurs[champ] for champ in champs if champ in valeurs}))
+        except ErreurImport as e:
+            rejets.append(_rejet(numero, code, e))
+
+        if len(lot) >= taille_lot:
+            yield from sorted(rejets + _importer_lot_avec_reessais(lot, simulation), key=lambda r: r['ligne'])
+            lot, rejets = [], []
+
+    resultats = _importer_lot_avec_reessais(lot, simulation) if lot else []
+    yield from sorted(rejets + resultats, key=lambda r: r['ligne'])
+
+def rapport_import_produits(resultats, duree, simulation=False):
+    """Synthèse d'un import : compteurs, débit et différences (produits inchangés omis)"""
+    statuts = Counter(resultat['statut'] for resultat in resultats)
+    return {
+        'simulation': simulation,
+        'crees': statuts['créé'],
+        'modifies': statuts['modifié'],
+        'inchanges': statuts['inchangé'],
+        'rejetes': statuts['rejeté'],
+        'duree': round(duree, 3),
+        'lignes_par_seconde': round(len(resultats) / duree) if duree else None,
+        'resultats': [resultat for resultat in resultats if resultat['statut'] != 'inchangé'],
+    }
+
+@click.command('importer-produits')
+@click.argument('fichier', type=click.File('rb'))
+@click.option('--format', 'format_', type=click.Choice(FORMATS),
+              help='Format du fichier (déduit de son extension par défaut)')
+@click.option('--champs', help='Champs à mettre à jour, séparés par des virgules (par défaut tous ceux du fichier)')
+@click.option('--simulation', is_flag=True, help='Affiche les différences sans rien écrire')
+@click.option('--taille-lot', default=TAILLE_LOT, show_default=True, help='Nombre de produits par transaction')
+@with_appcontext
+def importer_produits_commande(fichier, format_, champs, simulation, taille_lot):
+    """Crée ou met à jour les produits d'un fichier CSV ou XLSX (par code_produit)"""
+    format_ = format_ or ('xlsx' if fichier.name.endswith('.xlsx') else 'csv')
+    try:
+        champs = lire_champs(champs)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--champs')
+
+    debut = time.perf_counter()
+    resultats = []
+    try:
+        for resultat in importer_produits(lire_catalogue(fichier, format_), champs, simulation, taille_lot):
+            resultats.append(resultat)
+            if resultat['statut'] == 'rejeté':
+                click.echo(f"Ligne {resultat['ligne']}: {resultat['erreur']}", err=True)
+            elif simulation and resultat['statut'] == 'modifié':
+                click.echo(f"Ligne {resultat['ligne']} {resultat['code_produit']}: " + ', '.join(
+                    f'{champ} {ancien} -> {nouveau}' for champ, (ancien, nouveau) in resultat['modifications'].items()))
+            elif simulation and resultat['statut'] == 'créé':
+                click.echo(f"Ligne {resultat['ligne']} {resultat['code_produit']}: nouveau produit")
+    except ErreurImport as e:
+        raise click.ClickException(str(e))
+    rapport = rapport_import_produits(resultats, time.perf_counter() - debut, simulation)
+    if rapport['crees'] or rapport['modifies']:
+        invalider_produits()
+    click.echo(f"{'Simulation : ' if simulation else ''}{rapport['crees']} produits créés, "
+               f"{rapport['modifies']} modifiés, {rapport['inchanges']} inchangés, {rapport['rejetes']} rejetés "
+               f"en {rapport['duree']} s ({rapport['lignes_par_seconde']} lignes/s).")
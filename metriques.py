@@ -0,0 +1,203 @@
+import logging
+import re
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from flask import request, before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Mesures de performance des requêtes HTTP.
+# Pour chaque requête : endpoint, nombre d'ordres SQL avec leur durée totale
+# et celle du plus lent (événements du moteur SQLAlchemy), durée du rendu
+# des gabarits Jinja et taille de la réponse. Les requêtes plus lentes que
+# METRIQUES_SEUIL_LENT sont journalisées avec les empreintes de leurs ordres
+# SQL ; les histogrammes cumulés par endpoint sont exposés par /metrics au
+# format texte Prometheus.
+# Le coût par ordre SQL se limite à deux lectures d'horloge : la mesure peut
+# rester active en production. Les compteurs sont propres à chaque processus
+# (chaque worker gunicorn expose les siens), et les réponses diffusées
+# (exports) ne comptent que le travail fait avant le début de la diffusion.
+
+SEUIL_LENT = 0.5  # secondes
+EMPREINTES_JOURNALISEES = 5  # ordres SQL détaillés par requête lente
+LONGUEUR_EMPREINTE = 200
+
+SECONDES = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+HISTOGRAMMES = {
+    # nom: (description, bornes des classes)
+    'requetes_http_duree_secondes': ('Durée des requêtes HTTP', SECONDES),
+    'requetes_http_sql_ordres': ('Ordres SQL exécutés par requête', (0, 1, 2, 5, 10, 20, 50, 100, 200)),
+    'requetes_http_sql_duree_secondes': ('Durée totale des ordres SQL par requête', SECONDES),
+    'requetes_http_sql_max_secondes': ('Durée de l\'ordre SQL le plus lent de la requête', SECONDES),
+    'requetes_http_rendu_secondes': ('Durée du rendu des gabarits par requête', SECONDES),
+    'requetes_http_taille_octets': ('Taille des réponses', (1e3, 1e4, 1e5, 1e6, 1e7)),
+}
+
+_LITTERAUX = re.compile(r"'(?:[^']|'')*'|%\(\w+\)s|%s|\$\d+|(?<![\w.])\d+(?:\.\d+)?\b")
+_LISTES = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_COLONNES = re.compile(r'^SELECT\s(?:(?!\(SELECT).)*?\sFROM\s', re.S)
+
+# Mesure de la requête en cours (None hors requête : CLI, tâches de fond)
+_mesure = ContextVar('mesure', default=None)
+
+class Mesure:
+    """Travail d'une requête HTTP"""
+    __slots__ = ('debut', 'ordres', 'rendu', 'debut_rendu')
+
+    def __init__(self):
+        self.debut = time.perf_counter()
+        self.ordres = []  # (ordre SQL, durée)
+        self.rendu = 0.0
+        self.debut_rendu = None
+
+def empreinte_sql(ordre):
+    """Forme normalisée d'un ordre SQL : littéraux et listes de paramètres remplacés par ?
+
+    La liste des colonnes d'un SELECT (sans sous-requête) est omise : la table
+    et les conditions suffisent à reconnaître la requête.
+    """
+    ordre = _LISTES.sub('(?)', _LITTERAUX.sub('?', ordre))
+    ordre = _COLONNES.sub('SELECT ... FROM ', ordre)
+    return ' '.join(ordre.split())[:LONGUEUR_EMPREINTE]
+
+def _avant_ordre(conn, cursor, statement, parameters, context, executemany):
+    if context is not None and _mesure.get() is not None:
+        context._debut_mesure = time.perf_counter()
+
+def _apres_ordre(conn, cursor, statement, parameters, context, executemany):
+    mesure = _mesure.get()
+    debut = getattr(context, '_debut_mesure', None)
+    if mesure is not None and debut is not None:
+        mesure.ordres.append((statement, time.perf_counter() - debut))
+
+def _avant_rendu(sender, template, context, **extra):
+    mesure = _mesure.get()
+    if mesure is not None:
+        mesure.debut_rendu = time.perf_counter()
+
+def _apres_rendu(sender, template, context, **extra):
+    mesure = _mesure.get()
+    if mesure is not None and mesure.debut_rendu is not None:
+        mesure.rendu += time.perf_counter() - mesure.debut_rendu
+        mesure.debut_rendu = None
+
+class Metriques:
+    """Histogrammes des requêtes HTTP par endpoint, propres au processus"""
+
+    def __init__(self):
+        self.seuil_lent = SEUIL_LENT
+        self._histogrammes = {}  # (nom, endpoint): [effectifs par classe, somme, nombre]
+        self._requetes = {}  # (endpoint, méthode, code): nombre
+        self._verrou = threading.Lock()
+
+    def init_app(self, app):
+        if not app.config.get('METRIQUES', True):
+            return
+        self.seuil_lent = app.config.get('METRIQUES_SEUIL_LENT', SEUIL_LENT)
+        # Tous les moteurs (base principale et éventuels réplicas) sont mesurés
+        if not event.contains(Engine, 'before_cursor_execute', _avant_ordre):
+            event.listen(Engine, 'before_cursor_execute', _avant_ordre)
+            event.listen(Engine, 'after_cursor_execute', _apres_ordre)
+        before_render_template.connect(_avant_rendu, app)
+        template_rendered.connect(_apres_rendu, app)
+        app.before_request(self._commencer)
+        app.after_request(self._terminer)
+        app.teardown_request(self._abandonner)
+
+    def _commencer(self):
+        _mesure.set(Mesure())
+
+    def _terminer(self, response):
+        self._enregistrer(response.status_code, response.content_length)
+        return response
+
+    def _abandonner(self, erreur=None):
+        # Exception non gérée : after_request n'a pas été appelé
+        if _mesure.get() is not None:
+            self._enregistrer(500, None)
+
+    def _enregistrer(self, code, taille):
+        mesure = _mesure.get()
+        if mesure is None:
+            return
+        _mesure.set(None)
+        duree = time.perf_counter() - mesure.debut
+        durees_sql = [d for _, d in mesure.ordres]
+        duree_sql = sum(durees_sql)
+        endpoint = request.endpoint or 'aucun'
+        valeurs = {
+            'requetes_http_duree_secondes': duree,
+            'requetes_http_sql_ordres': len(durees_sql),
+            'requetes_http_sql_duree_secondes': duree_sql,
+            'requetes_http_sql_max_secondes': max(durees_sql, default=0.0),
+            'requetes_http_rendu_secondes': mesure.rendu,
+            'requetes_http_taille_octets': taille,
+        }
+
+        with self._verrou:
+            for nom, valeur in valeurs.items():
+                if valeur is not None:
+                    self._observer(nom, endpoint, valeur)
+            cle = (endpoint, request.method, code)
+            self._requetes[cle] = self._requetes.get(cle, 0) + 1
+
+        if duree >= self.seuil_lent:
+            self._journaliser(mesure, endpoint, code, duree, duree_sql, valeurs)
+
+    def _observer(self, nom, endpoint, valeur):
+        bornes = HISTOGRAMMES[nom][1]
+        histogramme = self._histogrammes.get((nom, endpoint))
+        if histogramme is None:
+            histogramme = self._histogrammes[(nom, endpoint)] = [[0] * (len(bornes) + 1), 0.0, 0]
+        histogramme[0][bisect_left(bornes, valeur)] += 1
+        histogramme[1] += valeur
+        histogramme[2] += 1
+
+    def _journaliser(self, mesure, endpoint, code, duree, duree_sql, valeurs):
+        empreintes = {}
+        for ordre, duree_ordre in mesure.ordres:
+            cumul = empreintes.setdefault(empreinte_sql(ordre), [0, 0.0])
+            cumul[0] += 1
+            cumul[1] += duree_ordre
+        plus_lentes = sorted(empreintes.items(), key=lambda e: e[1][1], reverse=True)
+        details = ''.join(
+            f'\n  {nombre} x {total * 1000:.0f} ms  {empreinte}'
+            for empreinte, (nombre, total) in plus_lentes[:EMPREINTES_JOURNALISEES]
+        )
+        logging.getLogger(__name__).warning(
+            'Requête lente %s %s (%s, %s) : %.0f ms, %d ordres SQL en %.0f ms (max %.0f ms), '
+            'rendu %.0f ms, %s octets%s',
+            request.method, request.path, endpoint, code, duree * 1000, len(mesure.ordres),
+            duree_sql * 1000, valeurs['requetes_http_sql_max_secondes'] * 1000, mesure.rendu * 1000,
+            valeurs['requetes_http_taille_octets'] if valeurs['requetes_http_taille_octets'] is not None else '?',
+            details
+        )
+
+    def exposition(self):
+        """Compteurs et histogrammes au format texte Prometheus"""
+        with self._verrou:
+            histogrammes = {cle: (list(h[0]), h[1], h[2]) for cle, h in self._histogrammes.items()}
+            requetes = dict(self._requetes)
+
+        lignes = ['# HELP requetes_http_total Requêtes HTTP traitées',
+                  '# TYPE requetes_http_total counter']
+        for (endpoint, methode, code), nombre in sorted(requetes.items()):
+            lignes.append(f'requetes_http_total{{endpoint="{endpoint}",methode="{methode}",code="{code}"}} {nombre}')
+
+        for nom, (description, bornes) in HISTOGRAMMES.items():
+            lignes += [f'# HELP {nom} {description}', f'# TYPE {nom} histogram']
+            for (nom_histogramme, endpoint), (effectifs, somme, nombre) in sorted(histogrammes.items()):
+                if nom_histogramme != nom:
+                    continue
+                cumul = 0
+                for borne, effectif in zip([f'{b:g}' for b in bornes] + ['+Inf'], effectifs):
+                    cumul += effectif
+                    lignes.append(f'{nom}_bucket{{endpoint="{endpoint}",le="{borne}"}} {cumul}')
+                lignes.append(f'{nom}_sum{{endpoint="{endpoint}"}} {somme}')
+                lignes.append(f'{nom}_count{{endpoint="{endpoint}"}} {nombre}')
+        return '\n'.join(lignes) + '\n'
+
+metriques = Metriques()
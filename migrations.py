@@ -0,0 +1,359 @@
+import click
+from datetime import datetime
+from flask.cli import with_appcontext
+from sqlalchemy import inspect
+from . import db
+from .agregats import remplir_ventes_mensuelles, remplir_classements
+from .reapprovisionnement import remplir_alertes
+from .recherche import creer_index_recherche
+from .factures import remplir_instantanes
+
+# Migrations versionnées du schéma.
+# Chaque migration est appliquée une seule fois et enregistrée dans la table
+# versions_schema ; `flask migrer` applique celles qui manquent, dans l'ordre.
+# Chaque migration décrit ses tables, colonnes et index tels qu'ils étaient
+# à sa version, sans lire models.py : les modèles évoluent, l'effet d'une
+# migration déjà écrite ne change pas. Les tables d'une autre version n'y
+# figurent que par les colonnes utilisées (clés étrangères, index).
+
+versions_schema = db.Table(
+    'versions_schema',
+    db.Column('version', db.Integer, primary_key=True),
+    db.Column('description', db.String(200), nullable=False),
+    db.Column('date_application', db.DateTime, nullable=False),
+)
+
+def _creer(connexion, *elements):
+    """Crée les tables (avec leurs index) ou les index donnés qui n'existent pas encore"""
+    for element in elements:
+        element.create(connexion, checkfirst=True)
+
+def _ajouter_colonne(connexion, table, colonne, options=''):
+    """Ajoute une colonne à une table existante, si elle n'y est pas encore"""
+    if colonne.name in {c['name'] for c in inspect(connexion).get_columns(table)}:
+        return
+    type_ = colonne.type.compile(connexion.dialect)
+    connexion.exec_driver_sql(f'ALTER TABLE {table} ADD COLUMN {colonne.name} {type_} {options}')
+
+def _schema_initial(connexion):
+    schema = db.MetaData()
+    _creer(connexion, db.Table(
+        'produits', schema,
+        db.Column('id', db.Integer, primary_key=True),
+        db.Column('nom', db.String(100), nullable=False),
+        db.Column('description', db.Text),
+        db.Column('prix_unitaire', db.Float, nullable=False),
+        db.Column('stock_actuel', db.Integer),
+        db.Column('stock_minimum', db.Integer),
+        db.Column('categorie', db.String(50)),
+        db.Column('code_produit', db.String(50), unique=True),
+        db.Column('date_creation', db.DateTime),
+        db.Column('actif', db.Boolean),
+    ), db.Table(
+        'clients', schema,
+        db.Column('id', db.Integer, primary_key=True),
+        db.Column('nom', db.String(100), nullable=False),
+        db.Column('email', db.String(120)),
+        db.Column('telephone', db.String(20)),
+        db.Column('adresse', db.Text),
+        db.Column('ville', db.String(50)),
+        db.Column('code_postal', db.String(10)),
+        db.Column('date_creation', db.DateTime),
+        db.Column('actif', db.Boolean),
+    ), db.Table(
+        'ventes', schema,
+        db.Column('id', db.Integer, primary_key=True),
+        db.Column('numero_vente', db.String(50), unique=True, nullable=False),
+        db.Column('client_id', db.Integer, db.ForeignKey('clients.id'), nullable=False),
+        db.Column('date_vente', db.DateTime),
+        db.Column('total_ht', db.Float),
+        db.Column('taux_tva', db.Float),
+        db.Column('total_ttc', db.Float),
+        db.Column('statut', db.String(20)),
+        db.Column('notes', db.Text),
+    ), db.Table(
+        'lignes_vente', schema,
+        db.Column('id', db.Integer, primary_key=True),
+        db.Column('vente_id', db.Integer, db.ForeignKey('ventes.id'), nullable=False),
+        db.Column('produit_id', db.Integer, db.ForeignKey('produits.id'), nullable=False),
+        db.Column('quantite', db.Integer, nullable=False),
+        db.Column('prix_unitaire', db.Float, nullable=False),
+        db.Column('sous_total', db.Float, nullable=False),
+    ), db.Table(
+        'factures', schema,
+        db.Column('id', db.Integer, primary_key=True),
+        db.Column('numero_facture', db.String(50), unique=True, nullable=False),
+        db.Column('vente_id', db.Integer, db.ForeignKey('ventes.id'), nullable=False),
+        db.Column('date_facture', db.DateTime),
+        db.Column('date_echeance', db.DateTime),
+        db.Column('statut', db.String(20)),
+        db.Column('notes', db.Text),
+    ), db.Table(
+        'ventes_mensuelles', schema,
+        db.Column('mois', db.String(7), primary_key=True),
+        db.Column('total_ht', db.Float, nullable=False),
+        db.Column('total_ttc', db.Float, nullable=False),
+        db.Column('nb_ventes', db.Integer, nullable=False),
+    ))
+
+def _index_requetes(connexion):
+    schema = db.MetaData()
+    produits = db.Table('produits', schema, db.Column('id', db.Integer), db.Column('nom', db.String(100)),
+                        db.Column('prix_unitaire', db.Float), db.Column('stock_actuel', db.Integer),
+                        db.Column('stock_minimum', db.Integer), db.Column('categorie', db.String(50)),
+                        db.Column('actif', db.Boolean))
+    clients = db.Table('clients', schema, db.Column('id', db.Integer), db.Column('nom', db.String(100)),
+                       db.Column('date_creation', db.DateTime), db.Column('actif', db.Boolean))
+    ventes = db.Table('ventes', schema, db.Column('id', db.Integer), db.Column('client_id', db.Integer),
+                      db.Column('date_vente', db.DateTime), db.Column('total_ttc', db.Float),
+                      db.Column('statut', db.String(20)))
+    lignes = db.Table('lignes_vente', schema, db.Column('vente_id', db.Integer), db.Column('produit_id', db.Integer))
+    factures = db.Table('factures', schema, db.Column('id', db.Integer), db.Column('vente_id', db.Integer),
+                        db.Column('date_facture', db.DateTime), db.Column('statut', db.String(20)))
+    p, c = produits.c, clients.c
+    _creer(connexion,
+           db.Index('ix_produits_actifs_nom', p.nom, p.id, postgresql_where=(p.actif == True), sqlite_where=(p.actif == True)),
+           db.Index('ix_produits_actifs_categorie', p.categorie, p.nom,
+                    postgresql_where=(p.actif == True), sqlite_where=(p.actif == True)),
+           db.Index('ix_produits_actifs_prix', p.prix_unitaire, p.id,
+                    postgresql_where=(p.actif == True), sqlite_where=(p.actif == True)),
+           db.Index('ix_produits_stock_faible', p.id,
+                    postgresql_where=db.and_(p.actif == True, p.stock_actuel <= p.stock_minimum),
+                    sqlite_where=db.and_(p.actif == True, p.stock_actuel <= p.stock_minimum)),
+           db.Index('ix_clients_actifs_nom', c.nom, c.id, postgresql_where=(c.actif == True), sqlite_where=(c.actif == True)),
+           db.Index('ix_clients_actifs_date', c.date_creation, c.id,
+                    postgresql_where=(c.actif == True), sqlite_where=(c.actif == True)),
+           db.Index('ix_ventes_statut_date', ventes.c.statut, ventes.c.date_vente),
+           db.Index('ix_ventes_date', ventes.c.date_vente, ventes.c.id),
+           db.Index('ix_ventes_montant', ventes.c.total_ttc, ventes.c.id),
+           db.Index('ix_ventes_client_date', ventes.c.client_id, ventes.c.date_vente),
+           db.Index('ix_lignes_vente_vente', lignes.c.vente_id),
+           db.Index('ix_lignes_vente_produit', lignes.c.produit_id, lignes.c.vente_id),
+           db.Index('ix_factures_statut_date', factures.c.statut, factures.c.date_facture, factures.c.id),
+           db.Index('ix_factures_date', factures.c.date_facture, factures.c.id),
+           db.Index('ix_factures_vente', factures.c.vente_id))
+
+def _version_catalogue(connexion):
+    postgresql = connexion.dialect.name == 'postgresql'
+    if postgresql:
+        connexion.exec_driver_sql('CREATE SEQUENCE IF NOT EXISTS produits_version_seq')
+    produits = db.Table('produits', db.MetaData(), db.Column('id', db.Integer), db.Column('version', db.Integer))
+    _ajouter_colonne(connexion, 'produits', produits.c.version, 'NOT NULL DEFAULT 0')
+    # Les produits existants forment la première version du catalogue
+    connexion.execute(produits.update().values(version=produits.c.id))
+    if postgresql:
+        connexion.exec_driver_sql(
+            "SELECT setval('produits_version_seq', coalesce(max(id), 0) + 1, false) FROM produits")
+    _creer(connexion, db.Index('ix_produits_version', produits.c.version))
+
+def _registre_stock(connexion):
+    schema = db.MetaData()
+    produits = db.Table('produits', schema, db.Column('id', db.Integer, primary_key=True),
+                        db.Column('stock_actuel', db.Integer))
+    db.Table('ventes', schema, db.Column('id', db.Integer, primary_key=True))
+    mouvements = db.Table(
+        'mouvements_stock', schema,
+        db.Column('id', db.Integer, primary_key=True),
+        db.Column('produit_id', db.Integer, db.ForeignKey('produits.id'), nullable=False),
+        db.Column('date_mouvement', db.DateTime, nullable=False),
+        db.Column('type_mouvement', db.String(20), nullable=False),
+        db.Column('quantite', db.Integer, nullable=False),
+        db.Column('vente_id', db.Integer, db.ForeignKey('ventes.id')),
+        db.Column('motif', db.String(200)),
+    )
+    db.Index('ix_mouvements_stock_date', mouvements.c.date_mouvement, mouvements.c.produit_id)
+    db.Index('ix_mouvements_stock_produit_date', mouvements.c.produit_id, mouvements.c.date_mouvement)
+    soldes = db.Table(
+        'soldes_stock', schema,
+        db.Column('date_solde', db.DateTime, primary_key=True),
+        db.Column('produit_id', db.Integer, db.ForeignKey('produits.id'), primary_key=True),
+        db.Column('stock', db.Integer, nullable=False),
+    )
+    _creer(connexion, mouvements, soldes)
+    # Solde d'ouverture : le stock actuel, point de départ du registre
+    connexion.execute(soldes.insert().from_select(
+        ['date_solde', 'produit_id', 'stock'],
+        db.select(db.literal(datetime.utcnow(), db.DateTime), produits.c.id, produits.c.stock_actuel)
+        .where(produits.c.stock_actuel != 0)
+    ))
+
+def _compteurs_numeros(connexion):
+    _creer(connexion, db.Table(
+        'compteurs_numeros', db.MetaData(),
+        db.Column('serie', db.String(20), primary_key=True),
+        db.Column('periode', db.String(8), primary_key=True),
+        db.Column('valeur', db.Integer, nullable=False),
+    ))
+
+def _taches(connexion):
+    schema = db.MetaData()
+    executions = db.Table(
+        'executions_taches', schema,
+        db.Column('id', db.Integer, primary_key=True),
+        db.Column('tache', db.String(50), nullable=False),
+        db.Column('debut', db.DateTime, nullable=False),
+        db.Column('duree', db.Float, nullable=False),
+        db.Column('lignes', db.Integer),
+        db.Column('erreur', db.Text),
+    )
+    db.Index('ix_executions_taches_tache_debut', executions.c.tache, executions.c.debut)
+    factures = db.Table('factures', schema, db.Column('statut', db.String(20)),
+                        db.Column('date_echeance', db.DateTime))
+    _creer(connexion, executions,
+           db.Index('ix_factures_statut_echeance', factures.c.statut, factures.c.date_echeance))
+
+def _classements(connexion):
+    schema = db.MetaData()
+    db.Table('produits', schema, db.Column('id', db.Integer, primary_key=True))
+    db.Table('clients', schema, db.Column('id', db.Integer, primary_key=True))
+    produits = db.Table(
+        'classement_produits', schema,
+        db.Column('periode', db.String(7), primary_key=True),
+        db.Column('produit_id', db.Integer, db.ForeignKey('produits.id'), primary_key=True),
+        db.Column('quantite', db.Integer, nullable=False),
+        db.Column('total_ht', db.Float, nullable=False),
+    )
+    db.Index('ix_classement_produits_quantite', produits.c.periode, produits.c.quantite, produits.c.produit_id)
+    db.Index('ix_classement_produits_total', produits.c.periode, produits.c.total_ht, produits.c.produit_id)
+    clients = db.Table(
+        'classement_clients', schema,
+        db.Column('periode', db.String(7), primary_key=True),
+        db.Column('client_id', db.Integer, db.ForeignKey('clients.id'), primary_key=True),
+        db.Column('nb_ventes', db.Integer, nullable=False),
+        db.Column('total_ttc', db.Float, nullable=False),
+    )
+    db.Index('ix_classement_clients_total', clients.c.periode, clients.c.total_ttc, clients.c.client_id)
+    db.Index('ix_classement_clients_ventes', clients.c.periode, clients.c.nb_ventes, clients.c.client_id)
+    _creer(connexion, produits, clients)
+    # Classements initiaux : l'historique des ventes confirmées
+    remplir_classements(connexion)
+
+def _alertes_stock(connexion):
+    schema = db.MetaData()
+    db.Table('produits', schema, db.Column('id', db.Integer, primary_key=True))
+    alertes = db.Table(
+        'alertes_stock', schema,
+        db.Column('produit_id', db.Integer, db.ForeignKey('produits.id'), primary_key=True),
+        db.Column('depuis', db.DateTime, nullable=False),
+        db.Column('vitesse', db.Float),
+        db.Column('jours_avant_rupture', db.Float),
+        db.Column('quantite_suggeree', db.Integer),
+        db.Column('date_calcul', db.DateTime),
+    )
+    notifications = db.Table(
+        'notifications', schema,
+        db.Column('id', db.Integer, primary_key=True),
+        db.Column('type', db.String(30), nullable=False),
+        db.Column('produit_id', db.Integer, db.ForeignKey('produits.id')),
+        db.Column('contenu', db.Text, nullable=False),
+        db.Column('date_creation', db.DateTime, nullable=False),
+        db.Column('date_envoi', db.DateTime),
+        db.Column('tentatives', db.Integer, nullable=False),
+        db.Column('erreur', db.Text),
+    )
+    envoi = notifications.c.date_envoi
+    db.Index('ix_notifications_en_attente', notifications.c.id,
+             postgresql_where=(envoi == None), sqlite_where=(envoi == None))
+    _creer(connexion, alertes, notifications)
+    # Alertes en cours : les produits déjà sous leur minimum, sans notification
+    remplir_alertes(connexion)
+
+def _instantanes_factures(connexion):
+    for colonne in (db.Column('client_nom', db.String(100)), db.Column('client_email', db.String(120)),
+                    db.Column('client_telephone', db.String(20)), db.Column('client_adresse', db.Text),
+                    db.Column('client_ville', db.String(50)), db.Column('client_code_postal', db.String(10)),
+                    db.Column('lignes', db.Text), db.Column('total_ht', db.Float),
+                    db.Column('taux_tva', db.Float), db.Column('total_ttc', db.Float),
+                    db.Column('notes_vente', db.Text)):
+        _ajouter_colonne(connexion, 'factures', colonne)
+    # Factures déjà émises : client et produits tels qu'ils sont aujourd'hui
+    remplir_instantanes(connexion)
+
+def _reservation_notifications(connexion):
+    _ajouter_colonne(connexion, 'notifications', db.Column('reservee_jusqua', db.DateTime))
+
+def _cumuls_mensuels(connexion):
+    # La migration 1 crée ventes_mensuelles sans la remplir : une base
+    # antérieure aux migrations avait un rapport mensuel vide
+    remplir_ventes_mensuelles(connexion)
+
+def _versions_par_transaction(connexion):
+    # PostgreSQL : la version d'un produit devient l'identifiant de la
+    # transaction qui l'écrit (catalogue.py), à la place de la séquence
+    if connexion.dialect.name != 'postgresql':
+        return
+    connexion.exec_driver_sql('ALTER TABLE produits ALTER COLUMN version TYPE bigint')
+    # Produits de la version de cette migration : renvoyés une fois aux formulaires
+    connexion.exec_driver_sql('UPDATE produits SET version = pg_current_xact_id()::text::bigint')
+    connexion.exec_driver_sql('DROP SEQUENCE IF EXISTS produits_version_seq')
+
+def _references_ventes(connexion):
+    ventes = db.Table('ventes', db.MetaData(), db.Column('reference', db.String(100)))
+    _ajouter_colonne(connexion, 'ventes', ventes.c.reference)
+    _creer(connexion, db.Index('ix_ventes_reference', ventes.c.reference, unique=True))
+
+def _transactions_lignes(connexion):
+    # Position de l'export des analyses dans l'ordre des commits (analyses.py)
+    lignes = db.Table('lignes_vente', db.MetaData(), db.Column('transaction_id', db.BigInteger))
+    _ajouter_colonne(connexion, 'lignes_vente', lignes.c.transaction_id)
+    if connexion.dialect.name != 'postgresql':
+        return
+    # Lignes existantes : transaction de cette migration, relues une fois par l'export
+    connexion.exec_driver_sql('ALTER TABLE lignes_vente ALTER COLUMN transaction_id '
+                              'SET DEFAULT pg_current_xact_id()::text::bigint')
+    connexion.exec_driver_sql('UPDATE lignes_vente SET transaction_id = pg_current_xact_id()::text::bigint')
+    _creer(connexion, db.Index('ix_lignes_vente_transaction', lignes.c.transaction_id))
+
+MIGRATIONS = [
+    (1, 'Schéma initial', _schema_initial),
+    (2, 'Index des requêtes du tableau de bord, des rapports et des listes', _index_requetes),
+    (3, 'Index de recherche plein texte des produits et des clients', creer_index_recherche),
+    (4, 'Version du catalogue des produits', _version_catalogue),
+    (5, 'Registre des mouvements de stock et soldes périodiques', _registre_stock),
+    (6, 'Compteurs de la numérotation des ventes et des factures', _compteurs_numeros),
+    (7, 'Exécutions des tâches de fond et index des échéances des factures', _taches),
+    (8, 'Classements des produits et des clients par période', _classements),
+    (9, 'Alertes de stock faible et file des notifications', _alertes_stock),
+    (10, 'Instantané du client, des lignes et des totaux des factures', _instantanes_factures),
+    (11, 'Réservation des notifications en cours d\'envoi', _reservation_notifications),
+    (12, 'Cumuls mensuels des ventes antérieures aux migrations', _cumuls_mensuels),
+    (13, 'Versions du catalogue dans l\'ordre des transactions', _versions_par_transaction),
+    (14, 'Référence des ventes importées des caisses', _references_ventes),
+    (15, 'Transaction des lignes de vente pour l\'export des analyses', _transactions_lignes),
+]
+
+def version_actuelle(connexion):
+    """Dernière version appliquée (0 pour une base vierge)"""
+    versions_schema.create(connexion, checkfirst=True)
+    return connexion.execute(db.select(db.func.max(versions_schema.c.version))).scalar() or 0
+
+def appliquer_migrations():
+    """Applique les migrations manquantes ; retourne les versions appliquées"""
+    appliquees = []
+    with db.engine.begin() as connexion:
+        actuelle = version_actuelle(connexion)
+
+    for version, description, migration in MIGRATIONS:
+        if version <= actuelle:
+            continue
+        # Une transaction par migration : une erreur laisse la base à la version précédente
+        with db.engine.begin() as connexion:
+            migration(connexion)
+            connexion.execute(versions_schema.insert().values(
+                version=version,
+                description=description,
+                date_application=datetime.utcnow()
+            ))
+        appliquees.append(version)
+
+    return appliquees
+
+@click.command('migrer')
+@with_appcontext
+def migrer_commande():
+    """Applique les migrations du schéma de la base de données"""
+    appliquees = appliquer_migrations()
+    if appliquees:
+        click.echo(f'Migrations appliquées: {", ".join(str(v) for v in appliquees)}')
+    else:
+        click.echo('Base de données à jour.')
@@ -1,6 +1,28 @@
+import json
 from datetime import datetime
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.functions import FunctionElement
 from . import db
 
+class prochaine_version(FunctionElement):
+    """Numéro de version suivant du catalogue des produits
+
+    Les versions suivent l'ordre des commits (voir catalogue.py).
+    """
+    type = db.BigInteger()
+    inherit_cache = True
+
+@compiles(prochaine_version)
+def _prochaine_version(element, compiler, **kw):
+    # SQLite sérialise les écritures : max + 1 ne peut pas être attribué deux
+    # fois, et la transaction qui l'a lu est validée avant la suivante
+    return '(SELECT coalesce(max(version), 0) + 1 FROM produits)'
+
+@compiles(prochaine_version, 'postgresql')
+def _prochaine_version_postgresql(element, compiler, **kw):
+    # Identifiant de la transaction qui écrit
+    return 'pg_current_xact_id()::text::bigint'
+
 class Produit(db.Model):
     __tablename__ = 'produits'
     
@@ -14,6 +36,25 @@ class Produit(db.Model):
     code_produit = db.Column(db.String(50), unique=True)
     date_creation = db.Column(db.DateTime, default=datetime.utcnow)
     actif = db.Column(db.Boolean, default=True)
+    # Version du catalogue à la dernière modification (nom, prix, stock...),
+    # pour la synchronisation incrémentale du formulaire de vente
+    version = db.Column(db.BigInteger, nullable=False, default=prochaine_version(),
+                        onupdate=prochaine_version())
+    
+    __table_args__ = (
+        db.Index('ix_produits_version', 'version'),
+        # Liste des produits actifs triée par nom ou filtrée par catégorie
+        db.Index('ix_produits_actifs_nom', 'nom', 'id',
+                 postgresql_where=(actif == True), sqlite_where=(actif == True)),
+        db.Index('ix_produits_actifs_categorie', 'categorie', 'nom',
+                 postgresql_where=(actif == True), sqlite_where=(actif == True)),
+        db.Index('ix_produits_actifs_prix', 'prix_unitaire', 'id',
+                 postgresql_where=(actif == True), sqlite_where=(actif == True)),
+        # Alertes de stock du tableau de bord : l'index ne contient que les produits concernés
+        db.Index('ix_produits_stock_faible', 'id',
+                 postgresql_where=db.and_(actif == True, stock_actuel <= stock_minimum),
+                 sqlite_where=db.and_(actif == True, stock_actuel <= stock_minimum)),
+    )
     
     # Relations
     lignes_vente = db.relationship('LigneVente', backref='produit', lazy=True)
@@ -38,6 +79,13 @@ class Client(db.Model):
     date_creation = db.Column(db.DateTime, default=datetime.utcnow)
     actif = db.Column(db.Boolean, default=True)
     
+    __table_args__ = (
+        db.Index('ix_clients_actifs_nom', 'nom', 'id',
+                 postgresql_where=(actif == True), sqlite_where=(actif == True)),
+        db.Index('ix_clients_actifs_date', 'date_creation', 'id',
+                 postgresql_where=(actif == True), sqlite_where=(actif == True)),
+    )
+    
     # Relations
     ventes = db.relationship('Vente', backref='client', lazy=True)
     
@@ -56,14 +104,32 @@ class Vente(db.Model):
     total_ttc = db.Column(db.Float, default=0.0)  # Montant TTC en ariary
     statut = db.Column(db.String(20), default='confirmée')  # confirmée, annulée
     notes = db.Column(db.Text)
+    reference = db.Column(db.String(100))  # Référence de la caisse pour une vente importée
+    
+    __table_args__ = (
+        # Une vente de caisse n'est importée qu'une fois (plusieurs NULL permis)
+        db.Index('ix_ventes_reference', 'reference', unique=True),
+        # Totaux du jour et du mois (statut = 'confirmée' AND date_vente >= ...)
+        db.Index('ix_ventes_statut_date', 'statut', 'date_vente'),
+        # Liste des ventes triée par date ou par montant, filtrée par client
+        db.Index('ix_ventes_date', 'date_vente', 'id'),
+        db.Index('ix_ventes_montant', 'total_ttc', 'id'),
+        db.Index('ix_ventes_client_date', 'client_id', 'date_vente'),
+    )
     
     # Relations
     lignes = db.relationship('LigneVente', backref='vente', lazy=True, cascade='all, delete-orphan')
     facture = db.relationship('Facture', backref='vente', uselist=False, lazy=True)
     
-    def calculer_totaux(self):
-        """Calcule les totaux HT et TTC basés sur les lignes de vente"""
-        self.total_ht = sum(ligne.sous_total for ligne in self.lignes)
+    def calculer_totaux(self, sous_totaux=None):
+        """Calcule les totaux HT et TTC basés sur les lignes de vente
+
+        `sous_totaux` évite de recharger les lignes quand elles viennent
+        d'être insérées en bloc.
+        """
+        if sous_totaux is None:
+            sous_totaux = [ligne.sous_total for ligne in self.lignes]
+        self.total_ht = sum(sous_totaux)
         self.total_ttc = self.total_ht * (1 + self.taux_tva / 100)
     
     def __repr__(self):
@@ -78,6 +144,14 @@ class LigneVente(db.Model):
     quantite = db.Column(db.Integer, nullable=False)
     prix_unitaire = db.Column(db.Float, nullable=False)  # Prix au moment de la vente
     sous_total = db.Column(db.Float, nullable=False)
+    # PostgreSQL : transaction qui a écrit la ligne (défaut posé par la
+    # migration 15), position de l'export des analyses ; NULL sous SQLite
+    transaction_id = db.Column(db.BigInteger, server_default=db.FetchedValue())
+    
+    __table_args__ = (
+        db.Index('ix_lignes_vente_vente', 'vente_id'),
+        db.Index('ix_lignes_vente_produit', 'produit_id', 'vente_id'),
+    )
     
     def __init__(self, **kwargs):
         super(LigneVente, self).__init__(**kwargs)
@@ -95,8 +169,173 @@ class Facture(db.Model):
     vente_id = db.Column(db.Integer, db.ForeignKey('ventes.id'), nullable=False)
     date_facture = db.Column(db.DateTime, default=datetime.utcnow)
     date_echeance = db.Column(db.DateTime)
-    statut = db.Column(db.String(20), default='impayée')  # impayée, payée, en_retard
+    statut = db.Column(db.String(20), default='impayée')  # impayée, payée, en_retard, annulée
     notes = db.Column(db.Text)
     
+    # Instantané de la vente à l'émission : client, lignes et totaux tels que
+    # facturés, lus sans jointure par la liste, le détail et le PDF
+    client_nom = db.Column(db.String(100))
+    client_email = db.Column(db.String(120))
+    client_telephone = db.Column(db.String(20))
+    client_adresse = db.Column(db.Text)
+    client_ville = db.Column(db.String(50))
+    client_code_postal = db.Column(db.String(10))
+    lignes = db.Column(db.Text)  # JSON : produit, code_produit, quantite, prix_unitaire, sous_total
+    total_ht = db.Column(db.Float)
+    taux_tva = db.Column(db.Float)
+    total_ttc = db.Column(db.Float)
+    notes_vente = db.Column(db.Text)
+    
+    __table_args__ = (
+        # Liste des factures, filtrée ou non par statut, triée par date
+        db.Index('ix_factures_statut_date', 'statut', 'date_facture', 'id'),
+        db.Index('ix_factures_date', 'date_facture', 'id'),
+        db.Index('ix_factures_vente', 'vente_id'),
+        # Factures impayées arrivées à échéance (tâche des retards)
+        db.Index('ix_factures_statut_echeance', 'statut', 'date_echeance'),
+    )
+    
+    def liste_lignes(self):
+        """Lignes de la facture telles qu'émises"""
+        return json.loads(self.lignes or '[]')
+    
+    def __repr__(self):
+        return f'<Facture {self.numero_facture}>'
+
+class VenteMensuelle(db.Model):
+    __tablename__ = 'ventes_mensuelles'
+    
+    mois = db.Column(db.String(7), primary_key=True)  # AAAA-MM
+    total_ht = db.Column(db.Float, nullable=False, default=0.0)
+    total_ttc = db.Column(db.Float, nullable=False, default=0.0)
+    nb_ventes = db.Column(db.Integer, nullable=False, default=0)
+    
+    def __repr__(self):
+        return f'<VenteMensuelle {self.mois}>'
+
+class ClassementProduit(db.Model):
+    __tablename__ = 'classement_produits'
+    
+    periode = db.Column(db.String(7), primary_key=True)  # AAAA-MM, AAAA ou tout
+    produit_id = db.Column(db.Integer, db.ForeignKey('produits.id'), primary_key=True)
+    quantite = db.Column(db.Integer, nullable=False, default=0)
+    total_ht = db.Column(db.Float, nullable=False, default=0.0)
+    
+    __table_args__ = (
+        # Meilleurs produits d'une période et rang d'un produit : parcours d'index
+        db.Index('ix_classement_produits_quantite', 'periode', 'quantite', 'produit_id'),
+        db.Index('ix_classement_produits_total', 'periode', 'total_ht', 'produit_id'),
+    )
+    
+    def __repr__(self):
+        return f'<ClassementProduit {self.periode} {self.produit_id}: {self.quantite}>'
+
+class ClassementClient(db.Model):
+    __tablename__ = 'classement_clients'
+    
+    periode = db.Column(db.String(7), primary_key=True)  # AAAA-MM, AAAA ou tout
+    client_id = db.Column(db.Integer, db.ForeignKey('clients.id'), primary_key=True)
+    nb_ventes = db.Column(db.Integer, nullable=False, default=0)
+    total_ttc = db.Column(db.Float, nullable=False, default=0.0)
+    
+    __table_args__ = (
+        db.Index('ix_classement_clients_total', 'periode', 'total_ttc', 'client_id'),
+        db.Index('ix_classement_clients_ventes', 'periode', 'nb_ventes', 'client_id'),
+    )
+    
+    def __repr__(self):
+        return f'<ClassementClient {self.periode} {self.client_id}: {self.total_ttc}>'
+
+class AlerteStock(db.Model):
+    __tablename__ = 'alertes_stock'
+    
+    # Produits actifs au stock minimum ou en dessous, tenus à jour à chaque variation du stock
+    produit_id = db.Column(db.Integer, db.ForeignKey('produits.id'), primary_key=True)
+    depuis = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    # Suggestion de réapprovisionnement, calculée par la tâche de fond (None avant le premier calcul)
+    vitesse = db.Column(db.Float)  # Unités vendues par jour (moyenne mobile pondérée)
+    jours_avant_rupture = db.Column(db.Float)  # None si le produit ne se vend pas
+    quantite_suggeree = db.Column(db.Integer)
+    date_calcul = db.Column(db.DateTime)
+    
+    def __repr__(self):
+        return f'<AlerteStock {self.produit_id}>'
+
+class Notification(db.Model):
+    __tablename__ = 'notifications'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    type = db.Column(db.String(30), nullable=False)  # stock_faible
+    produit_id = db.Column(db.Integer, db.ForeignKey('produits.id'))
+    contenu = db.Column(db.Text, nullable=False)  # JSON
+    date_creation = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    date_envoi = db.Column(db.DateTime)  # None tant qu'elle n'est pas envoyée
+    tentatives = db.Column(db.Integer, nullable=False, default=0)
+    erreur = db.Column(db.Text)  # Erreur du dernier envoi
+    reservee_jusqua = db.Column(db.DateTime)  # Envoi en cours par un worker jusqu'à cette date
+    
+    __table_args__ = (
+        # File d'envoi : l'index ne contient que les notifications en attente
+        db.Index('ix_notifications_en_attente', 'id',
+                 postgresql_where=(date_envoi == None), sqlite_where=(date_envoi == None)),
+    )
+    
+    def __repr__(self):
+        return f'<Notification {self.type} {self.id}>'
+
+class MouvementStock(db.Model):
+    __tablename__ = 'mouvements_stock'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    produit_id = db.Column(db.Integer, db.ForeignKey('produits.id'), nullable=False)
+    date_mouvement = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    type_mouvement = db.Column(db.String(20), nullable=False)  # vente, reapprovisionnement, ajustement, annulation
+    quantite = db.Column(db.Integer, nullable=False)  # Positive en entrée, négative en sortie
+    vente_id = db.Column(db.Integer, db.ForeignKey('ventes.id'))
+    motif = db.Column(db.String(200))
+    
+    __table_args__ = (
+        # Mouvements d'une période (soldes) et historique d'un produit
+        db.Index('ix_mouvements_stock_date', 'date_mouvement', 'produit_id'),
+        db.Index('ix_mouvements_stock_produit_date', 'produit_id', 'date_mouvement'),
+    )
+    
+    def __repr__(self):
+        return f'<MouvementStock {self.type_mouvement} {self.quantite:+d}>'
+
+class SoldeStock(db.Model):
+    __tablename__ = 'soldes_stock'
+    
+    date_solde = db.Column(db.DateTime, primary_key=True)
+    produit_id = db.Column(db.Integer, db.ForeignKey('produits.id'), primary_key=True)
+    stock = db.Column(db.Integer, nullable=False)
+    
+    def __repr__(self):
+        return f'<SoldeStock {self.produit_id} {self.date_solde}: {self.stock}>'
+
+class CompteurNumero(db.Model):
+    __tablename__ = 'compteurs_numeros'
+    
+    serie = db.Column(db.String(20), primary_key=True)  # vente, facture
+    periode = db.Column(db.String(8), primary_key=True)  # AAAAMMJJ ou AAAA selon la série
+    valeur = db.Column(db.Integer, nullable=False, default=0)  # Dernier numéro attribué
+    
+    def __repr__(self):
+        return f'<CompteurNumero {self.serie} {self.periode}: {self.valeur}>'
+
+class ExecutionTache(db.Model):
+    __tablename__ = 'executions_taches'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    tache = db.Column(db.String(50), nullable=False)
+    debut = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    duree = db.Column(db.Float, nullable=False)  # secondes
+    lignes = db.Column(db.Integer)  # Lignes traitées
+    erreur = db.Column(db.Text)  # None si l'exécution a réussi
+    
+    __table_args__ = (
+        db.Index('ix_executions_taches_tache_debut', 'tache', 'debut'),
+    )
+    
     def __repr__(self):
-        return f'<Facture {self.numero_facture}>'
\ No newline at end of file
+        return f'<ExecutionTache {self.tache} {self.debut}>'
@@ -0,0 +1,193 @@
+import click
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+import time
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import OperationalError
+
+# Configuration des moteurs SQLAlchemy selon le dialecte.
+# - SQLite : journal WAL (les lectures ne bloquent plus les écritures ni
+#   l'inverse), synchronous=NORMAL (plus de fsync à chaque commit en WAL,
+#   sans risque de corruption), attente des verrous (busy_timeout) au lieu
+#   de l'échec immédiat « database is locked », cache de pages et mmap
+#   agrandis. Les PRAGMA sont appliqués à chaque nouvelle connexion. La
+#   gestion des transactions de pysqlite est conservée : le BEGIN n'est émis
+#   qu'au premier ordre d'écriture, qui attend alors le verrou sans échec.
+# - PostgreSQL : pool dimensionné (par worker gunicorn : taille + débordement
+#   connexions au plus), connexions vérifiées avant emploi et renouvelées,
+#   délai maximal par ordre SQL (statement_timeout) et par transaction
+#   inactive, executemany groupés. Les lectures en masse (exports) passent
+#   déjà par un curseur serveur (yield_per).
+# Le cache des ordres compilés de SQLAlchemy est agrandi pour tous les
+# dialectes : les pages en filtrent et paginent de nombreuses variantes.
+# `flask mesurer-concurrence` compare le débit de processus concurrents
+# avec et sans ces réglages.
+
+TAILLE_CACHE_ORDRES = 1200  # ordres compilés gardés par moteur (500 par défaut)
+POOL = 5
+POOL_DEBORDEMENT = 10
+DELAI_REQUETE = 30  # secondes ; au-delà, PostgreSQL annule l'ordre SQL
+
+PRAGMAS_SQLITE = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 15000,  # ms
+    'cache_size': -64000,  # Kio (64 Mio par connexion)
+    'mmap_size': 256 * 1024 * 1024,
+    'temp_store': 'MEMORY',
+}
+# Sans effet (ou refusés) sur une base en mémoire
+PRAGMAS_FICHIER = ('journal_mode', 'mmap_size')
+
+def _sqlite_en_memoire(url):
+    return url.database in (None, '', ':memory:') or 'mode=memory' in str(url)
+
+def options_moteur(uri, pool=POOL, debordement=POOL_DEBORDEMENT, delai_requete=DELAI_REQUETE):
+    """Options de create_engine (SQLALCHEMY_ENGINE_OPTIONS) adaptées au dialecte de l'URI"""
+    url = make_url(uri)
+    dialecte = url.get_backend_name()
+    options = {'query_cache_size': TAILLE_CACHE_ORDRES}
+
+    if dialecte == 'sqlite':
+        # Pas de pool_pre_ping : une connexion SQLite ne se coupe pas, le
+        # SELECT 1 à chaque emprunt serait perdu
+        return options
+
+    options.update(pool_recycle=1800, pool_pre_ping=True)
+    if dialecte == 'postgresql':
+        options.update(
+            pool_size=pool,
+            max_overflow=debordement,
+            pool_timeout=10,
+            # Les connexions les plus récentes sont réutilisées en premier :
+            # les autres restent inactives et sont recyclées
+            pool_use_lifo=True,
+            connect_args={
+                'connect_timeout': 10,
+                'application_name': 'gestion-commerciale',
+                'options': f'-c statement_timeout={delai_requete * 1000} '
+                           f'-c idle_in_transaction_session_timeout={delai_requete * 2000}',
+            },
+        )
+        if url.get_dialect().driver == 'psycopg2':
+            # UPDATE en masse groupés eux aussi (psycopg2 seulement ; psycopg 3
+            # groupe les executemany de lui-même)
+            options['executemany_mode'] = 'values_plus_batch'
+    return options
+
+def _pragmas_sqlite(en_memoire, lecture_seule):
+    pragmas = [(nom, valeur) for nom, valeur in PRAGMAS_SQLITE.items()
+               if not (en_memoire and nom in PRAGMAS_FICHIER)]
+    if lecture_seule:
+        # Réplica : toute écriture y échoue au lieu de le faire diverger
+        pragmas.append(('query_only', 'ON'))
+
+    def appliquer(connexion_dbapi, enregistrement):
+        curseur = connexion_dbapi.cursor()
+        for nom, valeur in pragmas:
+            curseur.execute(f'PRAGMA {nom} = {valeur}')
+        curseur.close()
+    return appliquer
+
+def configurer_moteur(moteur, lecture_seule=False):
+    """Branche les réglages appliqués à chaque connexion (PRAGMA de SQLite)"""
+    if moteur.dialect.name == 'sqlite':
+        event.listen(moteur, 'connect', _pragmas_sqlite(_sqlite_en_memoire(moteur.url), lecture_seule))
+    return moteur
+
+def _banc_processus(uri, regle, duree, ecritures, lignes, graine, barriere, resultats):
+    """Processus du banc d'essai : lectures et écritures mêlées pendant `duree` secondes"""
+    try:
+        moteur = create_engine(uri, **options_moteur(uri)) if regle else create_engine(uri)
+        if regle:
+            configurer_moteur(moteur)
+        moteur.connect().close()
+        rng = random.Random(graine)
+        comptes = {'lectures': 0, 'ecritures': 0, 'erreurs': 0}
+        barriere.wait()
+
+        fin = time.perf_counter() + duree
+        while time.perf_counter() < fin:
+            try:
+                if rng.random() < ecritures:
+                    # Vente simulée : mise à jour d'un stock et écriture au journal
+                    with moteur.begin() as connexion:
+                        ligne = rng.randrange(lignes)
+                        connexion.execute(text('UPDATE banc_concurrence SET valeur = valeur - 1 WHERE id = :id'),
+                                          {'id': ligne})
+                        connexion.execute(text('INSERT INTO banc_concurrence_journal (ligne) VALUES (:id)'),
+                                          {'id': ligne})
+                    comptes['ecritures'] += 1
+                else:
+                    # Page de liste : lecture d'une plage
+                    debut = rng.randrange(max(1, lignes - 2000))
+                    with moteur.connect() as connexion:
+                        connexion.execute(text('SELECT count(*), sum(valeur) FROM banc_concurrence '
+                                               'WHERE id BETWEEN :debut AND :fin'),
+                                          {'debut': debut, 'fin': debut + 2000}).one()
+                    comptes['lectures'] += 1
+            except OperationalError:
+                comptes['erreurs'] += 1
+        moteur.dispose()
+        resultats.put((comptes, None))
+    except Exception as e:
+        resultats.put((None, str(e)))
+
+@click.command('mesurer-concurrence')
+@click.option('--processus', default=8, show_default=True, help='Processus concurrents (workers gunicorn).')
+@click.option('--duree', default=5.0, show_default=True, help='Durée de chaque mesure (secondes).')
+@click.option('--ecritures', default=0.2, show_default=True, help='Part des écritures (0 à 1).')
+@click.option('--lignes', default=20000, show_default=True, help='Lignes de la table d\'essai.')
+@click.option('--base', help='Base de l\'essai (par défaut une base SQLite temporaire).')
+def mesurer_concurrence_commande(processus, duree, ecritures, lignes, base):
+    """Compare le débit de processus concurrents avec les options par défaut et réglées"""
+    dossier = None
+    if base is None:
+        dossier = tempfile.mkdtemp()
+        base = 'sqlite:///' + os.path.join(dossier, 'banc.db')
+    moteur = create_engine(base)
+    sqlite = moteur.dialect.name == 'sqlite'
+    with moteur.begin() as connexion:
+        connexion.execute(text('CREATE TABLE banc_concurrence (id INTEGER PRIMARY KEY, valeur INTEGER NOT NULL)'))
+        connexion.execute(text('CREATE TABLE banc_concurrence_journal (ligne INTEGER NOT NULL)'))
+        connexion.execute(text('INSERT INTO banc_concurrence (id, valeur) VALUES (:id, 1000000)'),
+                          [{'id': i} for i in range(lignes)])
+    contexte = multiprocessing.get_context('spawn')
+
+    try:
+        for mode, regle in (('défaut', False), ('réglé', True)):
+            if sqlite:
+                # Le mode du journal est enregistré dans le fichier : chaque mesure part du sien
+                with moteur.connect() as connexion:
+                    connexion.exec_driver_sql(f"PRAGMA journal_mode = {'WAL' if regle else 'DELETE'}")
+            barriere = contexte.Barrier(processus)
+            resultats = contexte.Queue()
+            travailleurs = [
+                contexte.Process(target=_banc_processus,
+                                 args=(base, regle, duree, ecritures, lignes, rang, barriere, resultats))
+                for rang in range(processus)
+            ]
+            for travailleur in travailleurs:
+                travailleur.start()
+            mesures = [resultats.get() for _ in travailleurs]
+            for travailleur in travailleurs:
+                travailleur.join()
+            erreurs = [erreur for _, erreur in mesures if erreur]
+            if erreurs:
+                raise click.ClickException(f'Échec d\'un processus du banc : {erreurs[0]}')
+
+            total = {cle: sum(comptes[cle] for comptes, _ in mesures) for cle in mesures[0][0]}
+            click.echo(f"{mode}: {(total['lectures'] + total['ecritures']) / duree:.0f} transactions/s "
+                       f"({total['lectures'] / duree:.0f} lectures/s, {total['ecritures'] / duree:.0f} écritures/s), "
+                       f"{total['erreurs']} échec(s) « database is locked » ou délai dépassé")
+    finally:
+        with moteur.begin() as connexion:
+            connexion.execute(text('DROP TABLE banc_concurrence'))
+            connexion.execute(text('DROP TABLE banc_concurrence_journal'))
+        moteur.dispose()
+        if dossier:
+            shutil.rmtree(dossier)
@@ -0,0 +1,124 @@
+import click
+from datetime import datetime, timedelta
+from flask.cli import with_appcontext
+from sqlalchemy import select, insert, update, func, union_all
+from . import db
+from .models import Produit, MouvementStock, SoldeStock
+
+# Registre des mouvements de stock.
+# Toute variation de Produit.stock_actuel (vente, réapprovisionnement,
+# ajustement, annulation) est enregistrée dans mouvements_stock, table en
+# ajout seul, dans la même transaction que la variation.
+# Des soldes périodiques (soldes_stock, `flask cloturer-stocks`) sont
+# calculés à partir du solde précédent et des mouvements de la période :
+# le stock à une date passée se calcule depuis le dernier solde, en ne
+# relisant que les mouvements qui le suivent.
+
+TYPES_MOUVEMENT = ('vente', 'reapprovisionnement', 'ajustement', 'annulation')
+
+# Une clôture ne porte que sur les mouvements plus anciens que cette marge,
+# pour que les transactions en cours aient été validées
+MARGE_CLOTURE = timedelta(minutes=5)
+
+ENTETES_INVENTAIRE = ['id', 'code_produit', 'produit', 'stock']
+
+def enregistrer_mouvements(type_, mouvements, motif=None):
+    """Enregistre en une requête les mouvements [(produit_id, quantité signée, vente_id)]"""
+    if type_ not in TYPES_MOUVEMENT:
+        raise ValueError(f'Type de mouvement inconnu: {type_}')
+    date = datetime.utcnow()
+    lignes = [
+        dict(produit_id=produit_id, quantite=quantite, vente_id=vente_id,
+             type_mouvement=type_, motif=motif, date_mouvement=date)
+        for produit_id, quantite, vente_id in mouvements if quantite
+    ]
+    if lignes:
+        db.session.execute(insert(MouvementStock), lignes)
+
+def ajuster_stock(produit_id, nouveau_stock, motif=None):
+    """Fixe le stock d'un produit et enregistre l'écart comme ajustement ; retourne l'écart"""
+    # Ligne verrouillée (PostgreSQL) : une vente concurrente ne peut pas
+    # s'intercaler entre la lecture et l'écriture
+    actuel = db.session.execute(
+        select(Produit.stock_actuel).where(Produit.id == produit_id).with_for_update()
+    ).scalar() or 0
+    ecart = nouveau_stock - actuel
+    if ecart:
+        db.session.execute(update(Produit).where(Produit.id == produit_id)
+                           .values(stock_actuel=nouveau_stock))
+        enregistrer_mouvements('ajustement', [(produit_id, ecart, None)], motif)
+    return ecart
+
+def derniere_cloture(date=None):
+    """Date du dernier solde antérieur ou égal à `date` (None s'il n'y en a pas)"""
+    stmt = select(func.max(SoldeStock.date_solde))
+    if date is not None:
+        stmt = stmt.where(SoldeStock.date_solde <= date)
+    return db.session.execute(stmt).scalar()
+
+def _soldes(date):
+    """Stock de chaque produit à `date` : dernier solde + mouvements suivants"""
+    cloture = derniere_cloture(date)
+    mouvements = select(MouvementStock.produit_id, MouvementStock.quantite) \
+        .where(MouvementStock.date_mouvement <= date)
+    if cloture is None:
+        elements = mouvements
+    else:
+        elements = union_all(
+            select(SoldeStock.produit_id, SoldeStock.stock.label('quantite')).where(SoldeStock.date_solde == cloture),
+            mouvements.where(MouvementStock.date_mouvement > cloture)
+        )
+    elements = elements.subquery()
+    return select(elements.c.produit_id, func.sum(elements.c.quantite).label('stock')) \
+        .group_by(elements.c.produit_id)
+
+def requete_stocks_au(date, ids=None):
+    """Requête du stock des produits à `date` (code, nom, stock)"""
+    soldes = _soldes(date).subquery()
+    stmt = select(Produit.id, Produit.code_produit, Produit.nom,
+                  func.coalesce(soldes.c.stock, 0).label('stock')) \
+        .outerjoin(soldes, soldes.c.produit_id == Produit.id) \
+        .where(Produit.date_creation <= date)
+    if ids is not None:
+        stmt = stmt.where(Produit.id.in_(ids))
+    return stmt.order_by(Produit.id)
+
+def cloturer_stocks(date=None):
+    """Enregistre le solde de chaque produit à `date` ; retourne le nombre de soldes
+
+    Les stocks nuls ne sont pas enregistrés. Sans effet si un solde plus
+    récent existe déjà.
+    """
+    date = date or datetime.utcnow() - MARGE_CLOTURE
+    derniere = derniere_cloture()
+    if derniere is not None and derniere >= date:
+        return 0
+    soldes = _soldes(date).subquery()
+    resultat = db.session.execute(
+        insert(SoldeStock).from_select(
+            ['date_solde', 'produit_id', 'stock'],
+            select(db.literal(date, db.DateTime), soldes.c.produit_id, soldes.c.stock)
+            .where(soldes.c.stock != 0)
+        )
+    )
+    db.session.commit()
+    return resultat.rowcount
+
+def ecarts_stock():
+    """Produits dont le stock ne correspond pas au registre des mouvements"""
+    soldes = requete_stocks_au(datetime.utcnow()).subquery()
+    return db.session.execute(
+        select(Produit.id, Produit.nom, Produit.stock_actuel, soldes.c.stock)
+        .join(soldes, soldes.c.id == Produit.id)
+        .where(func.coalesce(Produit.stock_actuel, 0) != soldes.c.stock)
+        .order_by(Produit.id)
+    ).all()
+
+@click.command('cloturer-stocks')
+@with_appcontext
+def cloturer_stocks_commande():
+    """Enregistre les soldes de stock et contrôle le registre des mouvements"""
+    nb = cloturer_stocks()
+    click.echo(f'{nb} soldes de stock enregistrés.')
+    for produit_id, nom, stock_actuel, solde in ecarts_stock():
+        click.echo(f'Écart sur {nom} ({produit_id}): stock {stock_actuel}, registre {solde}', err=True)
@@ -0,0 +1,187 @@
+import click
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+from datetime import datetime
+from sqlalchemy import create_engine
+from sqlalchemy.dialects import postgresql, sqlite
+from . import db
+from .models import CompteurNumero
+
+# Numérotation des ventes et des factures.
+# Les numéros sont tirés de compteurs en base (compteurs_numeros), un par
+# série et par période : VTE-AAAAMMJJ-000001 pour les ventes (compteur du
+# jour), FACT-AAAA-000001 pour les factures (compteur de l'année). Un
+# numéro ne peut pas être attribué deux fois : plus d'échec de la vente
+# sur la contrainte d'unicité.
+# - Factures : le compteur est incrémenté dans la transaction de la vente,
+#   et revient en arrière avec elle : la suite est sans trou, comme l'exige
+#   la comptabilité. La ligne du compteur reste verrouillée jusqu'au commit,
+#   le numéro est donc pris en fin de transaction.
+# - Ventes : chaque processus réserve un bloc de numéros dans une courte
+#   transaction séparée, puis les distribue sans accès à la base ; les
+#   ventes ne se disputent pas la ligne du compteur. Les numéros d'un bloc
+#   non utilisés (arrêt du processus, vente en échec) sont perdus.
+
+TAILLE_BLOC = 20  # numéros de vente réservés à la fois par processus
+BLOCS_MAX = 64  # blocs entamés conservés (un par série et par période)
+
+SERIES = {
+    # série: (préfixe, période, numéros réservés par bloc ; None = sans trou)
+    'vente': ('VTE', '%Y%m%d', TAILLE_BLOC),
+    'facture': ('FACT', '%Y', None),
+}
+
+SERIE_BANC = 'banc'  # série du banc d'essai, supprimée après la mesure
+
+_UPSERT = {'postgresql': postgresql.insert, 'sqlite': sqlite.insert}
+
+def reserver(connexion, serie, periode, nombre=1):
+    """Avance de `nombre` le compteur (serie, periode) ; retourne sa nouvelle valeur
+
+    Les numéros réservés vont de valeur - nombre + 1 à valeur. Le compteur
+    est créé au premier numéro de la période (INSERT ... ON CONFLICT).
+    """
+    table = CompteurNumero.__table__
+    stmt = _UPSERT[connexion.dialect.name](table).values(serie=serie, periode=periode, valeur=nombre)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.serie, table.c.periode],
+        set_={'valeur': table.c.valeur + nombre}
+    ).returning(table.c.valeur)
+    return connexion.execute(stmt).scalar_one()
+
+class Distributeur:
+    """Blocs de numéros réservés par le processus courant"""
+
+    def __init__(self):
+        self.blocs = {}  # (série, période): [prochain, dernier]
+        self.pid = os.getpid()
+        self.verrou = threading.Lock()
+
+    def suivant(self, moteur, serie, periode, taille_bloc):
+        """Numéro suivant de la série ; réserve un bloc quand le précédent est épuisé"""
+        with self.verrou:
+            if self.pid != os.getpid():
+                # Processus issu d'un fork : les blocs du parent ne lui appartiennent pas
+                self.blocs, self.pid = {}, os.getpid()
+            bloc = self.blocs.get((serie, periode))
+            if bloc is None or bloc[0] > bloc[1]:
+                if len(self.blocs) >= BLOCS_MAX:
+                    # Import de nombreuses journées passées : les blocs entamés sont abandonnés
+                    self.blocs.clear()
+                # Transaction séparée, validée aussitôt : le compteur n'est pas
+                # verrouillé pendant la vente
+                with moteur.begin() as connexion:
+                    dernier = reserver(connexion, serie, periode, taille_bloc)
+                bloc = self.blocs[(serie, periode)] = [dernier - taille_bloc + 1, dernier]
+            bloc[0] += 1
+            return bloc[0] - 1
+
+_distributeur = Distributeur()
+
+def numeros(serie, dates):
+    """Numéros de la série pour des documents datés `dates` (None = maintenant)
+
+    Série sans trou : un UPDATE du compteur par période, dans la transaction
+    en cours. Série par blocs : sous SQLite, à appeler avant les écritures de
+    la transaction, le bloc étant réservé par une autre connexion.
+    """
+    prefixe, format_, taille_bloc = SERIES[serie]
+    periodes = [(date or datetime.utcnow()).strftime(format_) for date in dates]
+
+    if taille_bloc:
+        valeurs = [_distributeur.suivant(db.engine, serie, periode, taille_bloc) for periode in periodes]
+    else:
+        rangs = {}
+        for rang, periode in enumerate(periodes):
+            rangs.setdefault(periode, []).append(rang)
+        valeurs = [None] * len(periodes)
+        connexion = db.session.connection()
+        for periode, rangs_periode in rangs.items():
+            dernier = reserver(connexion, serie, periode, len(rangs_periode))
+            for valeur, rang in enumerate(rangs_periode, dernier - len(rangs_periode) + 1):
+                valeurs[rang] = valeur
+
+    return [f'{prefixe}-{periode}-{valeur:06d}' for periode, valeur in zip(periodes, valeurs)]
+
+def numero_vente(date=None):
+    """Numéro d'une nouvelle vente"""
+    return numeros('vente', [date])[0]
+
+def numero_facture(date=None):
+    """Numéro d'une nouvelle facture (suite annuelle sans trou)"""
+    return numeros('facture', [date])[0]
+
+def _banc_processus(uri, mode, nombre, taille_bloc, travail, barriere, resultats):
+    """Processus du banc d'essai : tire `nombre` numéros et renvoie (numéros, durée)"""
+    moteur = create_engine(uri)
+    moteur.connect().close()
+    distributeur = Distributeur()
+    barriere.wait()
+
+    debut = time.perf_counter()
+    valeurs = []
+    for _ in range(nombre):
+        # `travail` simule le reste de la transaction de vente
+        if mode == 'bloc':
+            valeurs.append(distributeur.suivant(moteur, SERIE_BANC, mode, taille_bloc))
+            time.sleep(travail)
+        else:
+            with moteur.begin() as connexion:
+                valeurs.append(reserver(connexion, SERIE_BANC, mode))
+                time.sleep(travail)
+    resultats.put((valeurs, time.perf_counter() - debut))
+    moteur.dispose()
+
+@click.command('mesurer-numerotation')
+@click.option('--processus', default=4, show_default=True, help='Processus concurrents.')
+@click.option('--numeros', 'nombre', default=200, show_default=True, help='Numéros tirés par processus.')
+@click.option('--bloc', default=TAILLE_BLOC, show_default=True, help='Taille des blocs réservés.')
+@click.option('--travail', default=2.0, show_default=True,
+              help='Durée (ms) du reste de la transaction de vente simulée.')
+@click.option('--base', help='Base de l\'essai (par défaut une base SQLite temporaire).')
+def mesurer_numerotation_commande(processus, nombre, bloc, travail, base):
+    """Mesure le débit de la numérotation, continue et par blocs, entre processus"""
+    dossier = None
+    if base is None:
+        dossier = tempfile.mkdtemp()
+        base = 'sqlite:///' + os.path.join(dossier, 'banc.db')
+    moteur = create_engine(base)
+    table = CompteurNumero.__table__
+    table.create(moteur, checkfirst=True)
+    contexte = multiprocessing.get_context('spawn')
+
+    try:
+        for mode in ('continu', 'bloc'):
+            barriere = contexte.Barrier(processus)
+            resultats = contexte.Queue()
+            travailleurs = [
+                contexte.Process(target=_banc_processus,
+                                 args=(base, mode, nombre, bloc, travail / 1000, barriere, resultats))
+                for _ in range(processus)
+            ]
+            for travailleur in travailleurs:
+                travailleur.start()
+            mesures = [resultats.get() for _ in travailleurs]
+            for travailleur in travailleurs:
+                travailleur.join()
+
+            valeurs = [valeur for valeurs_processus, _ in mesures for valeur in valeurs_processus]
+            duree = max(duree for _, duree in mesures)
+            with moteur.connect() as connexion:
+                compteur = connexion.execute(
+                    db.select(table.c.valeur).where(table.c.serie == SERIE_BANC, table.c.periode == mode)
+                ).scalar()
+            doublons = len(valeurs) - len(set(valeurs))
+            click.echo(f'{mode}: {len(valeurs)} numéros en {duree:.2f} s '
+                       f'({len(valeurs) / duree:.0f}/s), {doublons} doublon(s), '
+                       f'{compteur - len(valeurs)} numéro(s) réservé(s) non utilisé(s)')
+    finally:
+        with moteur.begin() as connexion:
+            connexion.execute(table.delete().where(table.c.serie == SERIE_BANC))
+        moteur.dispose()
+        if dossier:
+            shutil.rmtree(dossier)
@@ -0,0 +1,171 @@
+import glob
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from flask import current_app
+from . import db
+from . import utils
+from .models import Facture
+
+# Magasin des PDF de factures.
+# Chaque PDF est enregistré sur disque sous <id>-<empreinte>.pdf, où
+# l'empreinte est le hachage des données affichées dans le document : un
+# changement (statut, client...) donne un nouveau fichier, et l'empreinte
+# sert d'ETag pour répondre 304 aux réimpressions.
+# Les factures créées par le formulaire de vente sont rendues à l'avance
+# dans un pool de processus, hors du cycle de la requête.
+# Pré-rendu et suppression des PDF suivent le commit de la vente ou du
+# statut : une erreur du magasin (dossier inaccessible...) est journalisée
+# sans être propagée. Un PDF périmé laissé sur disque n'est jamais servi,
+# son empreinte ne correspondant plus aux données.
+
+PROCESSUS_PDF = 2
+
+_pool = None
+_verrou_pool = threading.Lock()
+
+def donnees_facture(facture_id):
+    """Données affichées sur le PDF d'une facture (None si elle n'existe pas)"""
+    # Une seule ligne : l'instantané de la vente enregistré avec la facture
+    facture = db.session.get(Facture, facture_id)
+    if facture is None:
+        return None
+
+    return {
+        'id': facture.id,
+        'numero_facture': facture.numero_facture,
+        'date_facture': facture.date_facture.strftime('%d/%m/%Y'),
+        'date_echeance': facture.date_echeance.strftime('%d/%m/%Y') if facture.date_echeance else None,
+        'statut': facture.statut,
+        'notes': facture.notes,
+        'client': {
+            'nom': facture.client_nom,
+            'email': facture.client_email,
+            'telephone': facture.client_telephone,
+            'adresse': facture.client_adresse,
+        },
+        'lignes': [
+            {
+                'produit': ligne['produit'],
+                'quantite': ligne['quantite'],
+                'prix_unitaire': ligne['prix_unitaire'],
+                'sous_total': ligne['sous_total'],
+            }
+            for ligne in facture.liste_lignes()
+        ],
+        'total_ht': facture.total_ht,
+        'taux_tva': facture.taux_tva,
+        'total_ttc': facture.total_ttc,
+    }
+
+def empreinte(donnees):
+    """Hachage du contenu d'une facture, utilisé comme nom de fichier et ETag"""
+    brut = json.dumps(donnees, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(brut.encode()).hexdigest()[:32]
+
+def _dossier():
+    dossier = current_app.config.get('PDF_FACTURES_DIR') or \
+        os.path.join(current_app.instance_path, 'factures_pdf')
+    os.makedirs(dossier, exist_ok=True)
+    return dossier
+
+def chemin_pdf(facture_id, hachage):
+    return os.path.join(_dossier(), f'{facture_id}-{hachage}.pdf')
+
+def obtenir_pdf(donnees, hachage):
+    """Chemin du PDF de la facture, rendu maintenant s'il n'est pas en magasin"""
+    chemin = chemin_pdf(donnees['id'], hachage)
+    if not os.path.exists(chemin):
+        invalider_pdf(donnees['id'])
+        utils.ecrire_facture_pdf(donnees, chemin)
+    return chemin
+
+def invalider_pdf(facture_id):
+    """Supprime les PDF en magasin d'une facture"""
+    try:
+        for chemin in glob.glob(os.path.join(_dossier(), f'{facture_id}-*.pdf')):
+            try:
+                os.remove(chemin)
+            except FileNotFoundError:
+                pass
+    except OSError as e:
+        logging.getLogger(__name__).warning('Suppression du PDF impossible: %s', e)
+
+def invalider_pdfs(factures_ids):
+    """Supprime les PDF en magasin de plusieurs factures (un seul parcours du dossier)"""
+    prefixes = {str(facture_id) for facture_id in factures_ids}
+    try:
+        with os.scandir(_dossier()) as fichiers:
+            for fichier in fichiers:
+                if fichier.name.endswith('.pdf') and fichier.name.split('-', 1)[0] in prefixes:
+                    try:
+                        os.remove(fichier.path)
+                    except FileNotFoundError:
+                        pass
+    except OSError as e:
+        logging.getLogger(__name__).warning('Suppression des PDF impossible: %s', e)
+
+def _pool_pdf():
+    global _pool
+    with _verrou_pool:
+        if _pool is None:
+            # spawn : les processus de rendu n'héritent ni des connexions
+            # à la base ni des threads du worker
+            _pool = ProcessPoolExecutor(
+                max_workers=current_app.config.get('PDF_PROCESSUS', PROCESSUS_PDF),
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return _pool
+
+def _abandonner_pool():
+    global _pool
+    with _verrou_pool:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+def _journaliser_echec(futur):
+    erreur = futur.exception()
+    if erreur is not None:
+        logging.getLogger(__name__).warning('Pré-rendu du PDF impossible: %s', erreur)
+        if isinstance(erreur, BrokenProcessPool):
+            _abandonner_pool()
+
+def prerendre_facture(facture_id):
+    """Lance en arrière-plan le rendu du PDF d'une facture
+
+    Sans effet si PDF_PROCESSUS vaut 0 ; le PDF sera alors rendu à la
+    première demande. Ne lève jamais d'exception : un échec laisse le
+    rendu à la première demande.
+    """
+    if not current_app.config.get('PDF_PROCESSUS', PROCESSUS_PDF):
+        return
+    try:
+        _prerendre(facture_id)
+    except Exception as e:
+        logging.getLogger(__name__).warning('Pré-rendu du PDF impossible: %s', e)
+
+def _prerendre(facture_id):
+    donnees = donnees_facture(facture_id)
+    if donnees is None:
+        return
+    hachage = empreinte(donnees)
+    chemin = chemin_pdf(facture_id, hachage)
+    if os.path.exists(chemin):
+        return
+    invalider_pdf(facture_id)
+    try:
+        futur = _pool_pdf().submit(utils.ecrire_facture_pdf, donnees, chemin)
+    except Exception as e:
+        # Pool arrêté ou cassé (processus tué), ou processus impossible à
+        # créer (worker démon) : le PDF sera rendu à la demande, et un
+        # nouveau pool sera essayé à la prochaine facture
+        logging.getLogger(__name__).warning('Pré-rendu du PDF impossible: %s', e)
+        _abandonner_pool()
+        return
+    futur.add_done_callback(_journaliser_echec)
@@ -0,0 +1,184 @@
+import click
+import json
+import os
+import statistics
+import time
+from datetime import datetime
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import event, select, func
+from sqlalchemy.engine import Engine
+from . import db
+from .models import Produit, Client, Vente, LigneVente, Facture
+from .pdf_factures import invalider_pdfs
+
+# Mesures de performance des pages les plus sollicitées.
+# `flask mesurer-performances` appelle chaque point de mesure avec le client
+# de test Flask (sans réseau) sur la base configurée par DATABASE_URL
+# (SQLite ou PostgreSQL, remplie par `flask generer-donnees`), et relève la
+# durée médiane, le 95e centile et le nombre de requêtes SQL par appel.
+# Les résultats sont comparés à une référence JSON : la commande échoue si
+# une page fait plus de requêtes SQL que dans la référence, ou si sa durée
+# médiane la dépasse de plus de la tolérance. Les durées dépendent de la
+# machine et de la base : une référence par machine et par dialecte.
+# Le point nouvelle_vente_envoi crée des ventes : base de test uniquement.
+
+REPETITIONS = 20
+TOLERANCE = 0.25  # hausse admise de la durée médiane
+ECART_MINIMAL_MS = 1.0  # en deçà, une hausse de durée est du bruit de mesure
+ECART_VOLUMES = 0.01  # la base grossit des ventes créées par la mesure
+
+POINTS = [
+    # nom, méthode, URL (complétée par les paramètres tirés de la base)
+    ('index', 'GET', '/'),
+    ('rapports', 'GET', '/rapports'),
+    ('produits', 'GET', '/produits/'),
+    ('produits_recherche', 'GET', '/produits/?search={terme}'),
+    ('clients', 'GET', '/clients/'),
+    ('ventes', 'GET', '/ventes/'),
+    ('ventes_client', 'GET', '/ventes/?client_id={client_id}'),
+    ('factures', 'GET', '/factures'),
+    ('factures_en_retard', 'GET', '/factures?statut=en_retard'),
+    ('nouvelle_vente', 'GET', '/ventes/nouvelle'),
+    ('nouvelle_vente_envoi', 'POST', '/ventes/nouvelle'),
+    ('facture_pdf', 'GET', '/factures/{facture_id}/pdf'),
+]
+
+def volumes():
+    """Nombre de lignes des tables principales"""
+    return {
+        modele.__tablename__: db.session.execute(select(func.count()).select_from(modele)).scalar()
+        for modele in (Produit, Client, Vente, LigneVente, Facture)
+    }
+
+def _parametres(repetitions):
+    """Identifiants utilisés par les points de mesure, tirés de la base de façon déterministe"""
+    derniere_vente = db.session.execute(
+        select(Vente.client_id).order_by(Vente.id.desc()).limit(1)).scalar()
+    produit = db.session.execute(
+        select(Produit.id, Produit.nom).where(Produit.actif == True)
+        .order_by(Produit.stock_actuel.desc(), Produit.id).limit(1)).first()
+    factures = db.session.execute(
+        select(Facture.id).order_by(Facture.id.desc()).limit(repetitions)).scalars().all()
+    if derniere_vente is None or produit is None:
+        raise click.ClickException('Base sans ventes : remplissez-la avec `flask generer-donnees`.')
+    return {
+        'client_id': derniere_vente,
+        'produit_id': produit.id,
+        'terme': produit.nom.split()[0][:4].lower(),
+        'factures': factures,
+    }
+
+def mesurer(repetitions=REPETITIONS):
+    """Durées et requêtes SQL de chaque point de mesure"""
+    volumes_initiaux = volumes()
+    parametres = _parametres(repetitions)
+    # Les PDF sont rendus à chaque appel : le magasin est vidé pour les factures mesurées
+    invalider_pdfs(parametres['factures'])
+    client = current_app.test_client()
+    compteur = [0]
+
+    def compter(*args):
+        compteur[0] += 1
+
+    event.listen(Engine, 'after_cursor_execute', compter)
+    try:
+        points = {}
+        for nom, methode, url in POINTS:
+            durees, requetes, statuts = [], [], set()
+            # Deux appels de mise en route, sauf pour les PDF (tous différents)
+            for rang in range(-2 if nom != 'facture_pdf' else 0, repetitions):
+                appel = url.format(facture_id=parametres['factures'][rang % len(parametres['factures'])],
+                                   **parametres)
+                donnees = None
+                if methode == 'POST':
+                    donnees = {'client_id': parametres['client_id'], 'produit_id': parametres['produit_id'],
+                               'quantite': '1', 'taux_tva': '20'}
+                compteur[0] = 0
+                debut = time.perf_counter()
+                reponse = client.open(appel, method=methode, data=donnees)
+                reponse.get_data()
+                duree = time.perf_counter() - debut
+                if rang >= 0:
+                    durees.append(duree * 1000)
+                    requetes.append(compteur[0])
+                    statuts.add(reponse.status_code)
+            durees.sort()
+            points[nom] = {
+                'mediane_ms': round(statistics.median(durees), 3),
+                'p95_ms': round(durees[min(len(durees) - 1, int(len(durees) * 0.95))], 3),
+                'requetes_sql': max(requetes),
+                'statuts': sorted(statuts),
+            }
+    finally:
+        event.remove(Engine, 'after_cursor_execute', compter)
+
+    return {
+        'dialecte': db.session.get_bind().dialect.name,
+        'date': datetime.utcnow().isoformat(timespec='seconds'),
+        'repetitions': repetitions,
+        'volumes': volumes_initiaux,
+        'points': points,
+    }
+
+def comparables(resultats, reference):
+    """Vrai si les résultats portent sur la même base que la référence (dialecte, volumes à 1 % près)"""
+    if resultats['dialecte'] != reference['dialecte'] or resultats['volumes'].keys() != reference['volumes'].keys():
+        return False
+    return all(abs(nombre - reference['volumes'][table]) <= ECART_VOLUMES * reference['volumes'][table]
+               for table, nombre in resultats['volumes'].items())
+
+def comparer(resultats, reference, tolerance=TOLERANCE):
+    """Régressions des résultats par rapport à la référence (liste de messages)"""
+    regressions = []
+    for nom, mesure in resultats['points'].items():
+        if any(statut >= 500 for statut in mesure['statuts']):
+            regressions.append(f'{nom}: erreur serveur ({mesure["statuts"]})')
+        attendu = reference['points'].get(nom)
+        if attendu is None:
+            continue
+        if mesure['requetes_sql'] > attendu['requetes_sql']:
+            regressions.append(f'{nom}: {mesure["requetes_sql"]} requêtes SQL '
+                               f'(référence {attendu["requetes_sql"]})')
+        if mesure['mediane_ms'] > attendu['mediane_ms'] * (1 + tolerance) and \
+                mesure['mediane_ms'] - attendu['mediane_ms'] > ECART_MINIMAL_MS:
+            regressions.append(f'{nom}: médiane {mesure["mediane_ms"]:.1f} ms '
+                               f'(référence {attendu["mediane_ms"]:.1f} ms)')
+    return regressions
+
+@click.command('mesurer-performances')
+@click.option('--repetitions', default=REPETITIONS, show_default=True, help='Appels mesurés par point.')
+@click.option('--reference', type=click.Path(dir_okay=False),
+              help='Référence JSON : comparée si elle existe, créée sinon.')
+@click.option('--enregistrer', is_flag=True, help='Remplace la référence par les résultats.')
+@click.option('--tolerance', default=TOLERANCE, show_default=True,
+              help='Hausse admise de la durée médiane (0.25 = +25 %).')
+@with_appcontext
+def mesurer_performances_commande(repetitions, reference, enregistrer, tolerance):
+    """Mesure les pages principales et les compare à une référence"""
+    resultats = mesurer(repetitions)
+    attendu = None
+    if reference and os.path.exists(reference) and not enregistrer:
+        with open(reference, encoding='utf-8') as fichier:
+            attendu = json.load(fichier)
+        if not comparables(resultats, attendu):
+            raise click.ClickException('Base différente de celle de la référence (dialecte ou volumes) : '
+                                       'les mesures ne sont pas comparables.')
+
+    click.echo(f"{resultats['dialecte']}, " + ', '.join(f'{n} {t}' for t, n in resultats['volumes'].items()))
+    for nom, mesure in resultats['points'].items():
+        ligne = (f"{nom:<22} {mesure['mediane_ms']:>9.1f} ms  p95 {mesure['p95_ms']:>9.1f} ms  "
+                 f"{mesure['requetes_sql']:>3} SQL")
+        if attendu and nom in attendu['points']:
+            ligne += (f"   (référence {attendu['points'][nom]['mediane_ms']:.1f} ms, "
+                      f"{attendu['points'][nom]['requetes_sql']} SQL)")
+        click.echo(ligne)
+
+    if reference and attendu is None:
+        with open(reference, 'w', encoding='utf-8') as fichier:
+            json.dump(resultats, fichier, indent=2, ensure_ascii=False)
+        click.echo(f'Référence enregistrée dans {reference}.')
+
+    regressions = comparer(resultats, attendu or {'points': {}}, tolerance)
+    if regressions:
+        raise click.ClickException('Régressions :\n' + '\n'.join(regressions))
@@ -1,29 +1,65 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify
+import time
+from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify, abort, make_response
+from datetime import datetime, timedelta
 from sqlalchemy import and_
 from .. import db
 from ..models import Produit
+from ..statistiques import invalider_produits, invalider_stock
+from ..requetes import requete_produits, paginer, TRIS_PRODUITS
+from ..requetes import requete_export_produits, ENTETES_PRODUITS
+from ..exports import reponse_csv
+from ..mouvements import enregistrer_mouvements, ajuster_stock, requete_stocks_au, ENTETES_INVENTAIRE
+from ..reapprovisionnement import surveiller_stocks, suggestions
+from ..importation import ErreurImport
+from ..importation_produits import importer_produits, lire_catalogue, lire_champs, rapport_import_produits
+from ..importation_produits import MIMETYPE_XLSX
+from ..catalogue import catalogue, etat_catalogue, details_produits, lire_ids
+from ..replicas import lecture_seule
 
 produits_bp = Blueprint('produits', __name__, url_prefix='/produits')
 
 @produits_bp.route('/')
+@lecture_seule
 def produits():
     """Liste des produits"""
     search = request.args.get('search', '')
     categorie = request.args.get('categorie', '')
     
-    query = Produit.query.filter_by(actif=True)
-    
-    if search:
-        query = query.filter(Produit.nom.contains(search))
-    
-    if categorie:
-        query = query.filter_by(categorie=categorie)
+    try:
+        page = paginer(requete_produits(search=search, categorie=categorie), TRIS_PRODUITS,
+                       request.args.get('tri'), request.args.get('ordre', 'asc'),
+                       apres=request.args.get('apres'), taille=request.args.get('taille'))
+    except ValueError:
+        abort(400)
     
-    produits = query.order_by(Produit.nom).all()
     categories = db.session.query(Produit.categorie).distinct().filter(Produit.categorie.isnot(None)).all()
     categories = [cat[0] for cat in categories]
     
-    return render_template('produits.html', produits=produits, categories=categories)
+    return render_template('produits.html', produits=page, page=page, categories=categories)
+
+@produits_bp.route('/export')
+@lecture_seule
+def exporter_produits():
+    """Exporter la liste des produits (CSV ou Excel)"""
+    stmt = requete_export_produits(search=request.args.get('search', ''),
+                                   categorie=request.args.get('categorie', ''))
+    try:
+        return reponse_csv('produits', ENTETES_PRODUITS, stmt, request.args.get('format', 'csv'))
+    except ValueError:
+        abort(400)
+
+@produits_bp.route('/inventaire')
+@lecture_seule
+def exporter_inventaire():
+    """Exporter le stock de chaque produit à la fin d'une journée (?date=AAAA-MM-JJ)"""
+    date = request.args.get('date')
+    try:
+        fin = datetime.strptime(date, '%Y-%m-%d') + timedelta(days=1, microseconds=-1) \
+            if date else datetime.utcnow()
+        return reponse_csv('inventaire', ENTETES_INVENTAIRE, requete_stocks_au(fin),
+                           request.args.get('format', 'csv'))
+    except ValueError:
+        abort(400)
 
 @produits_bp.route('/ajouter', methods=['GET', 'POST'])
 def ajouter_produit():
@@ -41,7 +77,12 @@ def ajouter_produit():
             )
             
             db.session.add(produit)
+            db.session.flush()
+            enregistrer_mouvements('reapprovisionnement', [(produit.id, produit.stock_actuel, None)],
+                                   'Stock initial')
+            surveiller_stocks([produit.id], sorties=False)
             db.session.commit()
+            invalider_produits()
             flash('Produit ajouté avec succès!', 'success')
             return redirect(url_for('produits.produits'))
             
@@ -61,12 +102,16 @@ def modifier_produit(id):
             produit.nom = request.form['nom']
             produit.description = request.form.get('description', '')
             produit.prix_unitaire = float(request.form['prix_unitaire'])
-            produit.stock_actuel = int(request.form.get('stock_actuel', 0))
             produit.stock_minimum = int(request.form.get('stock_minimum', 5))
             produit.categorie = request.form.get('categorie', '')
             produit.code_produit = request.form.get('code_produit', '')
+            # Le stock saisi est enregistré comme un ajustement dans le registre
+            ajuster_stock(produit.id, int(request.form.get('stock_actuel', 0)), 'Modification du produit')
+            # Stock ou seuil modifié : le produit entre en alerte ou en sort
+            surveiller_stocks([produit.id])
             
             db.session.commit()
+            invalider_stock()
             flash('Produit modifié avec succès!', 'success')
             return redirect(url_for('produits.produits'))
             
@@ -82,7 +127,9 @@ def supprimer_produit(id):
     try:
         produit = Produit.query.get_or_404(id)
         produit.actif = False
+        surveiller_stocks([produit.id], entrees=False)
         db.session.commit()
+        invalider_produits()
         flash('Produit supprimé avec succès!', 'success')
     except Exception as e:
         db.session.rollback()
@@ -91,13 +138,69 @@ def supprimer_produit(id):
     return redirect(url_for('produits.produits'))
 
 # API endpoints pour AJAX
+@produits_bp.route('/api/catalogue')
+def api_catalogue():
+    """API du catalogue du formulaire de vente (complet, ou modifié depuis ?depuis=<jeton>)"""
+    depuis = request.args.get('depuis', 0, type=int)
+    
+    # L'état du catalogue sert d'ETag : rien n'est relu s'il n'a pas changé
+    _, etat = etat_catalogue()
+    if etat in request.if_none_match:
+        response = make_response('', 304)
+        response.set_etag(etat)
+        return response
+    
+    response = jsonify(catalogue(depuis))
+    response.set_etag(etat)
+    response.cache_control.no_cache = True
+    return response
+
+@produits_bp.route('/api/stocks')
+def api_stocks():
+    """API des prix et stocks actuels de plusieurs produits (?ids=1,2,3)"""
+    try:
+        ids = lire_ids(request.args.get('ids', ''))
+    except ValueError:
+        abort(400)
+    
+    return jsonify(details_produits(ids))
+
+@produits_bp.route('/api/reapprovisionnement')
+@lecture_seule
+def api_reapprovisionnement():
+    """API des produits en alerte de stock et des quantités à commander, les plus urgents d'abord"""
+    return jsonify(suggestions())
+
+@produits_bp.route('/api/import', methods=['POST'])
+def api_import_produits():
+    """API d'import du catalogue par code_produit (CSV, ou XLSX selon le Content-Type)
+
+    ?champs=prix_unitaire,stock_actuel limite les champs mis à jour ;
+    ?simulation=1 renvoie les différences sans rien écrire.
+    """
+    try:
+        champs = lire_champs(request.args.get('champs'))
+    except ValueError:
+        abort(400)
+    simulation = request.args.get('simulation', '0') not in ('0', '', 'false', 'non')
+    format_ = 'xlsx' if request.mimetype == MIMETYPE_XLSX else 'csv'
+    
+    debut = time.perf_counter()
+    try:
+        resultats = list(importer_produits(lire_catalogue(request.stream, format_), champs, simulation))
+    except ErreurImport as e:
+        abort(400, description=str(e))
+    rapport = rapport_import_produits(resultats, time.perf_counter() - debut, simulation)
+    
+    if not simulation and (rapport['crees'] or rapport['modifies']):
+        invalider_produits()
+    
+    return jsonify(rapport)
+
 @produits_bp.route('/api/<int:id>')
 def api_produit_detail(id):
     """API pour obtenir les détails d'un produit"""
-    produit = Produit.query.get_or_404(id)
-    return jsonify({
-        'id': produit.id,
-        'nom': produit.nom,
-        'prix_unitaire': produit.prix_unitaire,
-        'stock_actuel': produit.stock_actuel
-    })
\ No newline at end of file
+    produits = details_produits([id])
+    if not produits:
+        abort(404)
+    return jsonify(produits[0])
\ No newline at end of file
@@ -0,0 +1,316 @@
+import click
+import json
+import logging
+import urllib.request
+from datetime import date, datetime, timedelta
+import numpy as np
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import select, insert, update, delete, func, and_, exists, literal, bindparam
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.sql import Select
+from . import db
+from .models import Produit, Vente, LigneVente, AlerteStock, Notification
+from .statistiques import invalider_stock
+
+# Alertes de stock faible et suggestions de réapprovisionnement.
+# Chaque variation du stock (vente, import, annulation, modification d'un
+# produit) appelle surveiller_stocks() dans sa propre transaction, pour les
+# seuls produits touchés : les produits passés au stock minimum ou en
+# dessous entrent dans alertes_stock et une notification est mise en file
+# dans la table notifications ; ceux revenus au-dessus en sortent.
+# L'INSERT ... ON CONFLICT DO NOTHING ne retourne que les produits entrés :
+# une seule notification par passage sous le minimum, même entre ventes
+# simultanées, et aucune notification si la vente échoue.
+# La tâche de fond reapprovisionnement fait le reste hors des requêtes :
+# - vitesse de vente des produits en alerte : moyenne mobile pondérée
+#   (demi-vie DEMI_VIE_JOURS) des quantités vendues par jour complet sur
+#   FENETRE_JOURS, calculée par NumPy sur la matrice produits × jours ;
+# - jours avant rupture (stock / vitesse) et quantité à commander pour
+#   couvrir le délai de livraison et COUVERTURE_JOURS de ventes au-dessus
+#   du stock minimum ;
+# - envoi des notifications en attente : POST JSON vers
+#   ALERTES_WEBHOOK_URL, ou journal de l'application sans URL, hors de
+#   toute transaction. Un envoi en échec est repris à la passe suivante,
+#   au plus TENTATIVES_MAX fois.
+
+FENETRE_JOURS = 56  # historique des ventes lu pour la vitesse
+DEMI_VIE_JOURS = 7  # le poids d'un jour de ventes est divisé par deux tous les 7 jours
+DELAI_LIVRAISON_JOURS = 7
+COUVERTURE_JOURS = 30  # jours de ventes couverts par une commande
+TENTATIVES_MAX = 5
+TAILLE_LOT = 100  # notifications envoyées par passe
+DELAI_ENVOI = 10  # secondes
+DELAI_RESERVATION = timedelta(minutes=30)  # au-delà d'un lot envoyé à DELAI_ENVOI par notification
+
+TYPE_STOCK_FAIBLE = 'stock_faible'
+
+_UPSERT = {'postgresql': postgresql.insert, 'sqlite': sqlite.insert}
+
+def condition_stock_faible():
+    """Produit actif au stock minimum ou en dessous (servi par l'index partiel ix_produits_stock_faible)"""
+    return and_(Produit.actif == True, Produit.stock_actuel <= Produit.stock_minimum)
+
+def _contenu(produit):
+    return json.dumps({
+        'produit_id': produit.id,
+        'code_produit': produit.code_produit,
+        'nom': produit.nom,
+        'stock_actuel': produit.stock_actuel,
+        'stock_minimum': produit.stock_minimum,
+    }, ensure_ascii=False)
+
+def surveiller_stocks(produits_ids, entrees=True, sorties=True):
+    """Met à jour les alertes des produits dont le stock vient de changer ; retourne les produits entrés en alerte
+
+    À appeler dans la transaction de la variation, après l'écriture du
+    stock. `produits_ids` : identifiants, ou SELECT d'identifiants.
+    entrees=False (stock en hausse) ou sorties=False (stock en baisse)
+    évite la requête qui ne peut rien changer.
+    """
+    if not isinstance(produits_ids, Select):
+        produits_ids = list(produits_ids)
+        if not produits_ids:
+            return []
+    entres = []
+    maintenant = datetime.utcnow()
+
+    if entrees:
+        table = AlerteStock.__table__
+        stmt = _UPSERT[db.session.get_bind().dialect.name](table).from_select(
+            ['produit_id', 'depuis'],
+            select(Produit.id, literal(maintenant, db.DateTime))
+            .where(Produit.id.in_(produits_ids), condition_stock_faible())
+        )
+        entres = db.session.execute(
+            stmt.on_conflict_do_nothing(index_elements=[table.c.produit_id]).returning(table.c.produit_id)
+        ).scalars().all()
+
+    if entres:
+        produits = db.session.execute(
+            select(Produit.id, Produit.code_produit, Produit.nom, Produit.stock_actuel, Produit.stock_minimum)
+            .where(Produit.id.in_(entres))
+        ).all()
+        db.session.execute(insert(Notification), [
+            dict(type=TYPE_STOCK_FAIBLE, produit_id=produit.id, contenu=_contenu(produit), date_creation=maintenant)
+            for produit in produits
+        ])
+
+    if sorties:
+        db.session.execute(
+            delete(AlerteStock).where(
+                AlerteStock.produit_id.in_(produits_ids),
+                ~exists().where(Produit.id == AlerteStock.produit_id, condition_stock_faible())
+            ).execution_options(synchronize_session=False)
+        )
+    return entres
+
+def remplir_alertes(connexion):
+    """Recalcule entièrement les alertes depuis les stocks, sans notification (sans commit)"""
+    connexion.execute(AlerteStock.__table__.delete())
+    connexion.execute(AlerteStock.__table__.insert().from_select(
+        ['produit_id', 'depuis'],
+        select(Produit.id, literal(datetime.utcnow(), db.DateTime)).where(condition_stock_faible())
+    ))
+
+def synchroniser_alertes():
+    """Recalcule l'ensemble des alertes depuis les stocks (après une écriture hors de l'application)
+
+    Les produits entrés en alerte sont notifiés ; retourne leur nombre.
+    """
+    entres = surveiller_stocks(select(Produit.id).where(condition_stock_faible()), sorties=False)
+    surveiller_stocks(select(AlerteStock.produit_id), entrees=False)
+    db.session.commit()
+    invalider_stock()
+    return len(entres)
+
+def vitesses_de_vente(produits_ids, creations, aujourd_hui=None):
+    """Unités vendues par jour de chaque produit : moyenne mobile pondérée des ventes confirmées
+
+    Un jour de ventes pèse deux fois moins que le suivant tous les
+    DEMI_VIE_JOURS ; seuls les jours complets depuis la création du produit
+    (`creations`, dates) comptent.
+    """
+    aujourd_hui = aujourd_hui or date.today()
+    debut = aujourd_hui - timedelta(days=FENETRE_JOURS)
+    periode = [datetime.combine(jour, datetime.min.time()) for jour in (debut, aujourd_hui)]
+    rang = {produit_id: i for i, produit_id in enumerate(produits_ids)}
+    jour = func.date(Vente.date_vente)
+    ventes = db.session.execute(
+        select(LigneVente.produit_id, jour, func.sum(LigneVente.quantite))
+        .join(Vente, Vente.id == LigneVente.vente_id)
+        .where(LigneVente.produit_id.in_(produits_ids), Vente.statut == 'confirmée',
+               Vente.date_vente >= periode[0], Vente.date_vente < periode[1])
+        .group_by(LigneVente.produit_id, jour)
+    ).all()
+
+    # Quantités vendues : une ligne par produit, une colonne par jour (la dernière est hier)
+    quantites = np.zeros((len(produits_ids), FENETRE_JOURS))
+    if ventes:
+        lignes = np.fromiter((rang[produit_id] for produit_id, _, _ in ventes), np.int64, len(ventes))
+        # SQLite retourne la date en texte, PostgreSQL en date
+        colonnes = np.fromiter(
+            (((date.fromisoformat(j) if isinstance(j, str) else j) - debut).days for _, j, _ in ventes),
+            np.int64, len(ventes))
+        np.add.at(quantites, (lignes, colonnes), np.fromiter((q for _, _, q in ventes), np.float64, len(ventes)))
+
+    anciennete = np.arange(FENETRE_JOURS - 1, -1, -1)
+    poids = np.broadcast_to(0.5 ** (anciennete / DEMI_VIE_JOURS), quantites.shape)
+    premier_jour = np.fromiter(((c - debut).days if c else 0 for c in creations), np.int64, len(creations))
+    poids = np.where(np.arange(FENETRE_JOURS) >= premier_jour[:, None], poids, 0.0)
+    total_poids = poids.sum(axis=1)
+    return np.divide((quantites * poids).sum(axis=1), total_poids,
+                     out=np.zeros(len(produits_ids)), where=total_poids > 0)
+
+def calculer_suggestions(maintenant=None):
+    """Vitesse de vente, jours avant rupture et quantité à commander des produits en alerte ; retourne leur nombre"""
+    maintenant = maintenant or datetime.utcnow()
+    alertes = db.session.execute(
+        select(AlerteStock.produit_id, Produit.stock_actuel, Produit.stock_minimum, Produit.date_creation)
+        .join(Produit, Produit.id == AlerteStock.produit_id)
+        .order_by(AlerteStock.produit_id)
+    ).all()
+    if not alertes:
+        return 0
+
+    ids = [alerte.produit_id for alerte in alertes]
+    vitesses = vitesses_de_vente(ids, [a.date_creation and a.date_creation.date() for a in alertes],
+                                 maintenant.date())
+    stocks = np.array([max(alerte.stock_actuel or 0, 0) for alerte in alertes], np.float64)
+    minimums = np.array([alerte.stock_minimum or 0 for alerte in alertes], np.float64)
+    jours = np.divide(stocks, vitesses, out=np.full(len(ids), np.nan), where=vitesses > 0)
+    # De quoi tenir jusqu'à la livraison puis COUVERTURE_JOURS au-dessus du
+    # minimum, et au moins de quoi sortir de l'alerte
+    a_commander = np.maximum(np.ceil(vitesses * (DELAI_LIVRAISON_JOURS + COUVERTURE_JOURS)) + minimums - stocks,
+                             minimums - stocks + 1)
+
+    table = AlerteStock.__table__
+    db.session.execute(
+        update(table).where(table.c.produit_id == bindparam('p_id')),
+        [
+            dict(p_id=produit_id, vitesse=round(float(vitesse), 3),
+                 jours_avant_rupture=None if np.isnan(j) else round(float(j), 1),
+                 quantite_suggeree=int(suggestion), date_calcul=maintenant)
+            for produit_id, vitesse, j, suggestion in zip(ids, vitesses, jours, a_commander)
+        ]
+    )
+    db.session.commit()
+    invalider_stock()
+    return len(ids)
+
+def _message(contenu):
+    message = (f"Stock faible : {contenu['nom']} ({contenu['stock_actuel']} en stock, "
+               f"minimum {contenu['stock_minimum']})")
+    if contenu.get('quantite_suggeree'):
+        message += f", commander {contenu['quantite_suggeree']}"
+    if contenu.get('jours_avant_rupture') is not None:
+        message += f", rupture dans {contenu['jours_avant_rupture']:.0f} j"
+    return message
+
+def _envoyer(url, type_, contenu):
+    """Envoie une notification (webhook JSON, ou journal sans URL)"""
+    if not url:
+        logging.getLogger(__name__).warning(_message(contenu))
+        return
+    requete = urllib.request.Request(
+        url, data=json.dumps({'type': type_, 'message': _message(contenu), **contenu}).encode('utf-8'),
+        headers={'Content-Type': 'application/json'}, method='POST')
+    urllib.request.urlopen(requete, timeout=DELAI_ENVOI).close()
+
+def _reserver_notifications(limite):
+    """Réserve un lot de notifications en attente ; retourne [(id, type, contenu)]
+
+    Transaction courte : les lignes sont verrouillées (SKIP LOCKED sous
+    PostgreSQL) le temps de compter la tentative et de poser la
+    réservation, puis le commit les libère avant tout envoi.
+    """
+    maintenant = datetime.utcnow()
+    notifications = db.session.execute(
+        select(Notification)
+        .where(Notification.date_envoi == None, Notification.tentatives < TENTATIVES_MAX,
+               (Notification.reservee_jusqua == None) | (Notification.reservee_jusqua < maintenant))
+        .order_by(Notification.id).limit(limite)
+        .with_for_update(skip_locked=True)
+    ).scalars().all()
+    if not notifications:
+        db.session.commit()
+        return []
+
+    # Suggestions les plus récentes des produits encore en alerte
+    alertes = {
+        alerte.produit_id: alerte for alerte in db.session.execute(
+            select(AlerteStock.produit_id, AlerteStock.vitesse, AlerteStock.jours_avant_rupture,
+                   AlerteStock.quantite_suggeree)
+            .where(AlerteStock.produit_id.in_([n.produit_id for n in notifications if n.produit_id]))
+        )
+    }
+    lot = []
+    for notification in notifications:
+        contenu = json.loads(notification.contenu)
+        alerte = alertes.get(notification.produit_id)
+        if alerte is not None:
+            contenu.update(vitesse=alerte.vitesse, jours_avant_rupture=alerte.jours_avant_rupture,
+                           quantite_suggeree=alerte.quantite_suggeree)
+        notification.tentatives += 1
+        notification.reservee_jusqua = maintenant + DELAI_RESERVATION
+        lot.append((notification.id, notification.type, contenu))
+    db.session.commit()
+    return lot
+
+def envoyer_notifications(limite=TAILLE_LOT):
+    """Envoie les notifications en attente ; retourne le nombre envoyé
+
+    Trois temps : réservation du lot (transaction courte), envois hors de
+    toute transaction, puis enregistrement des résultats (transaction
+    courte). Aucun verrou n'est tenu pendant les appels au webhook ; une
+    notification réservée par un worker arrêté en cours d'envoi est
+    reprise à l'expiration de sa réservation.
+    """
+    lot = _reserver_notifications(limite)
+    if not lot:
+        return 0
+
+    url = current_app.config.get('ALERTES_WEBHOOK_URL')
+    resultats = []
+    for notification_id, type_, contenu in lot:
+        try:
+            _envoyer(url, type_, contenu)
+        except (OSError, ValueError) as e:
+            resultats.append({'id': notification_id, 'erreur': str(e), 'date_envoi': None,
+                              'reservee_jusqua': None})
+        else:
+            resultats.append({'id': notification_id, 'erreur': None, 'date_envoi': datetime.utcnow(),
+                              'reservee_jusqua': None})
+
+    db.session.execute(update(Notification), resultats)
+    db.session.commit()
+    return sum(1 for resultat in resultats if resultat['date_envoi'])
+
+def traiter_alertes():
+    """Tâche de fond : suggestions des produits en alerte, puis envoi des notifications ; retourne les envois"""
+    calculer_suggestions()
+    return envoyer_notifications()
+
+def suggestions():
+    """Produits en alerte avec leur suggestion de réapprovisionnement, les plus urgents d'abord"""
+    alertes = db.session.execute(
+        select(Produit.id, Produit.code_produit, Produit.nom, Produit.stock_actuel, Produit.stock_minimum,
+               AlerteStock.depuis, AlerteStock.vitesse, AlerteStock.jours_avant_rupture,
+               AlerteStock.quantite_suggeree, AlerteStock.date_calcul)
+        .join(AlerteStock, AlerteStock.produit_id == Produit.id)
+        .order_by(AlerteStock.jours_avant_rupture.is_(None), AlerteStock.jours_avant_rupture, Produit.nom)
+    ).all()
+    return [dict(alerte._mapping) for alerte in alertes]
+
+@click.command('reapprovisionnement')
+@click.option('--synchroniser', is_flag=True, help='Recalcule d\'abord les alertes depuis les stocks.')
+@with_appcontext
+def reapprovisionnement_commande(synchroniser):
+    """Calcule et affiche les suggestions de réapprovisionnement des produits en alerte"""
+    if synchroniser:
+        click.echo(f'{synchroniser_alertes()} produit(s) entré(s) en alerte.')
+    calculer_suggestions()
+    for alerte in suggestions():
+        rupture = '-' if alerte['jours_avant_rupture'] is None else f"{alerte['jours_avant_rupture']:.1f} j"
+        click.echo(f"{alerte['nom'][:40]:<40} stock {alerte['stock_actuel']:>6} / {alerte['stock_minimum']:<6} "
+                   f"{alerte['vitesse']:>8.2f}/j  rupture {rupture:>8}  commander {alerte['quantite_suggeree']}")
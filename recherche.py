@@ -0,0 +1,178 @@
+import re
+import unicodedata
+from sqlalchemy import select, table, column, literal_column, func, and_
+from . import db
+from .models import Produit, Client
+
+# Recherche plein texte des produits et des clients.
+# SQLite : tables FTS5 (produits_fts, clients_fts) tenues à jour par des
+# triggers, sans accents grâce au tokenizer unicode61.
+# PostgreSQL : index GIN pg_trgm sur le texte sans accents (unaccent) des
+# colonnes cherchées, qui sert les LIKE '%...%'.
+# Les tables et index sont créés par la migration 3.
+
+LONGUEUR_MIN = 2
+LIMITE_SUGGESTIONS = 10
+LIMITE_SUGGESTIONS_MAX = 50
+
+# Correspondances classées par pertinence pour l'autocomplétion. Au-delà
+# (préfixe très courant), seules les plus récentes sont classées : le calcul
+# du score de toutes les correspondances coûterait plus que la requête.
+CANDIDATS_CLASSEMENT = 1000
+
+# Colonnes cherchées, et leur poids dans le classement SQLite (bm25)
+COLONNES_PRODUITS = ('nom', 'code_produit', 'categorie', 'description')
+POIDS_PRODUITS = (10.0, 8.0, 2.0, 1.0)
+COLONNES_CLIENTS = ('nom', 'email', 'telephone', 'ville')
+POIDS_CLIENTS = (10.0, 4.0, 4.0, 2.0)
+
+def normaliser(texte):
+    """Texte en minuscules et sans accents"""
+    decompose = unicodedata.normalize('NFKD', texte or '')
+    return ''.join(c for c in decompose if not unicodedata.combining(c)).lower()
+
+def mots(texte):
+    """Mots de la recherche, normalisés"""
+    return re.findall(r'\w+', normaliser(texte))
+
+def _dialecte():
+    return db.session.get_bind().dialect.name
+
+# SQLite (FTS5)
+
+def _requete_fts(termes):
+    # Chaque mot est cherché en préfixe : "riz bla" trouve « Riz blanc »
+    return ' '.join(f'"{terme}"*' for terme in termes)
+
+def _fts_correspond(table_fts, termes):
+    return literal_column(table_fts).op('MATCH')(_requete_fts(termes))
+
+def _fts_ids(table_fts, termes):
+    return select(column('rowid')).select_from(table(table_fts)).where(_fts_correspond(table_fts, termes))
+
+def _fts_rang(table_fts, poids):
+    return literal_column(f"bm25({table_fts}, {', '.join(str(p) for p in poids)})")
+
+# PostgreSQL (pg_trgm)
+
+def document_trgm(table, colonnes):
+    """Expression indexée : colonnes concaténées, en minuscules, sans accents
+
+    Le texte doit être identique dans l'index et dans les requêtes pour que
+    PostgreSQL utilise l'index.
+    """
+    concat = " || ' ' || ".join(f"coalesce({table}.{c}, '')" for c in colonnes)
+    return f'f_unaccent(lower({concat}))'
+
+def _trgm_condition(document, termes):
+    # Les mots ne contiennent que des caractères \w : seul « _ » est à échapper
+    return and_(*(literal_column(document).like('%' + terme.replace('_', r'\_') + '%') for terme in termes))
+
+def _trgm_rang(document, texte):
+    return func.word_similarity(normaliser(texte), literal_column(document))
+
+# Filtres et classements par dialecte
+
+def filtre_produits(texte):
+    """Condition SQL des produits correspondant à la recherche"""
+    termes = mots(texte)
+    if not termes:
+        return Produit.nom.contains(texte)
+    dialecte = _dialecte()
+    if dialecte == 'sqlite':
+        return Produit.id.in_(_fts_ids('produits_fts', termes))
+    if dialecte == 'postgresql':
+        return _trgm_condition(document_trgm('produits', COLONNES_PRODUITS), termes)
+    return Produit.nom.contains(texte)
+
+def filtre_clients(texte):
+    """Condition SQL des clients correspondant à la recherche"""
+    termes = mots(texte)
+    if not termes:
+        return Client.nom.contains(texte)
+    dialecte = _dialecte()
+    if dialecte == 'sqlite':
+        return Client.id.in_(_fts_ids('clients_fts', termes))
+    if dialecte == 'postgresql':
+        return _trgm_condition(document_trgm('clients', COLONNES_CLIENTS), termes)
+    return Client.nom.contains(texte)
+
+def _rechercher(modele, nom_table, table_fts, colonnes, poids, texte, limite, champs):
+    termes = mots(texte)
+    if len(''.join(termes)) < LONGUEUR_MIN:
+        return []
+
+    stmt = select(*champs).where(modele.actif == True)
+    dialecte = _dialecte()
+    if dialecte == 'sqlite':
+        fts = table(table_fts, column('rowid'))
+        candidats = select(fts.c.rowid.label('id'), _fts_rang(table_fts, poids).label('rang')) \
+            .where(_fts_correspond(table_fts, termes)) \
+            .order_by(fts.c.rowid.desc()).limit(CANDIDATS_CLASSEMENT).subquery()
+        stmt = stmt.join(candidats, candidats.c.id == modele.id) \
+            .order_by(candidats.c.rang, modele.nom)
+    elif dialecte == 'postgresql':
+        document = document_trgm(nom_table, colonnes)
+        stmt = stmt.where(_trgm_condition(document, termes)) \
+            .order_by(_trgm_rang(document, texte).desc(), modele.nom)
+    else:
+        stmt = stmt.where(modele.nom.contains(texte)).order_by(modele.nom)
+
+    return [dict(ligne._mapping) for ligne in db.session.execute(stmt.limit(limite))]
+
+def rechercher_produits(texte, limite=LIMITE_SUGGESTIONS):
+    """Produits actifs correspondant à la recherche, les plus pertinents d'abord"""
+    return _rechercher(Produit, 'produits', 'produits_fts', COLONNES_PRODUITS, POIDS_PRODUITS,
+                       texte, limite, (Produit.id, Produit.nom, Produit.code_produit,
+                                       Produit.prix_unitaire, Produit.stock_actuel))
+
+def rechercher_clients(texte, limite=LIMITE_SUGGESTIONS):
+    """Clients actifs correspondant à la recherche, les plus pertinents d'abord"""
+    return _rechercher(Client, 'clients', 'clients_fts', COLONNES_CLIENTS, POIDS_CLIENTS,
+                       texte, limite, (Client.id, Client.nom, Client.email,
+                                       Client.telephone, Client.ville))
+
+# Création des index (migration 3)
+
+def _ddl_fts(table, table_fts, colonnes):
+    liste = ', '.join(colonnes)
+    nouvelles = ', '.join(f'new.{c}' for c in colonnes)
+    anciennes = ', '.join(f'old.{c}' for c in colonnes)
+    supprimer = f"INSERT INTO {table_fts}({table_fts}, rowid, {liste}) VALUES ('delete', old.id, {anciennes});"
+    inserer = f"INSERT INTO {table_fts}(rowid, {liste}) VALUES (new.id, {nouvelles});"
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {table_fts} USING fts5({liste}, content='{table}', "
+        f"content_rowid='id', tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+        f"CREATE TRIGGER IF NOT EXISTS {table_fts}_ai AFTER INSERT ON {table} BEGIN {inserer} END",
+        f"CREATE TRIGGER IF NOT EXISTS {table_fts}_ad AFTER DELETE ON {table} BEGIN {supprimer} END",
+        # Seules les colonnes cherchées déclenchent une réindexation (pas le stock)
+        f"CREATE TRIGGER IF NOT EXISTS {table_fts}_au AFTER UPDATE OF {liste} ON {table} "
+        f"BEGIN {supprimer} {inserer} END",
+        f"INSERT INTO {table_fts}({table_fts}) VALUES ('rebuild')",
+    ]
+
+def _ddl_trgm(table, colonnes):
+    return [
+        f"CREATE INDEX IF NOT EXISTS ix_{table}_recherche ON {table} "
+        f"USING gin (({document_trgm(table, colonnes)}) gin_trgm_ops)",
+    ]
+
+def creer_index_recherche(connexion):
+    """Crée les index de recherche adaptés au dialecte de `connexion`"""
+    dialecte = connexion.dialect.name
+    if dialecte == 'sqlite':
+        ordres = _ddl_fts('produits', 'produits_fts', COLONNES_PRODUITS) + \
+                 _ddl_fts('clients', 'clients_fts', COLONNES_CLIENTS)
+    elif dialecte == 'postgresql':
+        ordres = [
+            "CREATE EXTENSION IF NOT EXISTS unaccent",
+            "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+            # unaccent() n'est pas IMMUTABLE : l'enveloppe l'est, pour l'index
+            "CREATE OR REPLACE FUNCTION f_unaccent(text) RETURNS text AS "
+            "$$ SELECT public.unaccent('public.unaccent', $1) $$ "
+            "LANGUAGE sql IMMUTABLE PARALLEL SAFE STRICT",
+        ] + _ddl_trgm('produits', COLONNES_PRODUITS) + _ddl_trgm('clients', COLONNES_CLIENTS)
+    else:
+        return
+    for ordre in ordres:
+        connexion.exec_driver_sql(ordre)
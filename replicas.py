@@ -0,0 +1,155 @@
+import click
+import logging
+import sqlite3
+import time
+from contextlib import closing, contextmanager
+from contextvars import ContextVar
+from flask import current_app, request, session
+from flask.cli import with_appcontext
+from flask_sqlalchemy.session import Session
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import DBAPIError
+
+# Lectures sur un réplica de la base.
+# Avec DATABASE_REPLICA_URL, les pages marquées @lecture_seule (listes,
+# rapports, exports, tableau de bord) lisent sur le réplica : les agrégats
+# des rapports ne chargent plus la base où passent les ventes. Seuls les
+# SELECT y sont envoyés ; les écritures, les SELECT ... FOR UPDATE et toutes
+# les autres pages restent sur la base principale.
+# - Lecture de ses propres écritures : après une requête d'écriture (POST),
+#   le même navigateur lit sur la base principale pendant
+#   REPLICA_DELAI_COLLANT secondes, le temps que le réplica rattrape son
+#   retard (horodatage gardé dans la session Flask).
+# - Repli : le réplica est vérifié à sa première utilisation dans la
+#   requête ; s'il ne répond pas, ou si une requête y échoue, les lectures
+#   repassent sur la base principale pendant PAUSE_REPLICA secondes. Une
+#   vue dont une lecture échoue sur le réplica est rejouée une fois sur la
+#   base principale, dans la même requête HTTP.
+# Les données mises en cache au-delà de la requête (statistiques) sont lues
+# sur la base principale (base_principale()) : un cache rempli depuis un
+# réplica en retard resterait faux jusqu'à son invalidation.
+
+CLE_REPLICA = 'replica'  # clé du moteur dans SQLALCHEMY_BINDS
+DELAI_COLLANT = 10.0  # secondes
+PAUSE_REPLICA = 30.0  # secondes
+METHODES_LECTURE = ('GET', 'HEAD')
+
+# Lecture en cours sur le réplica : None (base principale) ou
+# {'moteur': moteur vérifié, ou None avant la première lecture}
+_lecture = ContextVar('lecture_replica', default=None)
+
+def lecture_seule(vue):
+    """Marque une vue dont les lectures peuvent se faire sur le réplica"""
+    vue.lecture_seule = True
+    return vue
+
+@contextmanager
+def base_principale():
+    """Lectures du bloc faites sur la base principale, même dans une vue en lecture seule"""
+    jeton = _lecture.set(None)
+    try:
+        yield
+    finally:
+        _lecture.reset(jeton)
+
+class SessionRoutee(Session):
+    """Session envoyant les SELECT des vues en lecture seule au réplica"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        lecture = _lecture.get()
+        if lecture is not None and bind is None and not self._flushing \
+                and getattr(clause, 'is_select', False) and getattr(clause, '_for_update_arg', None) is None:
+            moteur = routage.moteur_lecture(self._db.engines, lecture)
+            if moteur is not None:
+                return moteur
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+class Routage:
+    """Choix de la base de chaque requête HTTP"""
+
+    def __init__(self):
+        self.delai_collant = DELAI_COLLANT
+        self.indisponible_jusqua = 0.0
+
+    def init_app(self, app):
+        if CLE_REPLICA not in app.config.get('SQLALCHEMY_BINDS', {}):
+            return
+        self.delai_collant = app.config.get('REPLICA_DELAI_COLLANT', DELAI_COLLANT)
+        app.before_request(self._commencer)
+        app.after_request(self._terminer)
+        app.teardown_request(self._abandonner)
+        app.register_error_handler(DBAPIError, self._rejouer)
+
+    def _commencer(self):
+        vue = current_app.view_functions.get(request.endpoint)
+        recente = time.time() - session.get('derniere_ecriture', 0) < self.delai_collant
+        if request.method in METHODES_LECTURE and getattr(vue, 'lecture_seule', False) and not recente:
+            _lecture.set({'moteur': None})
+        else:
+            _lecture.set(None)
+
+    def _terminer(self, response):
+        if request.method not in METHODES_LECTURE:
+            session['derniere_ecriture'] = time.time()
+        return response
+
+    def _abandonner(self, erreur=None):
+        lecture = _lecture.get()
+        _lecture.set(None)
+        if lecture is not None and lecture['moteur'] is not None and isinstance(erreur, DBAPIError):
+            self._suspendre(erreur)
+
+    def _rejouer(self, erreur):
+        """Rejoue sur la base principale une vue dont une lecture a échoué sur le réplica"""
+        lecture = _lecture.get()
+        if lecture is None or lecture['moteur'] is None:
+            raise erreur
+        self._suspendre(erreur)
+        _lecture.set(None)
+        current_app.extensions['sqlalchemy'].session.rollback()
+        vue = current_app.view_functions[request.endpoint]
+        return current_app.ensure_sync(vue)(**request.view_args)
+
+    def _suspendre(self, erreur):
+        self.indisponible_jusqua = time.monotonic() + PAUSE_REPLICA
+        logging.getLogger(__name__).warning(
+            'Réplica indisponible, lectures sur la base principale pendant %.0f s : %s', PAUSE_REPLICA, erreur)
+
+    def moteur_lecture(self, moteurs, lecture):
+        """Moteur du réplica pour la requête, ou None pour la base principale"""
+        if lecture['moteur'] is None:
+            if time.monotonic() < self.indisponible_jusqua:
+                return None
+            moteur = moteurs[CLE_REPLICA]
+            try:
+                moteur.connect().close()
+            except DBAPIError as e:
+                self._suspendre(e)
+                return None
+            lecture['moteur'] = moteur
+        return lecture['moteur']
+
+routage = Routage()
+
+@click.command('copier-replica')
+@with_appcontext
+def copier_replica_commande():
+    """Copie la base principale SQLite dans le réplica SQLite (essais en local)"""
+    principale = make_url(current_app.config['SQLALCHEMY_DATABASE_URI'])
+    replica = current_app.config.get('SQLALCHEMY_BINDS', {}).get(CLE_REPLICA)
+    if replica is None:
+        raise click.ClickException('DATABASE_REPLICA_URL n\'est pas défini.')
+    replica = make_url(replica['url'])
+    if principale.get_backend_name() != 'sqlite' or replica.get_backend_name() != 'sqlite':
+        raise click.ClickException('Copie réservée aux bases SQLite : sous PostgreSQL, '
+                                   'le réplica est alimenté par la réplication du serveur.')
+
+    debut = time.perf_counter()
+    # API de sauvegarde de SQLite : copie cohérente, la base principale reste utilisable
+    try:
+        with closing(sqlite3.connect(principale.database)) as source, \
+                closing(sqlite3.connect(replica.database)) as cible:
+            source.backup(cible)
+    except sqlite3.Error as e:
+        raise click.ClickException(f'Copie impossible : {e}')
+    click.echo(f'Base principale copiée dans {replica.database} en {time.perf_counter() - debut:.2f} s.')
@@ -0,0 +1,229 @@
+import base64
+import json
+from datetime import datetime
+from sqlalchemy import select, func, and_, or_
+from sqlalchemy.orm import joinedload, raiseload, defer
+from . import db
+from .models import Produit, Client, Vente, LigneVente, Facture
+from .recherche import filtre_produits, filtre_clients
+
+# Requêtes des pages de liste.
+# Chaque requête charge en une seule fois les relations affichées par son
+# template et interdit (raiseload) tout autre chargement paresseux, afin que
+# le nombre de requêtes SQL par page ne dépende pas du nombre de lignes.
+
+TAILLE_PAGE = 50
+TAILLE_PAGE_MAX = 200
+
+# Colonnes de tri autorisées pour chaque liste (l'id sert de départage)
+TRIS_PRODUITS = {'nom': Produit.nom, 'prix': Produit.prix_unitaire}
+TRIS_CLIENTS = {'nom': Client.nom, 'date': Client.date_creation}
+TRIS_VENTES = {'date': Vente.date_vente, 'montant': Vente.total_ttc}
+TRIS_FACTURES = {'date': Facture.date_facture}
+
+def _filtrer_produits(query, search='', categorie=''):
+    query = query.filter(Produit.actif == True)
+
+    if search:
+        query = query.filter(filtre_produits(search))
+
+    if categorie:
+        query = query.filter(Produit.categorie == categorie)
+
+    return query
+
+def _filtrer_clients(query, search=''):
+    query = query.filter(Client.actif == True)
+
+    if search:
+        query = query.filter(filtre_clients(search))
+
+    return query
+
+def _filtrer_ventes(query, date_debut=None, date_fin=None, client_id=None):
+    if date_debut:
+        query = query.filter(Vente.date_vente >= date_debut)
+
+    if date_fin:
+        query = query.filter(Vente.date_vente < date_fin)
+
+    if client_id:
+        query = query.filter(Vente.client_id == client_id)
+
+    return query
+
+def _filtrer_factures(query, statut=None):
+    if statut:
+        query = query.filter(Facture.statut == statut)
+
+    return query
+
+def requete_produits(search='', categorie=''):
+    """Requête de la liste des produits actifs"""
+    query = Produit.query.options(raiseload('*'))
+    return _filtrer_produits(query, search, categorie).order_by(Produit.nom)
+
+def requete_clients(search=''):
+    """Requête de la liste des clients actifs"""
+    query = Client.query.options(raiseload('*'))
+    return _filtrer_clients(query, search).order_by(Client.nom)
+
+def requete_ventes(date_debut=None, date_fin=None, client_id=None):
+    """Requête de la liste des ventes avec leur client et leur facture"""
+    query = Vente.query.options(
+        joinedload(Vente.client),
+        joinedload(Vente.facture),
+        raiseload('*')
+    )
+    query = _filtrer_ventes(query, date_debut, date_fin, client_id)
+    return query.order_by(Vente.date_vente.desc())
+
+def requete_factures(statut=None):
+    """Requête de la liste des factures (client et totaux lus dans leur instantané)"""
+    query = Facture.query.options(defer(Facture.lignes), raiseload('*'))
+    return _filtrer_factures(query, statut).order_by(Facture.date_facture.desc())
+
+def total_ventes(date_debut=None, date_fin=None, client_id=None):
+    """Total TTC des ventes confirmées correspondant aux filtres"""
+    query = db.session.query(func.sum(Vente.total_ttc)).filter(Vente.statut == 'confirmée')
+    return _filtrer_ventes(query, date_debut, date_fin, client_id).scalar() or 0
+
+def compter_factures(statut=None):
+    """Nombre de factures par statut correspondant aux filtres"""
+    query = db.session.query(Facture.statut, func.count(Facture.id))
+    comptes = dict(_filtrer_factures(query, statut).group_by(Facture.statut).all())
+    comptes['total'] = sum(comptes.values())
+    return comptes
+
+# Exports : lignes brutes (sans objets ORM) avec les filtres des listes
+
+ENTETES_PRODUITS = ['id', 'code_produit', 'nom', 'categorie', 'prix_unitaire',
+                    'stock_actuel', 'stock_minimum', 'date_creation']
+
+def requete_export_produits(search='', categorie=''):
+    """Lignes de l'export des produits actifs"""
+    stmt = select(Produit.id, Produit.code_produit, Produit.nom, Produit.categorie,
+                  Produit.prix_unitaire, Produit.stock_actuel, Produit.stock_minimum,
+                  Produit.date_creation)
+    return _filtrer_produits(stmt, search, categorie).order_by(Produit.id)
+
+ENTETES_CLIENTS = ['id', 'nom', 'email', 'telephone', 'adresse', 'ville',
+                   'code_postal', 'date_creation']
+
+def requete_export_clients(search=''):
+    """Lignes de l'export des clients actifs"""
+    stmt = select(Client.id, Client.nom, Client.email, Client.telephone, Client.adresse,
+                  Client.ville, Client.code_postal, Client.date_creation)
+    return _filtrer_clients(stmt, search).order_by(Client.id)
+
+ENTETES_VENTES = ['numero_vente', 'date_vente', 'client', 'statut', 'taux_tva', 'total_ht',
+                  'total_ttc', 'code_produit', 'produit', 'quantite', 'prix_unitaire', 'sous_total']
+
+def requete_export_ventes(date_debut=None, date_fin=None, client_id=None):
+    """Lignes de l'export des ventes : une par ligne de vente, avec sa vente"""
+    stmt = select(
+        Vente.numero_vente, Vente.date_vente, Client.nom, Vente.statut, Vente.taux_tva,
+        Vente.total_ht, Vente.total_ttc, Produit.code_produit, Produit.nom,
+        LigneVente.quantite, LigneVente.prix_unitaire, LigneVente.sous_total
+    ).join(Client, Vente.client_id == Client.id) \
+     .outerjoin(LigneVente, LigneVente.vente_id == Vente.id) \
+     .outerjoin(Produit, LigneVente.produit_id == Produit.id)
+    return _filtrer_ventes(stmt, date_debut, date_fin, client_id).order_by(Vente.id, LigneVente.id)
+
+ENTETES_FACTURES = ['numero_facture', 'date_facture', 'date_echeance', 'statut',
+                    'numero_vente', 'client', 'total_ht', 'total_ttc']
+
+def requete_export_factures(statut=None):
+    """Lignes de l'export des factures, avec le numéro de leur vente"""
+    stmt = select(
+        Facture.numero_facture, Facture.date_facture, Facture.date_echeance, Facture.statut,
+        Vente.numero_vente, Facture.client_nom, Facture.total_ht, Facture.total_ttc
+    ).join(Vente, Facture.vente_id == Vente.id)
+    return _filtrer_factures(stmt, statut).order_by(Facture.id)
+
+# Pagination par curseur (keyset)
+
+class Page:
+    """Page de résultats d'une liste paginée par curseur"""
+
+    def __init__(self, elements, suivant, tri, ordre, taille):
+        self.elements = elements
+        self.suivant = suivant
+        self.tri = tri
+        self.ordre = ordre
+        self.taille = taille
+
+    def __iter__(self):
+        return iter(self.elements)
+
+    def __len__(self):
+        return len(self.elements)
+
+def encoder_curseur(valeur, id):
+    """Encode la position (valeur de tri, id) du dernier élément d'une page"""
+    if isinstance(valeur, datetime):
+        valeur = valeur.isoformat()
+    brut = json.dumps([valeur, id], separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(brut).decode().rstrip('=')
+
+def decoder_curseur(curseur, colonne):
+    """Décode un curseur ; lève ValueError s'il est invalide"""
+    try:
+        brut = base64.urlsafe_b64decode(curseur + '=' * (-len(curseur) % 4))
+        valeur, id = json.loads(brut)
+        # Curseur forgé : valeur et identifiant doivent être des scalaires
+        if not isinstance(valeur, (str, int, float, type(None))) or isinstance(id, bool):
+            raise TypeError(valeur)
+        id = int(id)
+        if not all(-2 ** 63 <= v < 2 ** 63 for v in (id, valeur) if isinstance(v, int)):
+            raise OverflowError(valeur)
+        if valeur is not None and isinstance(colonne.type, db.DateTime):
+            valeur = datetime.fromisoformat(valeur)
+    except (TypeError, ValueError, OverflowError) as e:
+        raise ValueError(f'Curseur invalide: {curseur}') from e
+
+    return valeur, id
+
+def paginer(query, tris, tri, ordre, apres=None, taille=None):
+    """Retourne la page de `query` qui suit le curseur `apres`
+
+    `tris` associe les noms de tri autorisés à leur colonne ; le premier
+    sert de tri par défaut. Les résultats sont ordonnés sur (colonne, id),
+    ce qui permet de reprendre la lecture sans OFFSET.
+    """
+    if tri not in tris:
+        tri = next(iter(tris))
+    if ordre not in ('asc', 'desc'):
+        ordre = 'asc'
+
+    try:
+        taille = min(max(int(taille or TAILLE_PAGE), 1), TAILLE_PAGE_MAX)
+    except ValueError:
+        taille = TAILLE_PAGE
+
+    colonne = tris[tri]
+    cle = colonne.class_.id
+
+    query = query.order_by(None)
+
+    if apres:
+        valeur, id = decoder_curseur(apres, colonne)
+        if ordre == 'desc':
+            query = query.filter(or_(colonne < valeur, and_(colonne == valeur, cle < id)))
+        else:
+            query = query.filter(or_(colonne > valeur, and_(colonne == valeur, cle > id)))
+
+    if ordre == 'desc':
+        query = query.order_by(colonne.desc(), cle.desc())
+    else:
+        query = query.order_by(colonne.asc(), cle.asc())
+
+    elements = query.limit(taille + 1).all()
+
+    suivant = None
+    if len(elements) > taille:
+        elements = elements[:taille]
+        dernier = elements[-1]
+        suivant = encoder_curseur(getattr(dernier, colonne.key), dernier.id)
+
+    return Page(elements, suivant, tri, ordre, taille)
@@ -1,60 +1,84 @@
-from flask import render_template, request, redirect, url_for, flash, jsonify, make_response
+import hmac
+import io
+import time
+from flask import render_template, request, redirect, url_for, flash, jsonify, make_response, abort, send_file
 from datetime import datetime, timedelta
-from sqlalchemy import func, and_, extract
+from sqlalchemy import select, insert
 from app import app, db
 from models import Produit, Client, Vente, LigneVente, Facture
-import utils
+from agregats import ventes_par_mois, comptabiliser_vente, comptabiliser_classements
+from agregats import meilleurs_produits, meilleurs_clients, lire_periode, periodes_recentes
+from agregats import rang, CLASSEMENTS, LIMITE_CLASSEMENT_MAX
+from statistiques import statistiques, invalider_produits, invalider_stock, invalider_clients, invalider_ventes
+from catalogue import catalogue, etat_catalogue, details_produits, lire_ids
+from recherche import rechercher_produits, rechercher_clients, LIMITE_SUGGESTIONS, LIMITE_SUGGESTIONS_MAX
+from importation import importer_ventes, lire_ventes, rapport_import, ErreurImport
+from importation_produits import importer_produits, lire_catalogue, lire_champs, rapport_import_produits
+from importation_produits import MIMETYPE_XLSX
+from pdf_factures import donnees_facture, empreinte, obtenir_pdf, invalider_pdf, prerendre_facture
+from factures import instantanes
+from stocks import reserver_stocks, reessayer_transaction, StockInsuffisant
+from mouvements import enregistrer_mouvements, ajuster_stock, requete_stocks_au, ENTETES_INVENTAIRE
+from reapprovisionnement import surveiller_stocks, suggestions
+from numerotation import numero_vente, numero_facture
+from annulations import annuler_ventes, lire_criteres
+from requetes import requete_produits, requete_clients, requete_ventes, requete_factures
+from requetes import total_ventes, compter_factures, paginer, TRIS_PRODUITS, TRIS_CLIENTS, TRIS_VENTES, TRIS_FACTURES
+from requetes import requete_export_produits, requete_export_clients, requete_export_ventes, requete_export_factures
+from requetes import ENTETES_PRODUITS, ENTETES_CLIENTS, ENTETES_VENTES, ENTETES_FACTURES
+from exports import reponse_csv, RAPPORTS
+from metriques import metriques
+from replicas import lecture_seule
+from analyses import analyser, lire_criteres_analyse, DIMENSIONS, MESURES
 
 @app.route('/')
+@lecture_seule
 def index():
     """Page d'accueil avec statistiques générales"""
-    # Statistiques générales
-    total_produits = Produit.query.filter_by(actif=True).count()
-    total_clients = Client.query.filter_by(actif=True).count()
-    
-    # Produits en stock faible
-    produits_stock_faible = Produit.query.filter(
-        and_(Produit.stock_actuel <= Produit.stock_minimum, Produit.actif == True)
-    ).all()
-    
-    # Ventes du mois en cours
-    debut_mois = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-    ventes_mois = db.session.query(func.sum(Vente.total_ttc)).filter(
-        and_(Vente.date_vente >= debut_mois, Vente.statut == 'confirmée')
-    ).scalar() or 0
-    
-    # Ventes du jour
-    debut_jour = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
-    ventes_jour = db.session.query(func.sum(Vente.total_ttc)).filter(
-        and_(Vente.date_vente >= debut_jour, Vente.statut == 'confirmée')
-    ).scalar() or 0
-    
-    return render_template('index.html',
-                         total_produits=total_produits,
-                         total_clients=total_clients,
-                         produits_stock_faible=produits_stock_faible,
-                         ventes_mois=ventes_mois,
-                         ventes_jour=ventes_jour)
+    return render_template('index.html', **statistiques())
 
 @app.route('/produits')
+@lecture_seule
 def produits():
     """Liste des produits"""
     search = request.args.get('search', '')
     categorie = request.args.get('categorie', '')
     
-    query = Produit.query.filter_by(actif=True)
-    
-    if search:
-        query = query.filter(Produit.nom.contains(search))
-    
-    if categorie:
-        query = query.filter_by(categorie=categorie)
+    try:
+        page = paginer(requete_produits(search=search, categorie=categorie), TRIS_PRODUITS,
+                       request.args.get('tri'), request.args.get('ordre', 'asc'),
+                       apres=request.args.get('apres'), taille=request.args.get('taille'))
+    except ValueError:
+        abort(400)
     
-    produits = query.order_by(Produit.nom).all()
     categories = db.session.query(Produit.categorie).distinct().filter(Produit.categorie.isnot(None)).all()
     categories = [cat[0] for cat in categories]
     
-    return render_template('produits.html', produits=produits, categories=categories)
+    return render_template('produits.html', produits=page, page=page, categories=categories)
+
+@app.route('/produits/export')
+@lecture_seule
+def exporter_produits():
+    """Exporter la liste des produits (CSV ou Excel)"""
+    stmt = requete_export_produits(search=request.args.get('search', ''),
+                                   categorie=request.args.get('categorie', ''))
+    try:
+        return reponse_csv('produits', ENTETES_PRODUITS, stmt, request.args.get('format', 'csv'))
+    except ValueError:
+        abort(400)
+
+@app.route('/produits/inventaire')
+@lecture_seule
+def exporter_inventaire():
+    """Exporter le stock de chaque produit à la fin d'une journée (?date=AAAA-MM-JJ)"""
+    date = request.args.get('date')
+    try:
+        fin = datetime.strptime(date, '%Y-%m-%d') + timedelta(days=1, microseconds=-1) \
+            if date else datetime.utcnow()
+        return reponse_csv('inventaire', ENTETES_INVENTAIRE, requete_stocks_au(fin),
+                           request.args.get('format', 'csv'))
+    except ValueError:
+        abort(400)
 
 @app.route('/produits/ajouter', methods=['GET', 'POST'])
 def ajouter_produit():
@@ -72,7 +96,12 @@ def ajouter_produit():
             )
             
             db.session.add(produit)
+            db.session.flush()
+            enregistrer_mouvements('reapprovisionnement', [(produit.id, produit.stock_actuel, None)],
+                                   'Stock initial')
+            surveiller_stocks([produit.id], sorties=False)
             db.session.commit()
+            invalider_produits()
             flash('Produit ajouté avec succès!', 'success')
             return redirect(url_for('produits'))
             
@@ -92,12 +121,16 @@ def modifier_produit(id):
             produit.nom = request.form['nom']
             produit.description = request.form.get('description', '')
             produit.prix_unitaire = float(request.form['prix_unitaire'])
-            produit.stock_actuel = int(request.form.get('stock_actuel', 0))
             produit.stock_minimum = int(request.form.get('stock_minimum', 5))
             produit.categorie = request.form.get('categorie', '')
             produit.code_produit = request.form.get('code_produit', '')
+            # Le stock saisi est enregistré comme un ajustement dans le registre
+            ajuster_stock(produit.id, int(request.form.get('stock_actuel', 0)), 'Modification du produit')
+            # Stock ou seuil modifié : le produit entre en alerte ou en sort
+            surveiller_stocks([produit.id])
             
             db.session.commit()
+            invalider_stock()
             flash('Produit modifié avec succès!', 'success')
             return redirect(url_for('produits'))
             
@@ -113,7 +146,9 @@ def supprimer_produit(id):
     try:
         produit = Produit.query.get_or_404(id)
         produit.actif = False
+        surveiller_stocks([produit.id], entrees=False)
         db.session.commit()
+        invalider_produits()
         flash('Produit supprimé avec succès!', 'success')
     except Exception as e:
         db.session.rollback()
@@ -122,18 +157,29 @@ def supprimer_produit(id):
     return redirect(url_for('produits'))
 
 @app.route('/clients')
+@lecture_seule
 def clients():
     """Liste des clients"""
     search = request.args.get('search', '')
     
-    query = Client.query.filter_by(actif=True)
-    
-    if search:
-        query = query.filter(Client.nom.contains(search))
-    
-    clients = query.order_by(Client.nom).all()
+    try:
+        page = paginer(requete_clients(search=search), TRIS_CLIENTS,
+                       request.args.get('tri'), request.args.get('ordre', 'asc'),
+                       apres=request.args.get('apres'), taille=request.args.get('taille'))
+    except ValueError:
+        abort(400)
     
-    return render_template('clients.html', clients=clients)
+    return render_template('clients.html', clients=page, page=page)
+
+@app.route('/clients/export')
+@lecture_seule
+def exporter_clients():
+    """Exporter la liste des clients (CSV ou Excel)"""
+    stmt = requete_export_clients(search=request.args.get('search', ''))
+    try:
+        return reponse_csv('clients', ENTETES_CLIENTS, stmt, request.args.get('format', 'csv'))
+    except ValueError:
+        abort(400)
 
 @app.route('/clients/ajouter', methods=['GET', 'POST'])
 def ajouter_client():
@@ -151,6 +197,7 @@ def ajouter_client():
             
             db.session.add(client)
             db.session.commit()
+            invalider_clients()
             flash('Client ajouté avec succès!', 'success')
             return redirect(url_for('clients'))
             
@@ -167,6 +214,7 @@ def supprimer_client(id):
         client = Client.query.get_or_404(id)
         client.actif = False
         db.session.commit()
+        invalider_clients()
         flash('Client supprimé avec succès!', 'success')
     except Exception as e:
         db.session.rollback()
@@ -174,150 +222,232 @@ def supprimer_client(id):
     
     return redirect(url_for('clients'))
 
+def _filtres_ventes(args):
+    """Filtres de la liste des ventes lus dans la query string"""
+    date_debut = args.get('date_debut')
+    date_fin = args.get('date_fin')
+    client_id = args.get('client_id')
+    
+    return dict(
+        date_debut=datetime.strptime(date_debut, '%Y-%m-%d') if date_debut else None,
+        date_fin=datetime.strptime(date_fin, '%Y-%m-%d') + timedelta(days=1) if date_fin else None,
+        client_id=int(client_id) if client_id else None
+    )
+
 @app.route('/ventes')
+@lecture_seule
 def ventes():
     """Liste des ventes"""
-    date_debut = request.args.get('date_debut')
-    date_fin = request.args.get('date_fin')
-    client_id = request.args.get('client_id')
-    
-    query = Vente.query
+    filtres = _filtres_ventes(request.args)
     
-    if date_debut:
-        query = query.filter(Vente.date_vente >= datetime.strptime(date_debut, '%Y-%m-%d'))
-    
-    if date_fin:
-        fin = datetime.strptime(date_fin, '%Y-%m-%d') + timedelta(days=1)
-        query = query.filter(Vente.date_vente < fin)
-    
-    if client_id:
-        query = query.filter_by(client_id=int(client_id))
+    try:
+        page = paginer(requete_ventes(**filtres), TRIS_VENTES,
+                       request.args.get('tri'), request.args.get('ordre', 'desc'),
+                       apres=request.args.get('apres'), taille=request.args.get('taille'))
+    except ValueError:
+        abort(400)
     
-    ventes = query.order_by(Vente.date_vente.desc()).all()
-    clients = Client.query.filter_by(actif=True).order_by(Client.nom).all()
+    clients = requete_clients().all()
     
-    return render_template('ventes.html', ventes=ventes, clients=clients)
+    return render_template('ventes.html', ventes=page, page=page, clients=clients,
+                         total_filtres=total_ventes(**filtres))
+
+@app.route('/ventes/export')
+@lecture_seule
+def exporter_ventes():
+    """Exporter les ventes filtrées avec leurs lignes (CSV ou Excel)"""
+    try:
+        stmt = requete_export_ventes(**_filtres_ventes(request.args))
+        return reponse_csv('ventes', ENTETES_VENTES, stmt, request.args.get('format', 'csv'))
+    except ValueError:
+        abort(400)
+
+def _enregistrer_vente(form):
+    """Enregistre la vente décrite par le formulaire et sa facture ; retourne la facture"""
+    vente = Vente(
+        numero_vente=numero_vente(),
+        client_id=int(form['client_id']),
+        taux_tva=float(form.get('taux_tva', 20.0)),
+        notes=form.get('notes', '')
+    )
+    
+    db.session.add(vente)
+    db.session.flush()  # Pour obtenir l'ID de la vente
+    
+    # Regrouper les lignes d'un même produit (ordre de saisie conservé)
+    quantites = {}
+    for produit_id, quantite in zip(form.getlist('produit_id'), form.getlist('quantite')):
+        if produit_id and quantite:
+            quantites[int(produit_id)] = quantites.get(int(produit_id), 0) + int(quantite)
+    
+    # Vérifier et décrémenter le stock de tous les produits en une requête
+    reserver_stocks(quantites)
+    # Produits passés à leur stock minimum : alerte mise en file avec la vente
+    surveiller_stocks(quantites, sorties=False)
+    
+    # Prix de tous les produits en une seule requête
+    prix = dict(
+        db.session.query(Produit.id, Produit.prix_unitaire)
+        .filter(Produit.id.in_(quantites))
+        .all()
+    )
+    
+    lignes = [
+        dict(vente_id=vente.id, produit_id=produit_id, quantite=quantite,
+             prix_unitaire=prix[produit_id], sous_total=prix[produit_id] * quantite)
+        for produit_id, quantite in quantites.items()
+    ]
+    if lignes:
+        db.session.execute(insert(LigneVente), lignes)
+    enregistrer_mouvements('vente', [(produit_id, -quantite, vente.id)
+                                     for produit_id, quantite in quantites.items()])
+    
+    # Calculer les totaux à partir des lignes en mémoire
+    vente.calculer_totaux([ligne['sous_total'] for ligne in lignes])
+    
+    # Mettre à jour le cumul mensuel et les classements
+    comptabiliser_vente(vente)
+    comptabiliser_classements([(vente.date_vente, vente.client_id, vente.total_ttc, lignes)])
+    
+    # Créer la facture automatiquement (numéro pris en fin de transaction :
+    # le compteur des factures reste verrouillé jusqu'au commit), avec
+    # l'instantané du client, des lignes et des totaux
+    facture = Facture(
+        numero_facture=numero_facture(),
+        vente_id=vente.id,
+        date_echeance=datetime.utcnow() + timedelta(days=30),
+        **instantanes(db.session, [vente.id])[vente.id]
+    )
+    
+    db.session.add(facture)
+    db.session.commit()
+    return facture
 
 @app.route('/ventes/nouvelle', methods=['GET', 'POST'])
 def nouvelle_vente():
     """Créer une nouvelle vente"""
     if request.method == 'POST':
         try:
-            # Générer un numéro de vente unique
-            numero_vente = utils.generer_numero_vente()
-            
-            vente = Vente(
-                numero_vente=numero_vente,
-                client_id=int(request.form['client_id']),
-                taux_tva=float(request.form.get('taux_tva', 20.0)),
-                notes=request.form.get('notes', '')
-            )
-            
-            db.session.add(vente)
-            db.session.flush()  # Pour obtenir l'ID de la vente
+            # Rejouée si une vente concurrente fait échouer la transaction
+            facture = reessayer_transaction(lambda: _enregistrer_vente(request.form))
             
-            # Ajouter les lignes de vente
-            produits_ids = request.form.getlist('produit_id')
-            quantites = request.form.getlist('quantite')
-            
-            for i, produit_id in enumerate(produits_ids):
-                if produit_id and quantites[i]:
-                    produit = Produit.query.get(int(produit_id))
-                    quantite = int(quantites[i])
-                    
-                    # Vérifier le stock
-                    if produit.stock_actuel < quantite:
-                        flash(f'Stock insuffisant pour {produit.nom}. Stock disponible: {produit.stock_actuel}', 'error')
-                        db.session.rollback()
-                        return redirect(url_for('nouvelle_vente'))
-                    
-                    ligne = LigneVente(
-                        vente_id=vente.id,
-                        produit_id=int(produit_id),
-                        quantite=quantite,
-                        prix_unitaire=produit.prix_unitaire
-                    )
-                    ligne.sous_total = ligne.prix_unitaire * ligne.quantite
-                    
-                    # Mettre à jour le stock
-                    produit.stock_actuel -= quantite
-                    
-                    db.session.add(ligne)
-            
-            # Calculer les totaux
-            vente.calculer_totaux()
-            
-            # Créer la facture automatiquement
-            facture = Facture(
-                numero_facture=utils.generer_numero_facture(),
-                vente_id=vente.id,
-                date_echeance=datetime.utcnow() + timedelta(days=30)
-            )
-            
-            db.session.add(facture)
-            db.session.commit()
-            
-            flash('Vente créée avec succès!', 'success')
-            return redirect(url_for('facture_detail', id=facture.id))
+        except StockInsuffisant as e:
+            db.session.rollback()
+            flash(str(e), 'error')
+            return redirect(url_for('nouvelle_vente'))
             
         except Exception as e:
             db.session.rollback()
             flash(f'Erreur lors de la création de la vente: {str(e)}', 'error')
+        
+        else:
+            # Après le commit : la vente est enregistrée quoi qu'il arrive ici
+            invalider_ventes()
+            prerendre_facture(facture.id)
+            
+            flash('Vente créée avec succès!', 'success')
+            return redirect(url_for('facture_detail', id=facture.id))
+    
+    # Les produits sont chargés par le formulaire depuis l'API du catalogue
+    clients = db.session.execute(
+        select(Client.id, Client.nom).where(Client.actif == True).order_by(Client.nom)
+    ).all()
+    
+    return render_template('nouvelle_vente.html', clients=clients, maintenant=datetime.now())
+
+@app.route('/ventes/<int:id>/annuler', methods=['POST'])
+def annuler_vente(id):
+    """Annuler une vente : stock restitué et facture annulée"""
+    Vente.query.get_or_404(id)
     
-    clients = Client.query.filter_by(actif=True).order_by(Client.nom).all()
-    produits = Produit.query.filter_by(actif=True).order_by(Produit.nom).all()
+    try:
+        annulees = reessayer_transaction(
+            lambda: annuler_ventes(ids=[id], motif=request.form.get('motif') or None))
+        if annulees:
+            invalider_ventes()
+            invalider_stock()
+            flash('Vente annulée, stock restitué.', 'success')
+        else:
+            flash('Cette vente est déjà annulée.', 'error')
+    except Exception as e:
+        db.session.rollback()
+        flash(f'Erreur lors de l\'annulation de la vente: {str(e)}', 'error')
     
-    return render_template('nouvelle_vente.html', clients=clients, produits=produits)
+    return redirect(url_for('ventes'))
 
 @app.route('/factures')
+@lecture_seule
 def factures():
     """Liste des factures"""
     statut = request.args.get('statut')
     
-    query = Facture.query
-    
-    if statut:
-        query = query.filter_by(statut=statut)
-    
-    factures = query.order_by(Facture.date_facture.desc()).all()
-    
-    return render_template('factures.html', factures=factures)
+    try:
+        page = paginer(requete_factures(statut=statut), TRIS_FACTURES,
+                       request.args.get('tri'), request.args.get('ordre', 'desc'),
+                       apres=request.args.get('apres'), taille=request.args.get('taille'))
+    except ValueError:
+        abort(400)
+    
+    return render_template('factures.html', factures=page, page=page,
+                         comptes=compter_factures(statut=statut))
+
+@app.route('/factures/export')
+@lecture_seule
+def exporter_factures():
+    """Exporter la liste des factures (CSV ou Excel)"""
+    stmt = requete_export_factures(statut=request.args.get('statut'))
+    try:
+        return reponse_csv('factures', ENTETES_FACTURES, stmt, request.args.get('format', 'csv'))
+    except ValueError:
+        abort(400)
 
 @app.route('/factures/<int:id>')
+@lecture_seule
 def facture_detail(id):
-    """Détail d'une facture"""
+    """Détail d'une facture (une seule ligne : son instantané)"""
     facture = Facture.query.get_or_404(id)
-    return render_template('facture_detail.html', facture=facture)
+    return render_template('facture_detail.html', facture=facture, lignes=facture.liste_lignes())
 
 @app.route('/factures/<int:id>/pdf')
 def facture_pdf(id):
     """Générer le PDF d'une facture"""
-    facture = Facture.query.get_or_404(id)
+    donnees = donnees_facture(id)
+    if donnees is None:
+        abort(404)
+    
+    # L'empreinte du contenu sert d'ETag : une réimpression ne renvoie rien
+    hachage = empreinte(donnees)
+    if hachage in request.if_none_match:
+        response = make_response('', 304)
+        response.set_etag(hachage)
+        return response
     
     try:
-        pdf_content = utils.generer_facture_pdf(facture)
-        
-        response = make_response(pdf_content)
-        response.headers['Content-Type'] = 'application/pdf'
-        response.headers['Content-Disposition'] = f'inline; filename="facture_{facture.numero_facture}.pdf"'
-        
-        return response
-        
+        chemin = obtenir_pdf(donnees, hachage)
     except Exception as e:
         flash(f'Erreur lors de la génération du PDF: {str(e)}', 'error')
         return redirect(url_for('facture_detail', id=id))
+    
+    response = send_file(chemin, mimetype='application/pdf',
+                         download_name=f"facture_{donnees['numero_facture']}.pdf",
+                         etag=hachage, conditional=True)
+    response.cache_control.no_cache = True
+    return response
 
 @app.route('/factures/<int:id>/statut', methods=['POST'])
 def modifier_statut_facture(id):
     """Modifier le statut d'une facture"""
+    modifie = False
     try:
         facture = Facture.query.get_or_404(id)
         nouveau_statut = request.form['statut']
         
-        if nouveau_statut in ['impayée', 'payée', 'en_retard']:
+        if facture.statut == 'annulée':
+            flash('Une facture annulée ne peut plus changer de statut.', 'error')
+        elif nouveau_statut in ['impayée', 'payée', 'en_retard']:
             facture.statut = nouveau_statut
             db.session.commit()
-            flash('Statut de la facture modifié avec succès!', 'success')
+            modifie = True
         else:
             flash('Statut invalide!', 'error')
             
@@ -325,72 +455,223 @@ def modifier_statut_facture(id):
         db.session.rollback()
         flash(f'Erreur lors de la modification du statut: {str(e)}', 'error')
     
+    if modifie:
+        # Après le commit : le statut est imprimé sur le PDF
+        invalider_pdf(id)
+        prerendre_facture(id)
+        flash('Statut de la facture modifié avec succès!', 'success')
+    
     return redirect(url_for('facture_detail', id=id))
 
 @app.route('/rapports')
+@lecture_seule
 def rapports():
     """Page des rapports et statistiques"""
-    # Rapport mensuel
-    mois_actuel = datetime.now().month
-    annee_actuelle = datetime.now().year
-    
-    # Ventes par mois (12 derniers mois)
-    ventes_mensuelles = []
-    for i in range(12):
-        mois = mois_actuel - i
-        annee = annee_actuelle
-        
-        if mois <= 0:
-            mois += 12
-            annee -= 1
-        
-        total = db.session.query(func.sum(Vente.total_ttc)).filter(
-            and_(
-                extract('month', Vente.date_vente) == mois,
-                extract('year', Vente.date_vente) == annee,
-                Vente.statut == 'confirmée'
-            )
-        ).scalar() or 0
-        
-        ventes_mensuelles.insert(0, {
-            'mois': f"{annee}-{mois:02d}",
-            'total': total
-        })
-    
-    # Produits les plus vendus
-    produits_vendus = db.session.query(
-        Produit.nom,
-        func.sum(LigneVente.quantite).label('total_vendu')
-    ).join(LigneVente).join(Vente).filter(
-        Vente.statut == 'confirmée'
-    ).group_by(Produit.id, Produit.nom).order_by(
-        func.sum(LigneVente.quantite).desc()
-    ).limit(10).all()
-    
-    # Clients les plus actifs
-    clients_actifs = db.session.query(
-        Client.nom,
-        func.count(Vente.id).label('nb_ventes'),
-        func.sum(Vente.total_ttc).label('total_achats')
-    ).join(Vente).filter(
-        Vente.statut == 'confirmée'
-    ).group_by(Client.id, Client.nom).order_by(
-        func.sum(Vente.total_ttc).desc()
-    ).limit(10).all()
+    # Ventes par mois (12 derniers mois), lues dans la table des cumuls
+    ventes_mensuelles = ventes_par_mois(12)
+    
+    try:
+        # Période des classements et analyse à la demande (entrepôt d'analyse)
+        periode = lire_periode(request.args.get('periode'))
+        criteres = lire_criteres_analyse(request.args)
+        analyse = analyser(**criteres)
+    except ValueError:
+        abort(400)
+    
+    # Produits les plus vendus et clients les plus actifs de la période :
+    # lus dans les classements, tenus à jour à chaque vente
+    produits_vendus = meilleurs_produits(periode, 10)
+    clients_actifs = meilleurs_clients(periode, 10)
     
     return render_template('rapports.html',
                          ventes_mensuelles=ventes_mensuelles,
                          produits_vendus=produits_vendus,
-                         clients_actifs=clients_actifs)
+                         clients_actifs=clients_actifs,
+                         periode=periode, periodes=periodes_recentes(),
+                         analyse=analyse, criteres=criteres,
+                         dimensions=DIMENSIONS, mesures=MESURES)
+
+@app.route('/rapports/export/<rapport>')
+@lecture_seule
+def exporter_rapport(rapport):
+    """Exporter un rapport complet (ventes-mensuelles, produits ou clients)"""
+    if rapport not in RAPPORTS:
+        abort(404)
+    entetes, requete = RAPPORTS[rapport]
+    try:
+        return reponse_csv(f'rapport_{rapport}', entetes, requete(), request.args.get('format', 'csv'))
+    except ValueError:
+        abort(400)
 
 # API endpoints pour AJAX
+@app.route('/api/catalogue')
+def api_catalogue():
+    """API du catalogue du formulaire de vente (complet, ou modifié depuis ?depuis=<jeton>)"""
+    depuis = request.args.get('depuis', 0, type=int)
+    
+    # L'état du catalogue sert d'ETag : rien n'est relu s'il n'a pas changé
+    _, etat = etat_catalogue()
+    if etat in request.if_none_match:
+        response = make_response('', 304)
+        response.set_etag(etat)
+        return response
+    
+    response = jsonify(catalogue(depuis))
+    response.set_etag(etat)
+    response.cache_control.no_cache = True
+    return response
+
+@app.route('/api/stocks')
+def api_stocks():
+    """API des prix et stocks actuels de plusieurs produits (?ids=1,2,3)"""
+    try:
+        ids = lire_ids(request.args.get('ids', ''))
+    except ValueError:
+        abort(400)
+    
+    return jsonify(details_produits(ids))
+
+@app.route('/api/reapprovisionnement')
+@lecture_seule
+def api_reapprovisionnement():
+    """API des produits en alerte de stock et des quantités à commander, les plus urgents d'abord"""
+    return jsonify(suggestions())
+
+@app.route('/api/produits/import', methods=['POST'])
+def api_import_produits():
+    """API d'import du catalogue par code_produit (CSV, ou XLSX selon le Content-Type)
+
+    ?champs=prix_unitaire,stock_actuel limite les champs mis à jour ;
+    ?simulation=1 renvoie les différences sans rien écrire.
+    """
+    try:
+        champs = lire_champs(request.args.get('champs'))
+    except ValueError:
+        abort(400)
+    simulation = request.args.get('simulation', '0') not in ('0', '', 'false', 'non')
+    format_ = 'xlsx' if request.mimetype == MIMETYPE_XLSX else 'csv'
+    
+    debut = time.perf_counter()
+    try:
+        resultats = list(importer_produits(lire_catalogue(request.stream, format_), champs, simulation))
+    except ErreurImport as e:
+        abort(400, description=str(e))
+    rapport = rapport_import_produits(resultats, time.perf_counter() - debut, simulation)
+    
+    if not simulation and (rapport['crees'] or rapport['modifies']):
+        invalider_produits()
+    
+    return jsonify(rapport)
+
 @app.route('/api/produit/<int:id>')
 def api_produit_detail(id):
     """API pour obtenir les détails d'un produit"""
-    produit = Produit.query.get_or_404(id)
-    return jsonify({
-        'id': produit.id,
-        'nom': produit.nom,
-        'prix_unitaire': produit.prix_unitaire,
-        'stock_actuel': produit.stock_actuel
-    })
+    produits = details_produits([id])
+    if not produits:
+        abort(404)
+    return jsonify(produits[0])
+
+@app.route('/api/stats')
+@lecture_seule
+def api_stats():
+    """API des statistiques du tableau de bord"""
+    return jsonify(statistiques())
+
+@app.route('/api/analyses')
+@lecture_seule
+def api_analyses():
+    """API d'analyse des ventes : agrégats par dimensions sur une période"""
+    try:
+        resultat = analyser(**lire_criteres_analyse(request.args))
+    except ValueError:
+        abort(400)
+    if resultat is None:
+        # Entrepôt pas encore exporté (tâche exporter-analyses)
+        abort(503)
+    return jsonify(resultat)
+
+@app.route('/api/classements/<classement>')
+@lecture_seule
+def api_classements(classement):
+    """API des classements des produits ou des clients d'une période, et rang de l'un d'eux"""
+    if classement not in CLASSEMENTS:
+        abort(404)
+    modele, tris = CLASSEMENTS[classement]
+    tri = request.args.get('tri', tris[0])
+    try:
+        periode = lire_periode(request.args.get('periode'))
+    except ValueError:
+        abort(400)
+    if tri not in tris:
+        abort(400)
+    limite = min(max(request.args.get('limite', 10, type=int), 1), LIMITE_CLASSEMENT_MAX)
+    
+    meilleurs = meilleurs_produits if classement == 'produits' else meilleurs_clients
+    resultat = {'classement': classement, 'periode': periode, 'tri': tri,
+                'resultats': [dict(ligne._mapping, rang=position)
+                              for position, ligne in enumerate(meilleurs(periode, limite, tri), 1)]}
+    identifiant = request.args.get('id', type=int)
+    if identifiant is not None:
+        resultat['id'] = identifiant
+        resultat['rang'] = rang(modele, identifiant, periode, tri)
+    return jsonify(resultat)
+
+@app.route('/metrics')
+def metrics():
+    """Mesures des requêtes au format texte Prometheus"""
+    jeton = app.config.get('METRIQUES_JETON')
+    if jeton and not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {jeton}'):
+        abort(401)
+    reponse = make_response(metriques.exposition())
+    reponse.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    return reponse
+
+@app.route('/api/search')
+@lecture_seule
+def api_recherche():
+    """API d'autocomplétion des produits et des clients"""
+    texte = request.args.get('q', '').strip()
+    type_ = request.args.get('type', 'produits')
+    limite = min(max(request.args.get('limite', LIMITE_SUGGESTIONS, type=int), 1), LIMITE_SUGGESTIONS_MAX)
+    
+    if type_ == 'produits':
+        resultats = rechercher_produits(texte, limite)
+    elif type_ == 'clients':
+        resultats = rechercher_clients(texte, limite)
+    else:
+        abort(400)
+    
+    reponse = jsonify({'q': texte, 'type': type_, 'resultats': resultats})
+    reponse.cache_control.private = True
+    reponse.cache_control.max_age = 30
+    return reponse
+
+@app.route('/api/ventes/bulk', methods=['POST'])
+def api_import_ventes():
+    """API d'import en masse des ventes (JSON-lines, ou CSV avec Content-Type: text/csv)"""
+    format_ = 'csv' if request.mimetype == 'text/csv' else 'jsonl'
+    flux = io.TextIOWrapper(request.stream, encoding='utf-8')
+    
+    debut = time.perf_counter()
+    resultats = list(importer_ventes(lire_ventes(flux, format_)))
+    rapport = rapport_import(resultats, time.perf_counter() - debut)
+    
+    if rapport['importees']:
+        invalider_ventes()
+    
+    return jsonify(rapport)
+
+@app.route('/api/ventes/annulations', methods=['POST'])
+def api_annuler_ventes():
+    """API d'annulation en masse (par identifiants ou par période)"""
+    try:
+        criteres = lire_criteres(request.get_json(silent=True) or {})
+    except (ValueError, TypeError):
+        abort(400)
+    
+    annulees = reessayer_transaction(lambda: annuler_ventes(**criteres))
+    if annulees:
+        invalider_ventes()
+        invalider_stock()
+    
+    return jsonify({'annulees': len(annulees), 'ventes': annulees})
@@ -24,6 +24,9 @@ function initializeApp() {
     
     // Animations d'entrée
     animateElements();
+    
+    // Tri des tableaux côté serveur
+    initializeTableFeatures();
 }
 
 // ===== TOOLTIPS ET POPOVERS =====
@@ -204,7 +207,7 @@ function animateElements() {
 
 // ===== GESTION DES TABLEAUX =====
 function initializeTableFeatures() {
-    // Tri des colonnes (version simple)
+    // Tri des colonnes (effectué par le serveur)
     const sortableHeaders = document.querySelectorAll('th[data-sort]');
     sortableHeaders.forEach(function(header) {
         header.style.cursor = 'pointer';
@@ -213,95 +216,128 @@ function initializeTableFeatures() {
         });
         
         // Ajouter un indicateur visuel
-        header.innerHTML += ' <i class="fas fa-sort text-muted"></i>';
+        const direction = header.dataset.sortDirection;
+        if (direction === 'asc') {
+            header.innerHTML += ' <i class="fas fa-sort-up"></i>';
+        } else if (direction === 'desc') {
+            header.innerHTML += ' <i class="fas fa-sort-down"></i>';
+        } else {
+            header.innerHTML += ' <i class="fas fa-sort text-muted"></i>';
+        }
     });
 }
 
 function sortTable(header) {
-    // Implémentation simple du tri
-    const table = header.closest('table');
-    const tbody = table.querySelector('tbody');
-    const rows = Array.from(tbody.querySelectorAll('tr'));
-    const columnIndex = Array.from(header.parentNode.children).indexOf(header);
-    const sortType = header.dataset.sort;
+    // Le tri est fait par le serveur : on recharge la première page
+    // avec la colonne et l'ordre demandés
+    const params = new URLSearchParams(window.location.search);
+    const ordre = header.dataset.sortDirection === 'asc' ? 'desc' : 'asc';
     
-    const sortedRows = rows.sort(function(a, b) {
-        const aVal = a.children[columnIndex].textContent.trim();
-        const bVal = b.children[columnIndex].textContent.trim();
-        
-        if (sortType === 'number') {
-            return parseFloat(aVal.replace(/[^\d.-]/g, '')) - parseFloat(bVal.replace(/[^\d.-]/g, ''));
-        } else {
-            return aVal.localeCompare(bVal, 'fr');
-        }
-    });
-    
-    // Alterner l'ordre
-    if (header.dataset.sortDirection === 'desc') {
-        sortedRows.reverse();
-        header.dataset.sortDirection = 'asc';
-        header.querySelector('i').className = 'fas fa-sort-up';
-    } else {
-        header.dataset.sortDirection = 'desc';
-        header.querySelector('i').className = 'fas fa-sort-down';
-    }
+    params.set('tri', header.dataset.sort);
+    params.set('ordre', ordre);
+    params.delete('apres');
     
-    // Réorganiser les lignes
-    sortedRows.forEach(function(row) {
-        tbody.appendChild(row);
-    });
+    window.location.search = params.toString();
 }
 
 // ===== RECHERCHE EN TEMPS RÉEL =====
+// Suggestions servies par /api/search (index plein texte côté serveur) :
+// la recherche couvre toute la base, pas seulement la page affichée.
+const RECHERCHE_DELAI = 250;
+const RECHERCHE_LONGUEUR_MIN = 2;
+
 function initializeLiveSearch() {
-    const searchInputs = document.querySelectorAll('input[type="search"], input[name="search"]');
+    const searchInputs = document.querySelectorAll('input[data-recherche]');
     searchInputs.forEach(function(input) {
+        if (input.dataset.rechercheInitialisee) {
+            return;
+        }
+        input.dataset.rechercheInitialisee = '1';
+        
+        const menu = document.createElement('div');
+        menu.className = 'dropdown-menu w-100';
+        input.insertAdjacentElement('afterend', menu);
+        
         let searchTimeout;
+        let controleur = null;
+        
         input.addEventListener('input', function() {
             clearTimeout(searchTimeout);
             searchTimeout = setTimeout(function() {
-                performLiveSearch(input);
-            }, 300);
+                if (controleur) {
+                    controleur.abort();
+                }
+                controleur = new AbortController();
+                performLiveSearch(input, menu, controleur.signal);
+            }, RECHERCHE_DELAI);
+        });
+        
+        input.addEventListener('keydown', function(e) {
+            if (e.key === 'Escape') {
+                menu.classList.remove('show');
+            }
+        });
+        
+        input.addEventListener('blur', function() {
+            // Laisser le temps au clic sur une suggestion
+            setTimeout(function() { menu.classList.remove('show'); }, 150);
         });
     });
 }
 
-function performLiveSearch(input) {
-    const searchTerm = input.value.toLowerCase();
-    const targetTable = document.querySelector('table tbody');
+function performLiveSearch(input, menu, signal) {
+    const searchTerm = input.value.trim();
     
-    if (targetTable) {
-        const rows = targetTable.querySelectorAll('tr');
-        let visibleCount = 0;
-        
-        rows.forEach(function(row) {
-            const text = row.textContent.toLowerCase();
-            if (text.includes(searchTerm)) {
-                row.style.display = '';
-                visibleCount++;
-            } else {
-                row.style.display = 'none';
+    if (searchTerm.length < RECHERCHE_LONGUEUR_MIN) {
+        menu.classList.remove('show');
+        return;
+    }
+    
+    const params = new URLSearchParams({q: searchTerm, type: input.dataset.recherche});
+    fetch(`${input.dataset.rechercheUrl}?${params}`, {signal: signal})
+        .then(response => response.json())
+        .then(data => afficherSuggestions(input, menu, data.resultats))
+        .catch(error => {
+            if (error.name !== 'AbortError') {
+                console.error('Erreur lors de la recherche:', error);
             }
         });
+}
+
+function afficherSuggestions(input, menu, resultats) {
+    menu.innerHTML = '';
+    
+    if (resultats.length === 0) {
+        const vide = document.createElement('span');
+        vide.className = 'dropdown-item-text text-muted';
+        vide.textContent = `Aucun résultat trouvé pour "${input.value}"`;
+        menu.appendChild(vide);
+    }
+    
+    resultats.forEach(function(resultat) {
+        const item = document.createElement('button');
+        item.type = 'button';
+        item.className = 'dropdown-item d-flex justify-content-between';
         
-        // Afficher un message si aucun résultat
-        const existingNoResult = targetTable.querySelector('.no-results');
-        if (existingNoResult) {
-            existingNoResult.remove();
-        }
+        const nom = document.createElement('span');
+        nom.textContent = resultat.nom;
+        const detail = document.createElement('small');
+        detail.className = 'text-muted ms-3';
+        detail.textContent = resultat.code_produit || resultat.email || resultat.telephone || '';
+        item.append(nom, detail);
         
-        if (visibleCount === 0 && searchTerm !== '') {
-            const noResultRow = document.createElement('tr');
-            noResultRow.className = 'no-results';
-            noResultRow.innerHTML = `
-                <td colspan="100%" class="text-center text-muted py-4">
-                    <i class="fas fa-search fa-2x mb-2"></i><br>
-                    Aucun résultat trouvé pour "${input.value}"
-                </td>
-            `;
-            targetTable.appendChild(noResultRow);
-        }
-    }
+        item.addEventListener('mousedown', function(e) {
+            e.preventDefault();
+            input.value = resultat.nom;
+            menu.classList.remove('show');
+            if (input.form) {
+                input.form.submit();
+            }
+        });
+        menu.appendChild(item);
+    });
+    
+    menu.classList.add('show');
 }
 
 // ===== UTILITAIRES DE CONFIRMATION =====
@@ -0,0 +1,100 @@
+from datetime import datetime
+from sqlalchemy import func, and_
+from . import db
+from .cache import cache
+from .models import Produit, Client, Vente, AlerteStock
+from .replicas import base_principale
+
+# Statistiques du tableau de bord, servies depuis le cache.
+# Chaque compteur a sa propre clé ; les routes qui modifient les données
+# invalident, après le commit, uniquement les compteurs concernés.
+
+CLE_PRODUITS = 'stats:total_produits'
+CLE_CLIENTS = 'stats:total_clients'
+CLE_STOCK_FAIBLE = 'stats:stock_faible'
+
+def _debut_jour():
+    return datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+
+def _debut_mois():
+    return _debut_jour().replace(day=1)
+
+# Les clés des totaux de ventes contiennent la période : elles changent
+# d'elles-mêmes au passage à un nouveau jour ou à un nouveau mois.
+
+def _cle_ventes_jour():
+    return f"stats:ventes_jour:{_debut_jour().strftime('%Y-%m-%d')}"
+
+def _cle_ventes_mois():
+    return f"stats:ventes_mois:{_debut_mois().strftime('%Y-%m')}"
+
+def _memoriser(cle, calcul):
+    # Le cache survit à la requête : il est rempli depuis la base principale,
+    # jamais depuis un réplica en retard
+    def calcul_principal():
+        with base_principale():
+            return calcul()
+    return cache.memoriser(cle, calcul_principal)
+
+def _total_ventes_depuis(debut):
+    return db.session.query(func.sum(Vente.total_ttc)).filter(
+        and_(Vente.date_vente >= debut, Vente.statut == 'confirmée')
+    ).scalar() or 0
+
+def total_produits():
+    """Nombre de produits actifs"""
+    return _memoriser(CLE_PRODUITS, lambda: Produit.query.filter_by(actif=True).count())
+
+def total_clients():
+    """Nombre de clients actifs"""
+    return _memoriser(CLE_CLIENTS, lambda: Client.query.filter_by(actif=True).count())
+
+def produits_stock_faible():
+    """Produits actifs dont le stock est au minimum ou en dessous, avec leur suggestion de réapprovisionnement"""
+    def calcul():
+        # Ensemble des alertes tenu à jour à chaque variation du stock (reapprovisionnement.py) :
+        # parcouru en premier, il ne contient que les produits concernés
+        produits = db.session.query(
+            Produit.id, Produit.nom, Produit.stock_actuel, Produit.stock_minimum,
+            AlerteStock.jours_avant_rupture, AlerteStock.quantite_suggeree
+        ).select_from(AlerteStock).join(Produit, Produit.id == AlerteStock.produit_id) \
+         .order_by(Produit.nom).all()
+        return [dict(p._mapping) for p in produits]
+
+    return _memoriser(CLE_STOCK_FAIBLE, calcul)
+
+def ventes_jour():
+    """Total TTC des ventes confirmées du jour"""
+    return _memoriser(_cle_ventes_jour(), lambda: _total_ventes_depuis(_debut_jour()))
+
+def ventes_mois():
+    """Total TTC des ventes confirmées du mois en cours"""
+    return _memoriser(_cle_ventes_mois(), lambda: _total_ventes_depuis(_debut_mois()))
+
+def statistiques():
+    """Toutes les statistiques du tableau de bord"""
+    return {
+        'total_produits': total_produits(),
+        'total_clients': total_clients(),
+        'produits_stock_faible': produits_stock_faible(),
+        'ventes_jour': ventes_jour(),
+        'ventes_mois': ventes_mois(),
+    }
+
+# Invalidation
+
+def invalider_produits():
+    """Après l'ajout ou la suppression d'un produit"""
+    cache.delete(CLE_PRODUITS, CLE_STOCK_FAIBLE)
+
+def invalider_stock():
+    """Après une modification du stock ou du seuil d'un produit, ou un calcul des suggestions"""
+    cache.delete(CLE_STOCK_FAIBLE)
+
+def invalider_clients():
+    """Après l'ajout ou la suppression d'un client"""
+    cache.delete(CLE_CLIENTS)
+
+def invalider_ventes():
+    """Après l'enregistrement d'une vente (totaux et stocks)"""
+    cache.delete(_cle_ventes_jour(), _cle_ventes_mois(), CLE_STOCK_FAIBLE)
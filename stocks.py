@@ -0,0 +1,186 @@
+import click
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+import time
+from sqlalchemy import case, select, func
+from sqlalchemy.exc import DBAPIError
+from . import db, create_app
+from .models import Produit, Client, LigneVente
+from .migrations import appliquer_migrations
+
+# Réservation du stock lors d'une vente.
+# Le stock est décrémenté par un UPDATE conditionnel exécuté en base
+# (WHERE stock_actuel >= :quantite) : la vérification et l'écriture sont
+# atomiques, deux ventes simultanées ne peuvent pas vendre le même article.
+# Tous les produits d'une vente sont réservés par la même requête.
+# `flask mesurer-survente` le vérifie sous charge : des processus postent
+# des ventes concurrentes sur les mêmes produits jusqu'à épuisement.
+
+TENTATIVES = 3
+
+# Codes SQLSTATE PostgreSQL : échec de sérialisation et interblocage
+CODES_REESSAI = ('40001', '40P01')
+
+class StockInsuffisant(Exception):
+    """Le stock d'un produit ne permet pas de servir la quantité demandée"""
+
+    def __init__(self, produit_id, nom=None, disponible=None):
+        self.produit_id = produit_id
+        self.nom = nom
+        self.disponible = disponible
+        if nom is None:
+            message = f'Produit introuvable ou inactif: {produit_id}'
+        else:
+            message = f'Stock insuffisant pour {nom}. Stock disponible: {disponible}'
+        super().__init__(message)
+
+def reserver_stocks(quantites):
+    """Retire du stock les quantités {produit_id: quantité}, ou lève StockInsuffisant
+
+    Un seul UPDATE ... WHERE stock_actuel >= <quantité du produit> pour
+    tous les produits ; RETURNING indique quels produits ont été servis.
+    En cas d'échec la transaction doit être annulée par l'appelant.
+    """
+    if not quantites:
+        return
+    table = Produit.__table__
+    quantite = case(quantites, value=table.c.id)
+    servis = set(db.session.execute(
+        table.update()
+        .where(table.c.id.in_(quantites),
+               table.c.actif == True,
+               table.c.stock_actuel >= quantite)
+        .values(stock_actuel=table.c.stock_actuel - quantite)
+        .returning(table.c.id)
+    ).scalars())
+
+    manquants = sorted(set(quantites) - servis)
+    if manquants:
+        produit_id = manquants[0]
+        produit = db.session.query(Produit.nom, Produit.stock_actuel).filter(
+            Produit.id == produit_id, Produit.actif == True
+        ).first()
+        if produit is None:
+            raise StockInsuffisant(produit_id)
+        raise StockInsuffisant(produit_id, produit.nom, produit.stock_actuel)
+
+def est_erreur_serialisation(erreur):
+    """Vrai si la transaction a échoué à cause d'une écriture concurrente"""
+    if getattr(erreur.orig, 'pgcode', None) in CODES_REESSAI:
+        return True
+    # SQLite : un autre processus détient le verrou d'écriture
+    return 'database is locked' in str(erreur.orig)
+
+def reessayer_transaction(operation, tentatives=TENTATIVES):
+    """Exécute `operation()` et la rejoue après un échec de sérialisation
+
+    `operation` doit faire tout son travail dans db.session (commit
+    compris) : la session est annulée avant chaque nouvelle tentative.
+    """
+    for tentative in range(1, tentatives + 1):
+        try:
+            return operation()
+        except DBAPIError as e:
+            db.session.rollback()
+            if tentative == tentatives or not est_erreur_serialisation(e):
+                raise
+            time.sleep(random.uniform(0, 0.05 * 2 ** tentative))
+
+def _application_banc(base, dossier):
+    """Application du banc sur `base` : PDF rendus à la demande, ni mesures ni réplica"""
+    os.environ.update(DATABASE_URL=base, PDF_FACTURES_DIR=os.path.join(dossier, 'pdf'),
+                      ANALYSES_DIR=os.path.join(dossier, 'analyses'), PDF_PROCESSUS='0', METRIQUES='0')
+    os.environ.pop('DATABASE_REPLICA_URL', None)
+    os.environ.pop('CACHE_URL', None)
+    return create_app()
+
+def _banc_processus(base, dossier, client_id, quantites, ventes, barriere, resultats):
+    """Processus du banc : poste `ventes` ventes par le formulaire et compte leurs issues"""
+    try:
+        client = _application_banc(base, dossier).test_client()
+        formulaire = {'client_id': str(client_id), 'produit_id': [str(i) for i in quantites],
+                      'quantite': [str(q) for q in quantites.values()]}
+        comptes = {'enregistrees': 0, 'refusees': 0, 'erreurs': 0}
+        barriere.wait()
+
+        debut = time.perf_counter()
+        for _ in range(ventes):
+            destination = client.post('/ventes/nouvelle', data=formulaire).headers.get('Location', '')
+            if '/factures/' in destination:
+                comptes['enregistrees'] += 1
+            elif destination.endswith('/ventes/nouvelle'):
+                comptes['refusees'] += 1  # stock insuffisant
+            else:
+                comptes['erreurs'] += 1
+        resultats.put((comptes, time.perf_counter() - debut, None))
+    except Exception as e:
+        resultats.put((None, 0, str(e)))
+
+@click.command('mesurer-survente')
+@click.option('--processus', default=12, show_default=True, help='Processus concurrents (workers gunicorn).')
+@click.option('--ventes', default=20, show_default=True, help='Ventes postées par processus.')
+@click.option('--stock', default=200, show_default=True, help='Stock initial de chacun des deux produits.')
+@click.option('--base', help='Base vide de l\'essai (par défaut une base SQLite temporaire).')
+def mesurer_survente_commande(processus, ventes, stock, base):
+    """Vérifie que des ventes concurrentes ne vendent jamais plus que le stock"""
+    dossier = tempfile.mkdtemp()
+    base = base or 'sqlite:///' + os.path.join(dossier, 'banc.db')
+    app = _application_banc(base, dossier)
+
+    try:
+        with app.app_context():
+            appliquer_migrations()
+            produits = [Produit(nom=f'Banc survente {rang}', prix_unitaire=1000, stock_actuel=stock)
+                        for rang in (1, 2)]
+            client = Client(nom='Banc survente')
+            db.session.add_all(produits + [client])
+            db.session.commit()
+            # Chaque vente prend 3 unités du premier produit et 1 du second
+            quantites = {produits[0].id: 3, produits[1].id: 1}
+            client_id = client.id
+
+        contexte = multiprocessing.get_context('spawn')
+        barriere = contexte.Barrier(processus)
+        resultats = contexte.Queue()
+        travailleurs = [
+            contexte.Process(target=_banc_processus,
+                             args=(base, dossier, client_id, quantites, ventes, barriere, resultats))
+            for _ in range(processus)
+        ]
+        for travailleur in travailleurs:
+            travailleur.start()
+        mesures = [resultats.get() for _ in travailleurs]
+        for travailleur in travailleurs:
+            travailleur.join()
+        erreurs = [erreur for _, _, erreur in mesures if erreur]
+        if erreurs:
+            raise click.ClickException(f'Échec d\'un processus du banc : {erreurs[0]}')
+
+        total = {cle: sum(comptes[cle] for comptes, _, _ in mesures) for cle in mesures[0][0]}
+        duree = max(duree for _, duree, _ in mesures)
+        click.echo(f"{total['enregistrees']} vente(s) enregistrée(s), {total['refusees']} refusée(s) "
+                   f"pour stock insuffisant, {total['erreurs']} en erreur, en {duree:.2f} s")
+
+        with app.app_context():
+            vendus = dict(db.session.execute(
+                select(LigneVente.produit_id, func.sum(LigneVente.quantite))
+                .where(LigneVente.produit_id.in_(quantites)).group_by(LigneVente.produit_id)
+            ).all())
+            incoherents = []
+            for produit_id, quantite in quantites.items():
+                restant = db.session.get(Produit, produit_id).stock_actuel
+                vendu = vendus.get(produit_id, 0)
+                click.echo(f'produit {produit_id} : stock {stock} -> {restant}, {vendu} vendu(s)')
+                if restant < 0 or stock - restant != vendu or vendu != quantite * total['enregistrees']:
+                    incoherents.append(produit_id)
+        if incoherents:
+            raise click.ClickException(f'Stock incohérent avec les ventes enregistrées : produit(s) {incoherents}')
+        click.echo('Aucune survente : le stock vendu correspond aux ventes enregistrées.')
+    finally:
+        with app.app_context():
+            for moteur in db.engines.values():
+                moteur.dispose()
+        shutil.rmtree(dossier)
@@ -0,0 +1,122 @@
+import click
+import logging
+import time
+from datetime import datetime, timedelta
+from flask.cli import with_appcontext
+from sqlalchemy import select, update, delete, func
+from . import db
+from .models import Facture, ExecutionTache
+from .analyses import exporter_analyses
+from .mouvements import cloturer_stocks
+from .pdf_factures import invalider_pdfs
+from .reapprovisionnement import traiter_alertes
+
+# Tâches de fond.
+# Les travaux périodiques sont exécutés hors des requêtes par `flask taches` :
+# une passe (tâche planifiée, cron) exécute les tâches dues ; avec --boucle,
+# la commande devient un worker (ligne `worker` du Procfile) qui les exécute
+# à leur intervalle. Chaque exécution est enregistrée dans executions_taches
+# (début, durée, lignes traitées, erreur) ; une tâche en échec est reprise à
+# la passe suivante. Les tâches sont idempotentes : deux workers peuvent
+# tourner en même temps sans effet de bord.
+# - Historique borné : chaque exécution supprime celles de sa tâche plus
+#   anciennes que RETENTION (index (tache, debut)) ; la table garde environ
+#   1 500 lignes par jour de rétention.
+
+PAUSE = 60  # secondes entre deux passes du worker
+RETENTION = timedelta(days=30)  # historique gardé des exécutions de chaque tâche
+
+def marquer_factures_en_retard(maintenant=None):
+    """Passe en retard les factures impayées dont l'échéance est dépassée ; retourne leur nombre
+
+    Un seul UPDATE, servi par l'index (statut, date_echeance).
+    """
+    factures_ids = db.session.execute(
+        update(Facture)
+        .where(Facture.statut == 'impayée', Facture.date_echeance < (maintenant or datetime.utcnow()))
+        .values(statut='en_retard')
+        .returning(Facture.id)
+        .execution_options(synchronize_session=False)
+    ).scalars().all()
+    db.session.commit()
+    # Le statut est imprimé sur le PDF
+    invalider_pdfs(factures_ids)
+    return len(factures_ids)
+
+TACHES = {
+    # nom: (fonction retournant le nombre de lignes traitées, intervalle)
+    'factures-en-retard': (marquer_factures_en_retard, timedelta(minutes=15)),
+    'cloturer-stocks': (cloturer_stocks, timedelta(days=1)),
+    'exporter-analyses': (exporter_analyses, timedelta(minutes=15)),
+    'reapprovisionnement': (traiter_alertes, timedelta(minutes=1)),
+}
+
+def dernieres_executions():
+    """Dernière exécution enregistrée de chaque tâche"""
+    dernieres = select(ExecutionTache.tache, func.max(ExecutionTache.id).label('id')) \
+        .group_by(ExecutionTache.tache).subquery()
+    executions = ExecutionTache.query.join(dernieres, dernieres.c.id == ExecutionTache.id).all()
+    return {execution.tache: execution for execution in executions}
+
+def taches_dues(maintenant=None):
+    """Tâches en échec ou dont la dernière exécution date de plus que leur intervalle"""
+    maintenant = maintenant or datetime.utcnow()
+    dernieres = dernieres_executions()
+    return [
+        nom for nom, (_, intervalle) in TACHES.items()
+        if nom not in dernieres or dernieres[nom].erreur is not None
+        or dernieres[nom].debut + intervalle <= maintenant
+    ]
+
+def executer_tache(nom):
+    """Exécute une tâche et enregistre son exécution ; retourne l'enregistrement"""
+    fonction, _ = TACHES[nom]
+    debut = datetime.utcnow()
+    chrono = time.perf_counter()
+    lignes, erreur = None, None
+    try:
+        lignes = fonction()
+    except Exception as e:
+        db.session.rollback()
+        erreur = str(e)
+        logging.getLogger(__name__).exception('Échec de la tâche %s', nom)
+
+    execution = ExecutionTache(tache=nom, debut=debut, duree=time.perf_counter() - chrono,
+                               lignes=lignes, erreur=erreur)
+    db.session.add(execution)
+    # L'exécution enregistrée reste la dernière de la tâche
+    db.session.execute(delete(ExecutionTache).where(ExecutionTache.tache == nom,
+                                                    ExecutionTache.debut < debut - RETENTION)
+                       .execution_options(synchronize_session=False))
+    db.session.commit()
+    return execution
+
+@click.command('taches')
+@click.option('--boucle', is_flag=True, help='Exécute les tâches à leur intervalle jusqu\'à l\'arrêt (worker).')
+@click.option('--toutes', is_flag=True, help='Exécute toutes les tâches, dues ou non.')
+@click.option('--etat', is_flag=True, help='Affiche la dernière exécution de chaque tâche.')
+@with_appcontext
+def taches_commande(boucle, toutes, etat):
+    """Exécute les tâches de fond dues (factures en retard, soldes de stock, alertes de stock)"""
+    if etat:
+        dernieres = dernieres_executions()
+        for nom in TACHES:
+            execution = dernieres.get(nom)
+            if execution is None:
+                click.echo(f'{nom}: jamais exécutée')
+            else:
+                resultat = execution.erreur or f'{execution.lignes} ligne(s)'
+                click.echo(f'{nom}: {execution.debut:%Y-%m-%d %H:%M:%S} UTC, '
+                           f'{execution.duree:.2f} s, {resultat}')
+        return
+
+    while True:
+        for nom in (list(TACHES) if toutes else taches_dues()):
+            execution = executer_tache(nom)
+            resultat = f'échec ({execution.erreur})' if execution.erreur else f'{execution.lignes} ligne(s)'
+            click.echo(f'{nom}: {resultat} en {execution.duree:.2f} s')
+        if not boucle:
+            break
+        # Pas de connexion gardée entre deux passes
+        db.session.remove()
+        time.sleep(PAUSE)
@@ -0,0 +1,54 @@
+import pytest
+from sqlalchemy import event
+from app import create_app, db
+from app.migrations import appliquer_migrations
+
+# Tests sur des bases SQLite temporaires, une par application créée.
+# `application` : base vide, sans migration ; `base` : base migrée ;
+# `instructions` : instructions SQL exécutées par la base migrée.
+
+@pytest.fixture
+def fabrique(tmp_path, monkeypatch):
+    """Crée des applications, chacune sur sa propre base SQLite temporaire"""
+    monkeypatch.setenv('PDF_PROCESSUS', '0')
+    monkeypatch.setenv('METRIQUES', '0')
+    applications = []
+
+    def creer(nom='test'):
+        monkeypatch.setenv('DATABASE_URL', f'sqlite:///{tmp_path / nom}.db')
+        monkeypatch.setenv('PDF_FACTURES_DIR', str(tmp_path / nom / 'factures_pdf'))
+        monkeypatch.setenv('ANALYSES_DIR', str(tmp_path / nom / 'analyses'))
+        app = create_app()
+        app.config['TESTING'] = True
+        applications.append(app)
+        return app
+
+    yield creer
+    for app in applications:
+        with app.app_context():
+            for moteur in db.engines.values():
+                moteur.dispose()
+
+@pytest.fixture
+def application(fabrique):
+    app = fabrique()
+    with app.app_context():
+        yield app
+        db.session.remove()
+
+@pytest.fixture
+def base(application):
+    appliquer_migrations()
+    return application
+
+@pytest.fixture
+def instructions(base):
+    """Instructions (texte, paramètres) exécutées sur la base pendant le test"""
+    releve = []
+
+    def relever(connexion, curseur, instruction, parametres, contexte, executemany):
+        releve.append((instruction, parametres))
+
+    event.listen(db.engine, 'after_cursor_execute', relever)
+    yield releve
+    event.remove(db.engine, 'after_cursor_execute', relever)
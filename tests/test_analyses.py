@@ -0,0 +1,56 @@
+import numpy as np
+from sqlalchemy import select, insert, update, func
+from app import db
+from app import analyses
+from app.generation import generer_donnees
+from app.models import LigneVente, Vente
+
+# Export incrémental de l'entrepôt : lignes validées après l'export suivant.
+
+def _total_confirme():
+    return db.session.execute(select(func.sum(LigneVente.sous_total)).join(Vente)
+                              .where(Vente.statut == 'confirmée')).scalar()
+
+def test_lignes_validees_en_retard_exportees(base):
+    generer_donnees(nb_produits=20, nb_clients=20, nb_lignes=500, jours=30)
+    vente_id, produit_id = db.session.execute(select(LigneVente.vente_id, LigneVente.produit_id)).first()
+    db.session.commit()
+
+    with db.engine.connect() as autre:
+        # Lignes écrites par une transaction encore en cours pendant l'export
+        retardees = [{'vente_id': vente_id, 'produit_id': produit_id, 'quantite': 1,
+                      'prix_unitaire': 100, 'sous_total': 100} for _ in range(3)]
+        autre.execute(insert(LigneVente), retardees)
+        analyses.exporter_analyses()
+        db.session.rollback()
+        autre.commit()
+
+    # Une vente annulée entre les deux exports : le nombre de lignes ne suffit pas à détecter le retard
+    annulee = db.session.execute(select(func.max(Vente.id)).where(Vente.id != vente_id)).scalar()
+    db.session.execute(update(Vente).where(Vente.id == annulee).values(statut='annulée'))
+    db.session.commit()
+    assert analyses.exporter_analyses() == len(retardees)
+
+    en_base = db.session.execute(select(LigneVente.id).order_by(LigneVente.id)).scalars().all()
+    e = analyses.entrepot()
+    assert sorted(e.colonnes['ligne'].tolist()) == en_base
+    assert np.isclose(e.colonnes['montant_ht'][e.colonnes['confirmee']].sum(), _total_confirme())
+
+    # Rien de nouveau : l'export suivant n'ajoute aucune ligne
+    assert analyses.exporter_analyses() == 0
+    assert len(analyses.entrepot()) == len(en_base)
+
+def test_lignes_relues_non_dupliquees(base, monkeypatch):
+    generer_donnees(nb_produits=20, nb_clients=20, nb_lignes=200, jours=30)
+    nombre = db.session.execute(select(func.count()).select_from(LigneVente)).scalar()
+
+    # Position en retard sur les lignes lues (transactions encore en
+    # cours sous PostgreSQL) : toutes les lignes sont relues au suivant
+    with monkeypatch.context() as m:
+        m.setattr(analyses, '_position_export', lambda: 1)
+        assert analyses.exporter_analyses() == nombre
+    assert len(analyses.entrepot().meta['relues']) == nombre
+
+    assert analyses.exporter_analyses() == 0
+    assert len(analyses.entrepot()) == nombre
+    assert analyses.entrepot().meta['relues'] == []
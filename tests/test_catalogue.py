@@ -0,0 +1,48 @@
+from sqlalchemy import update
+from sqlalchemy.dialects import postgresql
+from app import db
+from app.catalogue import catalogue
+from app.models import Produit, prochaine_version
+
+# Synchronisation du formulaire de vente : écritures validées en retard.
+
+def _produits():
+    produits = [Produit(nom=f'Produit {i}', prix_unitaire=100, stock_actuel=10) for i in range(3)]
+    db.session.add_all(produits)
+    db.session.commit()
+    return [produit.id for produit in produits]
+
+def test_ecriture_validee_apres_la_synchronisation(base):
+    ids = _produits()
+    with db.engine.connect() as autre:
+        # Écriture en cours dans une autre transaction pendant la synchronisation
+        autre.execute(update(Produit.__table__).where(Produit.id == ids[0]).values(prix_unitaire=150))
+        synchro = catalogue()
+        db.session.rollback()
+        assert [ids[0], 'Produit 0', 100, 10] in synchro['produits']
+        autre.commit()
+
+    delta = catalogue(synchro['version'])
+    assert delta['produits'] == [[ids[0], 'Produit 0', 150, 10]]
+    assert not delta['complet']
+    db.session.rollback()
+    assert catalogue(delta['version'])['produits'] == []
+
+def test_etag_change_apres_une_ecriture(base):
+    ids = _produits()
+    client = base.test_client()
+    premiere = client.get('/produits/api/catalogue')
+    etag = premiere.headers['ETag']
+    assert client.get('/produits/api/catalogue', headers={'If-None-Match': etag}).status_code == 304
+
+    db.session.execute(update(Produit.__table__).where(Produit.id == ids[1]).values(stock_actuel=4))
+    db.session.commit()
+    reponse = client.get(f"/produits/api/catalogue?depuis={premiere.json['version']}",
+                         headers={'If-None-Match': etag})
+    assert reponse.status_code == 200
+    assert reponse.json['produits'] == [[ids[1], 'Produit 1', 100, 4]]
+
+def test_version_postgresql_de_la_transaction():
+    # Sous PostgreSQL, la version suit l'ordre des commits : identifiant de la transaction
+    sql = str(prochaine_version().compile(dialect=postgresql.dialect()))
+    assert sql == 'pg_current_xact_id()::text::bigint'
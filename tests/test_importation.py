@@ -0,0 +1,103 @@
+import json
+import pytest
+from sqlalchemy import select, func
+from app import db
+from app.importation import importer_ventes, lire_ventes, importer_ventes_commande
+from app.models import Produit, Client, Vente, MouvementStock
+
+# Import en masse des ventes des caisses.
+
+@pytest.fixture
+def catalogue_import(base):
+    """Un client et deux produits ; retourne (client_id, riz_id, huile_id)"""
+    client = Client(nom='Rakoto')
+    riz = Produit(nom='Riz', prix_unitaire=1000, stock_actuel=10)
+    huile = Produit(nom='Huile', prix_unitaire=2500, stock_actuel=3)
+    db.session.add_all([client, riz, huile])
+    db.session.commit()
+    return client.id, riz.id, huile.id
+
+def _flux(*ventes):
+    return [json.dumps(vente) + '\n' for vente in ventes]
+
+def _importer(flux):
+    return list(importer_ventes(lire_ventes(flux, 'jsonl')))
+
+def _compter(modele):
+    return db.session.execute(select(func.count()).select_from(modele)).scalar()
+
+def test_flux_renvoye_sans_doublon(catalogue_import):
+    client_id, riz_id, _ = catalogue_import
+    flux = _flux(*({'reference': f'CAISSE1-{i}', 'client_id': client_id,
+                    'lignes': [{'produit_id': riz_id, 'quantite': 1}]} for i in range(3)))
+    premier = _importer(flux)
+    assert [r['statut'] for r in premier] == ['importée'] * 3
+
+    # La caisse renvoie le flux (délai dépassé) : rien n'est réimporté
+    second = _importer(flux)
+    assert [r['statut'] for r in second] == ['déjà importée'] * 3
+    assert [(r['vente_id'], r['facture_id']) for r in second] == \
+        [(r['vente_id'], r['facture_id']) for r in premier]
+    assert _compter(Vente) == 3
+    assert db.session.get(Produit, riz_id).stock_actuel == 7
+    assert _compter(MouvementStock) == 3
+
+def test_reference_repetee_dans_le_flux(catalogue_import):
+    client_id, riz_id, _ = catalogue_import
+    vente = {'reference': 'CAISSE1-1', 'client_id': client_id, 'lignes': [{'produit_id': riz_id, 'quantite': 2}]}
+    resultats = _importer(_flux(vente, vente))
+    assert [r['statut'] for r in resultats] == ['importée', 'déjà importée']
+    assert resultats[1]['vente_id'] == resultats[0]['vente_id']
+    assert db.session.get(Produit, riz_id).stock_actuel == 8
+
+def test_rapport_par_enregistrement(catalogue_import):
+    client_id, riz_id, huile_id = catalogue_import
+    flux = _flux(
+        {'reference': 'A', 'client_id': client_id, 'lignes': [{'produit_id': riz_id, 'quantite': 2}]},
+        {'reference': 'B', 'client_id': 999, 'lignes': [{'produit_id': riz_id, 'quantite': 1}]},
+        {'reference': 'C', 'client_id': client_id, 'lignes': [{'produit_id': huile_id, 'quantite': 5}]},
+        {'reference': 'D', 'client_id': client_id, 'lignes': []},
+    ) + ['{pas du json\n']
+    resultats = _importer(flux)
+
+    assert [(r['ligne'], r['reference'], r['statut']) for r in resultats] == [
+        (1, 'A', 'importée'), (2, 'B', 'rejetée'), (3, 'C', 'rejetée'), (4, 'D', 'rejetée'), (5, None, 'rejetée')]
+    assert resultats[0]['numero_vente'] and resultats[0]['facture_id']
+    assert resultats[1]['erreur'] == 'Client introuvable ou inactif: 999'
+    assert resultats[2]['erreur'] == 'Stock insuffisant pour Huile. Stock disponible: 3'
+    assert resultats[3]['erreur'] == 'Vente sans ligne'
+    assert resultats[4]['erreur'].startswith('JSON invalide')
+    # Seule la vente acceptée a touché au stock
+    assert [db.session.get(Produit, i).stock_actuel for i in (riz_id, huile_id)] == [8, 3]
+
+def test_stock_affecte_dans_l_ordre_du_lot(catalogue_import):
+    client_id, _, huile_id = catalogue_import
+    vente = {'client_id': client_id, 'lignes': [{'produit_id': huile_id, 'quantite': 2}]}
+    resultats = _importer(_flux(vente, vente))
+    assert [r['statut'] for r in resultats] == ['importée', 'rejetée']
+    assert resultats[1]['erreur'] == 'Stock insuffisant pour Huile. Stock disponible: 1'
+
+def test_api_bulk_csv(catalogue_import, base):
+    client_id, riz_id, huile_id = catalogue_import
+    corps = ('reference,client_id,date_vente,taux_tva,notes,produit_id,quantite,prix_unitaire\n'
+             f'T1,{client_id},2024-05-02T10:00:00,20,,{riz_id},1,\n'
+             f'T1,{client_id},2024-05-02T10:00:00,20,,{huile_id},1,2000\n'
+             f'T2,{client_id},,,,{riz_id},0,\n')
+    reponse = base.test_client().post('/ventes/api/bulk', data=corps, content_type='text/csv')
+    rapport = reponse.get_json()
+    assert (rapport['importees'], rapport['deja_importees'], rapport['rejetees']) == (1, 0, 1)
+    vente = db.session.get(Vente, rapport['resultats'][0]['vente_id'])
+    assert (vente.reference, vente.total_ht) == ('T1', 3000)
+    assert rapport['resultats'][1]['erreur'] == 'quantite invalide: 0'
+
+def test_commande_cli(catalogue_import, base, tmp_path):
+    client_id, riz_id, _ = catalogue_import
+    fichier = tmp_path / 'ventes.jsonl'
+    fichier.write_text(''.join(_flux(
+        {'reference': 'F1', 'client_id': client_id, 'lignes': [{'produit_id': riz_id, 'quantite': 1}]},
+        {'reference': 'F2', 'client_id': 999, 'lignes': [{'produit_id': riz_id, 'quantite': 1}]})),
+        encoding='utf-8')
+    sortie = base.test_cli_runner().invoke(importer_ventes_commande, [str(fichier)])
+    assert sortie.exit_code == 0, sortie.output
+    assert '1 ventes importées, 0 déjà importées, 1 rejetées' in sortie.output
+    assert 'Ligne 2: Client introuvable ou inactif: 999' in sortie.output
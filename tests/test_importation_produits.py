@@ -0,0 +1,44 @@
+from sqlalchemy import select, update
+from app import db
+from app import importation_produits
+from app.importation_produits import importer_produits
+from app.models import Produit, MouvementStock
+
+# Inventaire importé pendant une vente : écart inscrit au registre.
+
+def _produit(stock):
+    produit = Produit(code_produit='RIZ-25', nom='Riz 25 kg', prix_unitaire=50000, stock_actuel=stock)
+    db.session.add(produit)
+    db.session.commit()
+    return produit.id
+
+def _ajustements(produit_id):
+    return db.session.execute(select(MouvementStock.quantite).where(
+        MouvementStock.produit_id == produit_id, MouvementStock.type_mouvement == 'ajustement')).scalars().all()
+
+def test_inventaire_ecart_au_stock_remplace(base):
+    produit_id = _produit(10)
+    resultats = list(importer_produits([(2, {'code_produit': 'RIZ-25', 'stock_actuel': '25',
+                                              'prix_unitaire': '52000'})]))
+    assert resultats[0]['modifications'] == {'prix_unitaire': [50000, 52000], 'stock_actuel': [10, 25]}
+    assert _ajustements(produit_id) == [15]
+    assert db.session.get(Produit, produit_id).prix_unitaire == 52000
+
+def test_vente_concurrente_entre_lecture_et_ecriture(base, monkeypatch):
+    produit_id = _produit(10)
+    remplacer = importation_produits._remplacer_stocks
+
+    def vente_concurrente(stocks):
+        # Vente de 4 validée par une autre connexion après la lecture du stock
+        with db.engine.begin() as autre:
+            autre.execute(update(Produit.__table__).where(Produit.id == produit_id)
+                          .values(stock_actuel=Produit.stock_actuel - 4))
+        return remplacer(stocks)
+
+    monkeypatch.setattr(importation_produits, '_remplacer_stocks', vente_concurrente)
+    resultats = list(importer_produits([(2, {'code_produit': 'RIZ-25', 'stock_actuel': '25'})]))
+
+    assert db.session.get(Produit, produit_id).stock_actuel == 25
+    # L'écart part du stock après la vente, pas du stock lu
+    assert _ajustements(produit_id) == [19]
+    assert resultats[0]['modifications'] == {'stock_actuel': [6, 25]}
@@ -0,0 +1,29 @@
+from datetime import datetime
+from app import db
+from app.generation import generer_donnees
+
+# Plans d'exécution (EXPLAIN QUERY PLAN de SQLite) des requêtes du tableau
+# de bord et des rapports : aucune ne parcourt entièrement une grande table.
+# Un parcours d'index (SCAN ... USING INDEX) est accepté : il ne lit que
+# les lignes de l'index partiel ou s'arrête à la première page.
+
+GRANDES_TABLES = {'produits', 'clients', 'ventes', 'lignes_vente', 'factures', 'mouvements_stock'}
+PAGES = ['/', '/rapports', f'/rapports?periode={datetime.now():%Y-%m}']
+
+def _parcours_complets(sql, parametres):
+    plan = db.session.connection().exec_driver_sql('EXPLAIN QUERY PLAN ' + sql, parametres).all()
+    return [ligne.detail for ligne in plan
+            if ligne.detail.startswith('SCAN ') and ligne.detail.split()[1] in GRANDES_TABLES
+            and 'INDEX' not in ligne.detail]
+
+def test_tableau_de_bord_et_rapports_utilisent_les_index(base, instructions):
+    generer_donnees(nb_produits=200, nb_clients=300, nb_lignes=3000, jours=90)
+    client = base.test_client()
+    for page in PAGES:
+        instructions.clear()
+        assert client.get(page).status_code == 200, page
+        requetes = [(sql, parametres) for sql, parametres in instructions
+                    if sql.lstrip().upper().startswith('SELECT')]
+        assert requetes, page
+        for sql, parametres in requetes:
+            assert _parcours_complets(sql, parametres) == [], f'{page}: {sql}'
@@ -0,0 +1,78 @@
+from sqlalchemy import inspect, text
+from app import db
+from app.migrations import appliquer_migrations, MIGRATIONS
+
+# Schéma créé par db.create_all() avant les migrations versionnées
+SCHEMA_ORIGINE = """
+CREATE TABLE clients (
+    id INTEGER NOT NULL, nom VARCHAR(100) NOT NULL, email VARCHAR(120), telephone VARCHAR(20),
+    adresse TEXT, ville VARCHAR(50), code_postal VARCHAR(10), date_creation DATETIME, actif BOOLEAN,
+    PRIMARY KEY (id)
+);
+CREATE TABLE produits (
+    id INTEGER NOT NULL, nom VARCHAR(100) NOT NULL, description TEXT, prix_unitaire FLOAT NOT NULL,
+    stock_actuel INTEGER, stock_minimum INTEGER, categorie VARCHAR(50), code_produit VARCHAR(50),
+    date_creation DATETIME, actif BOOLEAN,
+    PRIMARY KEY (id), UNIQUE (code_produit)
+);
+CREATE TABLE ventes (
+    id INTEGER NOT NULL, numero_vente VARCHAR(50) NOT NULL, client_id INTEGER NOT NULL,
+    date_vente DATETIME, total_ht FLOAT, taux_tva FLOAT, total_ttc FLOAT, statut VARCHAR(20), notes TEXT,
+    PRIMARY KEY (id), UNIQUE (numero_vente), FOREIGN KEY(client_id) REFERENCES clients (id)
+);
+CREATE TABLE factures (
+    id INTEGER NOT NULL, numero_facture VARCHAR(50) NOT NULL, vente_id INTEGER NOT NULL,
+    date_facture DATETIME, date_echeance DATETIME, statut VARCHAR(20), notes TEXT,
+    PRIMARY KEY (id), UNIQUE (numero_facture), FOREIGN KEY(vente_id) REFERENCES ventes (id)
+);
+CREATE TABLE lignes_vente (
+    id INTEGER NOT NULL, vente_id INTEGER NOT NULL, produit_id INTEGER NOT NULL, quantite INTEGER NOT NULL,
+    prix_unitaire FLOAT NOT NULL, sous_total FLOAT NOT NULL,
+    PRIMARY KEY (id), FOREIGN KEY(vente_id) REFERENCES ventes (id),
+    FOREIGN KEY(produit_id) REFERENCES produits (id)
+);
+INSERT INTO clients (id, nom, ville, actif) VALUES (1, 'Rakoto', 'Antananarivo', 1);
+INSERT INTO produits (id, nom, prix_unitaire, stock_actuel, stock_minimum, code_produit, actif)
+    VALUES (1, 'Riz', 1000, 3, 5, 'P1', 1), (2, 'Huile', 2500, 40, 5, 'P2', 1);
+INSERT INTO ventes (id, numero_vente, client_id, date_vente, total_ht, taux_tva, total_ttc, statut, notes)
+    VALUES (1, 'VTE-20240502-0001', 1, '2024-05-02 10:15:00', 4500, 20, 5400, 'confirmée', ''),
+           (2, 'VTE-20240610-0001', 1, '2024-06-10 09:00:00', 1000, 20, 1200, 'confirmée', ''),
+           (3, 'VTE-20240520-0001', 1, '2024-05-20 16:30:00', 500, 20, 600, 'annulée', '');
+INSERT INTO lignes_vente (vente_id, produit_id, quantite, prix_unitaire, sous_total)
+    VALUES (1, 1, 2, 1000, 2000), (1, 2, 1, 2500, 2500);
+INSERT INTO factures (id, numero_facture, vente_id, date_facture, statut)
+    VALUES (1, 'FACT-2024-0001', 1, '2024-05-02 10:15:00', 'impayée');
+"""
+
+def test_migration_d_une_base_d_origine(application):
+    """Une base créée avant les migrations passe à la dernière version sans perte"""
+    with db.engine.begin() as connexion:
+        for instruction in SCHEMA_ORIGINE.split(';'):
+            if instruction.strip():
+                connexion.exec_driver_sql(instruction)
+
+    assert appliquer_migrations() == [version for version, _, _ in MIGRATIONS]
+
+    index = {i['name'] for i in inspect(db.engine).get_indexes('produits')}
+    assert {'ix_produits_version', 'ix_produits_actifs_nom', 'ix_produits_stock_faible'} <= index
+    assert db.session.execute(text('SELECT id, version FROM produits ORDER BY id')).all() == [(1, 1), (2, 2)]
+    assert db.session.execute(text('SELECT produit_id FROM alertes_stock')).scalars().all() == [1]
+    assert db.session.execute(text('SELECT client_nom, total_ttc FROM factures')).one() == ('Rakoto', 5400)
+    assert db.session.execute(text('SELECT count(*) FROM classement_produits')).scalar() > 0
+    # Cumuls mensuels des ventes confirmées, sans la vente annulée
+    assert db.session.execute(text('SELECT mois, total_ht, total_ttc, nb_ventes FROM ventes_mensuelles '
+                                   'ORDER BY mois')).all() == [('2024-05', 4500, 5400, 1),
+                                                               ('2024-06', 1000, 1200, 1)]
+
+def test_migrations_idempotentes(base):
+    """Une base à jour n'a plus de migration à appliquer"""
+    assert appliquer_migrations() == []
+
+def test_schema_conforme_aux_modeles(base):
+    """Les migrations créent toutes les tables, colonnes et index des modèles"""
+    inspection = inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        colonnes = {c['name'] for c in inspection.get_columns(table.name)}
+        assert set(table.c.keys()) <= colonnes, table.name
+        index = {i['name'] for i in inspection.get_indexes(table.name)}
+        assert {i.name for i in table.indexes} <= index, table.name
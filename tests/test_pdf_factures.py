@@ -0,0 +1,30 @@
+import os
+import threading
+from app import utils
+
+# Écriture concurrente du PDF d'une facture : threads du pool de rendu.
+
+def test_ecriture_concurrente_d_une_facture(tmp_path, monkeypatch):
+    contenus = {i: bytes([i]) * 200_000 for i in range(8)}
+    monkeypatch.setattr(utils, 'generer_facture_pdf', lambda donnees: contenus[donnees])
+    chemin = str(tmp_path / 'FAC-000001.pdf')
+    depart = threading.Barrier(len(contenus))
+    erreurs = []
+
+    def ecrire(i):
+        depart.wait()
+        try:
+            utils.ecrire_facture_pdf(i, chemin)
+        except Exception as e:
+            erreurs.append(e)
+
+    threads = [threading.Thread(target=ecrire, args=(i,)) for i in contenus]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert erreurs == []
+    with open(chemin, 'rb') as fichier:
+        assert fichier.read() in contenus.values()
+    assert os.listdir(tmp_path) == ['FAC-000001.pdf']
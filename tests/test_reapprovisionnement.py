@@ -0,0 +1,44 @@
+import json
+from app import db
+from app import reapprovisionnement
+from app.models import Notification
+
+# Envoi des notifications : réservation, envois hors transaction, résultats.
+
+def _notification(nom):
+    return Notification(type=reapprovisionnement.TYPE_STOCK_FAIBLE,
+                        contenu=json.dumps({'nom': nom, 'stock_actuel': 1, 'stock_minimum': 5}))
+
+def test_envois_hors_transaction(base, monkeypatch):
+    db.session.add_all([_notification('A'), _notification('B')])
+    db.session.commit()
+    envois = []
+
+    def envoyer(url, type_, contenu):
+        # Le lot est réservé et validé : aucun verrou n'est tenu pendant l'appel
+        assert not db.session().in_transaction()
+        envois.append(contenu['nom'])
+        if contenu['nom'] == 'B':
+            raise OSError('webhook injoignable')
+
+    monkeypatch.setattr(reapprovisionnement, '_envoyer', envoyer)
+    assert reapprovisionnement.envoyer_notifications() == 1
+    assert envois == ['A', 'B']
+
+    notifications = db.session.execute(db.select(Notification).order_by(Notification.id)).scalars().all()
+    assert [(n.tentatives, n.date_envoi is not None, n.erreur, n.reservee_jusqua) for n in notifications] == [
+        (1, True, None, None), (1, False, 'webhook injoignable', None)]
+
+    # L'envoi en échec est repris à la passe suivante
+    envois.clear()
+    assert reapprovisionnement.envoyer_notifications() == 0
+    assert envois == ['B']
+
+def test_reservation_en_cours_non_reprise(base, monkeypatch):
+    db.session.add(_notification('A'))
+    db.session.commit()
+    assert len(reapprovisionnement._reserver_notifications(10)) == 1
+
+    # Un autre worker ne reprend pas une notification réservée
+    monkeypatch.setattr(reapprovisionnement, '_envoyer', lambda *args: None)
+    assert reapprovisionnement.envoyer_notifications() == 0
@@ -0,0 +1,14 @@
+import time
+from app.replicas import routage
+
+# Repli sur la base principale quand une lecture échoue sur le réplica.
+
+def test_vue_rejouee_sur_la_base_principale(base, fabrique, tmp_path, monkeypatch):
+    # Réplica sans schéma : toute lecture y échoue (« no such table »)
+    monkeypatch.setenv('DATABASE_REPLICA_URL', f"sqlite:///{tmp_path / 'replica.db'}")
+    monkeypatch.setattr(routage, 'indisponible_jusqua', 0.0)
+    app = fabrique()
+
+    reponse = app.test_client().get('/produits/')
+    assert reponse.status_code == 200
+    assert routage.indisponible_jusqua > time.monotonic()
@@ -0,0 +1,54 @@
+import base64
+import json
+from sqlalchemy import event
+from app import db
+from app.generation import generer_donnees
+from app.migrations import appliquer_migrations
+
+# Nombre d'instructions SQL des pages de liste : chargement des relations
+# en jointure (requetes.py), il ne dépend pas du nombre de lignes affichées.
+
+PAGES = ['/produits/', '/clients/', '/ventes/', '/factures']
+VOLUMES = {'petite': (60, 60, 400), 'grande': (400, 400, 4000)}
+
+def _compter(app, nb_produits, nb_clients, nb_lignes):
+    """Nombre d'instructions exécutées par chaque page, sur une base générée"""
+    with app.app_context():
+        appliquer_migrations()
+        generer_donnees(nb_produits=nb_produits, nb_clients=nb_clients, nb_lignes=nb_lignes, jours=60)
+        compteur = [0]
+
+        def compter(connexion, curseur, instruction, parametres, contexte, executemany):
+            compteur[0] += 1
+
+        client = app.test_client()
+        nombres = {}
+        event.listen(db.engine, 'after_cursor_execute', compter)
+        try:
+            for page in PAGES:
+                compteur[0] = 0
+                assert client.get(page).status_code == 200, page
+                nombres[page] = compteur[0]
+        finally:
+            event.remove(db.engine, 'after_cursor_execute', compter)
+            db.session.remove()
+        return nombres
+
+def test_instructions_par_page_independantes_du_volume(fabrique):
+    petite, grande = (_compter(fabrique(nom), *volumes) for nom, volumes in VOLUMES.items())
+    assert petite == grande
+    assert petite == {'/produits/': 2, '/clients/': 1, '/ventes/': 3, '/factures': 2}
+
+def _curseur(forme):
+    return base64.urlsafe_b64encode(json.dumps(forme).encode()).decode().rstrip('=')
+
+def test_curseur_forge_refuse(base):
+    # Curseur modifié à la main : 400, jamais d'erreur 500
+    client = base.test_client()
+    for forme in ([1, [2]], [[1], 2], [1, 'x'], [1, 2 ** 70], 'abc'):
+        for page in PAGES:
+            assert client.get(f'{page}?apres={_curseur(forme)}').status_code == 400, (page, forme)
+    # Les ventes sont triées par date
+    assert client.get(f"/ventes/?apres={_curseur(['2024-13-01', 1])}").status_code == 400
+    assert client.get(f"/ventes/?apres={_curseur([5, 1])}").status_code == 400
+    assert client.get('/ventes/?apres=%%%').status_code == 400
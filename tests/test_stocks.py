@@ -0,0 +1,59 @@
+import threading
+from sqlalchemy import select, func
+from app import db
+from app.models import Produit, MouvementStock
+from app.mouvements import enregistrer_mouvements
+from app.stocks import reserver_stocks, reessayer_transaction, StockInsuffisant
+
+# Ventes simultanées sur un petit stock : jamais de survente, registre juste.
+
+THREADS = 8
+ESSAIS = 10  # ventes tentées par thread, bien plus que le stock
+
+def test_reservations_concurrentes(base):
+    produits = [Produit(nom='Riz 25 kg', prix_unitaire=50000, stock_actuel=15),
+                Produit(nom='Huile 1 L', prix_unitaire=8000, stock_actuel=9)]
+    db.session.add_all(produits)
+    db.session.flush()
+    enregistrer_mouvements('reapprovisionnement', [(p.id, p.stock_actuel, None) for p in produits])
+    db.session.commit()
+    quantites = {produits[0].id: 2, produits[1].id: 1}
+
+    depart = threading.Barrier(THREADS)
+    servies, refusees, erreurs = [], [], []
+
+    def vendre():
+        reserver_stocks(quantites)
+        enregistrer_mouvements('vente', [(produit_id, -quantite, None) for produit_id, quantite in quantites.items()])
+        db.session.commit()
+
+    def vendeur():
+        with base.app_context():
+            depart.wait()
+            for _ in range(ESSAIS):
+                try:
+                    reessayer_transaction(vendre)
+                    servies.append(1)
+                except StockInsuffisant:
+                    db.session.rollback()
+                    refusees.append(1)
+                except Exception as e:
+                    db.session.rollback()
+                    erreurs.append(e)
+
+    threads = [threading.Thread(target=vendeur) for _ in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert erreurs == []
+    # 15 // 2 ventes possibles : le riz limite
+    assert len(servies) == 7
+    assert len(refusees) == THREADS * ESSAIS - 7
+    db.session.expire_all()
+    stocks = dict(db.session.execute(select(Produit.id, Produit.stock_actuel)).all())
+    assert stocks == {produits[0].id: 1, produits[1].id: 2}
+    registre = dict(db.session.execute(select(MouvementStock.produit_id, func.sum(MouvementStock.quantite))
+                                       .group_by(MouvementStock.produit_id)).all())
+    assert registre == stocks
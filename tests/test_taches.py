@@ -0,0 +1,27 @@
+from datetime import datetime, timedelta
+from sqlalchemy import select
+from app import db
+from app import taches
+from app.models import ExecutionTache
+
+# Historique des exécutions des tâches de fond : borné par RETENTION.
+
+def test_historique_des_executions_borne(base, monkeypatch):
+    monkeypatch.setitem(taches.TACHES, 'essai', (lambda: 3, timedelta(minutes=1)))
+    maintenant = datetime.utcnow()
+    db.session.add_all(
+        [ExecutionTache(tache='essai', debut=maintenant - taches.RETENTION - timedelta(hours=h), duree=0.1)
+         for h in (1, 48)]
+        + [ExecutionTache(tache='essai', debut=maintenant - timedelta(days=1), duree=0.1),
+           ExecutionTache(tache='autre', debut=maintenant - taches.RETENTION * 2, duree=0.1)]
+    )
+    db.session.commit()
+
+    execution = taches.executer_tache('essai')
+    assert execution.lignes == 3
+    restantes = db.session.execute(select(ExecutionTache.tache, ExecutionTache.debut)
+                                   .order_by(ExecutionTache.debut)).all()
+    # Les exécutions des autres tâches ne sont supprimées que par leurs propres passes
+    assert [tache for tache, _ in restantes] == ['autre', 'essai', 'essai']
+    assert restantes[-1].debut == execution.debut
+    assert taches.dernieres_executions()['essai'].id == execution.id
@@ -1,4 +1,6 @@
-from datetime import datetime
+import os
+import uuid
+from functools import lru_cache
 from reportlab.lib import colors
 from reportlab.lib.pagesizes import A4
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
@@ -6,32 +8,15 @@ from reportlab.lib.units import inch
 from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
 from reportlab.pdfgen import canvas
 from io import BytesIO
-import uuid
-
-def generer_numero_vente():
-    """Génère un numéro de vente unique basé sur la date et un UUID court"""
-    today = datetime.now()
-    date_str = today.strftime('%Y%m%d')
-    uuid_court = str(uuid.uuid4())[:8].upper()
-    return f"VTE-{date_str}-{uuid_court}"
-
-def generer_numero_facture():
-    """Génère un numéro de facture unique basé sur la date et un UUID court"""
-    today = datetime.now()
-    date_str = today.strftime('%Y%m%d')
-    uuid_court = str(uuid.uuid4())[:8].upper()
-    return f"FACT-{date_str}-{uuid_court}"
 
 def formater_ariary(montant):
     """Formate un montant en ariary avec séparateurs de milliers"""
     return f"{montant:,.0f} MGA".replace(',', ' ')
 
-def generer_facture_pdf(facture):
-    """Génère le PDF d'une facture"""
-    buffer = BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=A4)
+@lru_cache(maxsize=1)
+def _styles():
+    """Feuille de styles des factures, construite une seule fois par processus"""
     styles = getSampleStyleSheet()
-    story = []
     
     # Style personnalisé pour le titre
     title_style = ParagraphStyle(
@@ -43,49 +28,89 @@ def generer_facture_pdf(facture):
         alignment=1  # Centré
     )
     
+    style_info = TableStyle([
+        ('FONTNAME', (0, 0), (-1, -1), 'Helvetica'),
+        ('FONTSIZE', (0, 0), (-1, -1), 12),
+        ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
+        ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+        ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+    ])
+    
+    style_client = TableStyle([
+        ('FONTNAME', (0, 0), (-1, -1), 'Helvetica'),
+        ('FONTSIZE', (0, 0), (-1, -1), 10),
+        ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
+        ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+        ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+    ])
+    
+    style_produits = TableStyle([
+        # En-tête
+        ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
+        ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+        ('FONTSIZE', (0, 0), (-1, 0), 12),
+        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+        
+        # Corps du tableau
+        ('FONTNAME', (0, 1), (-1, -4), 'Helvetica'),
+        ('FONTSIZE', (0, 1), (-1, -4), 10),
+        ('ALIGN', (0, 1), (0, -4), 'LEFT'),  # Nom du produit aligné à gauche
+        
+        # Lignes de totaux
+        ('FONTNAME', (0, -3), (-1, -1), 'Helvetica-Bold'),
+        ('FONTSIZE', (0, -3), (-1, -1), 11),
+        ('ALIGN', (2, -3), (-1, -1), 'RIGHT'),
+        
+        # Bordures
+        ('GRID', (0, 0), (-1, -4), 1, colors.black),
+        ('LINEBELOW', (0, -3), (-1, -1), 2, colors.black),
+    ])
+    
+    return styles, title_style, style_info, style_client, style_produits
+
+def generer_facture_pdf(donnees):
+    """Génère le PDF d'une facture à partir de ses données affichées
+
+    `donnees` est le dictionnaire construit par pdf_factures.donnees_facture() ;
+    la fonction n'accède pas à la base et peut tourner dans un autre processus.
+    """
+    buffer = BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=A4)
+    styles, title_style, style_info, style_client, style_produits = _styles()
+    story = []
+    
     # En-tête de la facture
     story.append(Paragraph("FACTURE", title_style))
     story.append(Spacer(1, 20))
     
     # Informations de la facture
     facture_info = [
-        ["Numéro de facture:", facture.numero_facture],
-        ["Date de facture:", facture.date_facture.strftime('%d/%m/%Y')],
-        ["Date d'échéance:", facture.date_echeance.strftime('%d/%m/%Y') if facture.date_echeance else "N/A"],
-        ["Statut:", facture.statut.upper()]
+        ["Numéro de facture:", donnees['numero_facture']],
+        ["Date de facture:", donnees['date_facture']],
+        ["Date d'échéance:", donnees['date_echeance'] or "N/A"],
+        ["Statut:", donnees['statut'].upper()]
     ]
     
     table_info = Table(facture_info, colWidths=[2*inch, 3*inch])
-    table_info.setStyle(TableStyle([
-        ('FONTNAME', (0, 0), (-1, -1), 'Helvetica'),
-        ('FONTSIZE', (0, 0), (-1, -1), 12),
-        ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
-        ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-        ('VALIGN', (0, 0), (-1, -1), 'TOP'),
-    ]))
+    table_info.setStyle(style_info)
     
     story.append(table_info)
     story.append(Spacer(1, 30))
     
     # Informations du client
-    client = facture.vente.client
+    client = donnees['client']
     story.append(Paragraph("Informations Client", styles['Heading2']))
     
     client_info = [
-        ["Nom:", client.nom],
-        ["Email:", client.email or "N/A"],
-        ["Téléphone:", client.telephone or "N/A"],
-        ["Adresse:", client.adresse or "N/A"]
+        ["Nom:", client['nom']],
+        ["Email:", client['email'] or "N/A"],
+        ["Téléphone:", client['telephone'] or "N/A"],
+        ["Adresse:", client['adresse'] or "N/A"]
     ]
     
     table_client = Table(client_info, colWidths=[1.5*inch, 3.5*inch])
-    table_client.setStyle(TableStyle([
-        ('FONTNAME', (0, 0), (-1, -1), 'Helvetica'),
-        ('FONTSIZE', (0, 0), (-1, -1), 10),
-        ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
-        ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-        ('VALIGN', (0, 0), (-1, -1), 'TOP'),
-    ]))
+    table_client.setStyle(style_client)
     
     story.append(table_client)
     story.append(Spacer(1, 30))
@@ -96,52 +121,51 @@ def generer_facture_pdf(facture):
     # En-tête du tableau des produits
     data = [['Produit', 'Quantité', 'Prix unitaire', 'Sous-total']]
     
-    for ligne in facture.vente.lignes:
+    for ligne in donnees['lignes']:
         data.append([
-            ligne.produit.nom,
-            str(ligne.quantite),
-            formater_ariary(ligne.prix_unitaire),
-            formater_ariary(ligne.sous_total)
+            ligne['produit'],
+            str(ligne['quantite']),
+            formater_ariary(ligne['prix_unitaire']),
+            formater_ariary(ligne['sous_total'])
         ])
     
     # Ligne des totaux
-    data.append(['', '', 'Total HT:', formater_ariary(facture.vente.total_ht)])
-    data.append(['', '', f'TVA ({facture.vente.taux_tva}%):', formater_ariary(facture.vente.total_ttc - facture.vente.total_ht)])
-    data.append(['', '', 'Total TTC:', formater_ariary(facture.vente.total_ttc)])
+    data.append(['', '', 'Total HT:', formater_ariary(donnees['total_ht'])])
+    data.append(['', '', f"TVA ({donnees['taux_tva']}%):", formater_ariary(donnees['total_ttc'] - donnees['total_ht'])])
+    data.append(['', '', 'Total TTC:', formater_ariary(donnees['total_ttc'])])
     
     table_produits = Table(data, colWidths=[3*inch, 1*inch, 1.5*inch, 1.5*inch])
-    table_produits.setStyle(TableStyle([
-        # En-tête
-        ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
-        ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, 0), 12),
-        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-        
-        # Corps du tableau
-        ('FONTNAME', (0, 1), (-1, -4), 'Helvetica'),
-        ('FONTSIZE', (0, 1), (-1, -4), 10),
-        ('ALIGN', (0, 1), (0, -4), 'LEFT'),  # Nom du produit aligné à gauche
-        
-        # Lignes de totaux
-        ('FONTNAME', (0, -3), (-1, -1), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, -3), (-1, -1), 11),
-        ('ALIGN', (2, -3), (-1, -1), 'RIGHT'),
-        
-        # Bordures
-        ('GRID', (0, 0), (-1, -4), 1, colors.black),
-        ('LINEBELOW', (0, -3), (-1, -1), 2, colors.black),
-    ]))
+    table_produits.setStyle(style_produits)
     
     story.append(table_produits)
     story.append(Spacer(1, 30))
     
     # Notes si présentes
-    if facture.notes:
+    if donnees['notes']:
         story.append(Paragraph("Notes", styles['Heading2']))
-        story.append(Paragraph(facture.notes, styles['Normal']))
+        story.append(Paragraph(donnees['notes'], styles['Normal']))
     
     # Générer le PDF
     doc.build(story)
     buffer.seek(0)
-    return buffer.getvalue()
\ No newline at end of file
+    return buffer.getvalue()
+
+def ecrire_facture_pdf(donnees, chemin):
+    """Génère le PDF d'une facture et l'écrit dans `chemin`
+
+    L'écriture passe par un fichier temporaire renommé à la fin : un
+    lecteur ne voit jamais de PDF incomplet. Le nom du fichier temporaire
+    est unique, même entre les threads d'un processus.
+    """
+    contenu = generer_facture_pdf(donnees)
+    # Nom unique (open en mode 'x') : les droits restent ceux du umask
+    temporaire = f"{chemin}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(temporaire, 'xb') as fichier:
+            fichier.write(contenu)
+        os.replace(temporaire, chemin)
+    except OSError:
+        if os.path.exists(temporaire):
+            os.unlink(temporaire)
+        raise
+    return chemin
@@ -1,102 +1,207 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash
+import io
+import time
+from flask import Blueprint, render_template, request, redirect, url_for, flash, abort, jsonify
 from datetime import datetime, timedelta
+from sqlalchemy import select, insert
 from .. import db
 from ..models import Produit, Client, Vente, LigneVente, Facture
-from .. import utils
+from ..agregats import comptabiliser_vente, comptabiliser_classements
+from ..statistiques import invalider_ventes, invalider_stock
+from ..importation import importer_ventes, lire_ventes, rapport_import
+from ..pdf_factures import prerendre_facture
+from ..factures import instantanes
+from ..stocks import reserver_stocks, reessayer_transaction, StockInsuffisant
+from ..mouvements import enregistrer_mouvements
+from ..reapprovisionnement import surveiller_stocks
+from ..numerotation import numero_vente, numero_facture
+from ..annulations import annuler_ventes, lire_criteres
+from ..requetes import requete_clients, requete_ventes, total_ventes, paginer, TRIS_VENTES
+from ..requetes import requete_export_ventes, ENTETES_VENTES
+from ..exports import reponse_csv
+from ..replicas import lecture_seule
 
 ventes_bp = Blueprint('ventes', __name__, url_prefix='/ventes')
 
+def _filtres_ventes(args):
+    """Filtres de la liste des ventes lus dans la query string"""
+    date_debut = args.get('date_debut')
+    date_fin = args.get('date_fin')
+    client_id = args.get('client_id')
+    
+    return dict(
+        date_debut=datetime.strptime(date_debut, '%Y-%m-%d') if date_debut else None,
+        date_fin=datetime.strptime(date_fin, '%Y-%m-%d') + timedelta(days=1) if date_fin else None,
+        client_id=int(client_id) if client_id else None
+    )
+
 @ventes_bp.route('/')
+@lecture_seule
 def ventes():
     """Liste des ventes"""
-    date_debut = request.args.get('date_debut')
-    date_fin = request.args.get('date_fin')
-    client_id = request.args.get('client_id')
+    filtres = _filtres_ventes(request.args)
+    
+    try:
+        page = paginer(requete_ventes(**filtres), TRIS_VENTES,
+                       request.args.get('tri'), request.args.get('ordre', 'desc'),
+                       apres=request.args.get('apres'), taille=request.args.get('taille'))
+    except ValueError:
+        abort(400)
+    
+    clients = requete_clients().all()
+    
+    return render_template('ventes.html', ventes=page, page=page, clients=clients,
+                         total_filtres=total_ventes(**filtres))
+
+@ventes_bp.route('/export')
+@lecture_seule
+def exporter_ventes():
+    """Exporter les ventes filtrées avec leurs lignes (CSV ou Excel)"""
+    try:
+        stmt = requete_export_ventes(**_filtres_ventes(request.args))
+        return reponse_csv('ventes', ENTETES_VENTES, stmt, request.args.get('format', 'csv'))
+    except ValueError:
+        abort(400)
+
+def _enregistrer_vente(form):
+    """Enregistre la vente décrite par le formulaire et sa facture ; retourne la facture"""
+    vente = Vente(
+        numero_vente=numero_vente(),
+        client_id=int(form['client_id']),
+        taux_tva=float(form.get('taux_tva', 20.0)),
+        notes=form.get('notes', '')
+    )
+    
+    db.session.add(vente)
+    db.session.flush()  # Pour obtenir l'ID de la vente
+    
+    # Regrouper les lignes d'un même produit (ordre de saisie conservé)
+    quantites = {}
+    for produit_id, quantite in zip(form.getlist('produit_id'), form.getlist('quantite')):
+        if produit_id and quantite:
+            quantites[int(produit_id)] = quantites.get(int(produit_id), 0) + int(quantite)
     
-    query = Vente.query
+    # Vérifier et décrémenter le stock de tous les produits en une requête
+    reserver_stocks(quantites)
+    # Produits passés à leur stock minimum : alerte mise en file avec la vente
+    surveiller_stocks(quantites, sorties=False)
     
-    if date_debut:
-        query = query.filter(Vente.date_vente >= datetime.strptime(date_debut, '%Y-%m-%d'))
+    # Prix de tous les produits en une seule requête
+    prix = dict(
+        db.session.query(Produit.id, Produit.prix_unitaire)
+        .filter(Produit.id.in_(quantites))
+        .all()
+    )
     
-    if date_fin:
-        fin = datetime.strptime(date_fin, '%Y-%m-%d') + timedelta(days=1)
-        query = query.filter(Vente.date_vente < fin)
+    lignes = [
+        dict(vente_id=vente.id, produit_id=produit_id, quantite=quantite,
+             prix_unitaire=prix[produit_id], sous_total=prix[produit_id] * quantite)
+        for produit_id, quantite in quantites.items()
+    ]
+    if lignes:
+        db.session.execute(insert(LigneVente), lignes)
+    enregistrer_mouvements('vente', [(produit_id, -quantite, vente.id)
+                                     for produit_id, quantite in quantites.items()])
     
-    if client_id:
-        query = query.filter_by(client_id=int(client_id))
+    # Calculer les totaux à partir des lignes en mémoire
+    vente.calculer_totaux([ligne['sous_total'] for ligne in lignes])
     
-    ventes = query.order_by(Vente.date_vente.desc()).all()
-    clients = Client.query.filter_by(actif=True).order_by(Client.nom).all()
+    # Mettre à jour le cumul mensuel et les classements
+    comptabiliser_vente(vente)
+    comptabiliser_classements([(vente.date_vente, vente.client_id, vente.total_ttc, lignes)])
     
-    return render_template('ventes.html', ventes=ventes, clients=clients)
+    # Créer la facture automatiquement (numéro pris en fin de transaction :
+    # le compteur des factures reste verrouillé jusqu'au commit), avec
+    # l'instantané du client, des lignes et des totaux
+    facture = Facture(
+        numero_facture=numero_facture(),
+        vente_id=vente.id,
+        date_echeance=datetime.utcnow() + timedelta(days=30),
+        **instantanes(db.session, [vente.id])[vente.id]
+    )
+    
+    db.session.add(facture)
+    db.session.commit()
+    return facture
 
 @ventes_bp.route('/nouvelle', methods=['GET', 'POST'])
 def nouvelle_vente():
     """Créer une nouvelle vente"""
     if request.method == 'POST':
         try:
-            # Générer un numéro de vente unique
-            numero_vente = utils.generer_numero_vente()
-            
-            vente = Vente(
-                numero_vente=numero_vente,
-                client_id=int(request.form['client_id']),
-                taux_tva=float(request.form.get('taux_tva', 20.0)),
-                notes=request.form.get('notes', '')
-            )
-            
-            db.session.add(vente)
-            db.session.flush()  # Pour obtenir l'ID de la vente
-            
-            # Ajouter les lignes de vente
-            produits_ids = request.form.getlist('produit_id')
-            quantites = request.form.getlist('quantite')
-            
-            for i, produit_id in enumerate(produits_ids):
-                if produit_id and quantites[i]:
-                    produit = Produit.query.get(int(produit_id))
-                    quantite = int(quantites[i])
-                    
-                    # Vérifier le stock
-                    if produit.stock_actuel < quantite:
-                        flash(f'Stock insuffisant pour {produit.nom}. Stock disponible: {produit.stock_actuel}', 'error')
-                        db.session.rollback()
-                        return redirect(url_for('ventes.nouvelle_vente'))
-                    
-                    ligne = LigneVente(
-                        vente_id=vente.id,
-                        produit_id=int(produit_id),
-                        quantite=quantite,
-                        prix_unitaire=produit.prix_unitaire
-                    )
-                    ligne.sous_total = ligne.prix_unitaire * ligne.quantite
-                    
-                    # Mettre à jour le stock
-                    produit.stock_actuel -= quantite
-                    
-                    db.session.add(ligne)
-            
-            # Calculer les totaux
-            vente.calculer_totaux()
-            
-            # Créer la facture automatiquement
-            facture = Facture(
-                numero_facture=utils.generer_numero_facture(),
-                vente_id=vente.id,
-                date_echeance=datetime.utcnow() + timedelta(days=30)
-            )
-            
-            db.session.add(facture)
-            db.session.commit()
+            # Rejouée si une vente concurrente fait échouer la transaction
+            facture = reessayer_transaction(lambda: _enregistrer_vente(request.form))
             
-            flash('Vente créée avec succès!', 'success')
-            return redirect(url_for('base.facture_detail', id=facture.id))
+        except StockInsuffisant as e:
+            db.session.rollback()
+            flash(str(e), 'error')
+            return redirect(url_for('ventes.nouvelle_vente'))
             
         except Exception as e:
             db.session.rollback()
             flash(f'Erreur lors de la création de la vente: {str(e)}', 'error')
+        
+        else:
+            # Après le commit : la vente est enregistrée quoi qu'il arrive ici
+            invalider_ventes()
+            prerendre_facture(facture.id)
+            
+            flash('Vente créée avec succès!', 'success')
+            return redirect(url_for('base.facture_detail', id=facture.id))
+    
+    # Les produits sont chargés par le formulaire depuis l'API du catalogue
+    clients = db.session.execute(
+        select(Client.id, Client.nom).where(Client.actif == True).order_by(Client.nom)
+    ).all()
+    
+    return render_template('nouvelle_vente.html', clients=clients, maintenant=datetime.now())
+
+@ventes_bp.route('/<int:id>/annuler', methods=['POST'])
+def annuler_vente(id):
+    """Annuler une vente : stock restitué et facture annulée"""
+    Vente.query.get_or_404(id)
+    
+    try:
+        annulees = reessayer_transaction(
+            lambda: annuler_ventes(ids=[id], motif=request.form.get('motif') or None))
+        if annulees:
+            invalider_ventes()
+            invalider_stock()
+            flash('Vente annulée, stock restitué.', 'success')
+        else:
+            flash('Cette vente est déjà annulée.', 'error')
+    except Exception as e:
+        db.session.rollback()
+        flash(f'Erreur lors de l\'annulation de la vente: {str(e)}', 'error')
+    
+    return redirect(url_for('ventes.ventes'))
+
+# API endpoints pour AJAX
+@ventes_bp.route('/api/bulk', methods=['POST'])
+def api_import_ventes():
+    """API d'import en masse des ventes (JSON-lines, ou CSV avec Content-Type: text/csv)"""
+    format_ = 'csv' if request.mimetype == 'text/csv' else 'jsonl'
+    flux = io.TextIOWrapper(request.stream, encoding='utf-8')
+    
+    debut = time.perf_counter()
+    resultats = list(importer_ventes(lire_ventes(flux, format_)))
+    rapport = rapport_import(resultats, time.perf_counter() - debut)
+    
+    if rapport['importees']:
+        invalider_ventes()
+    
+    return jsonify(rapport)
+
+@ventes_bp.route('/api/annulations', methods=['POST'])
+def api_annuler_ventes():
+    """API d'annulation en masse (par identifiants ou par période)"""
+    try:
+        criteres = lire_criteres(request.get_json(silent=True) or {})
+    except (ValueError, TypeError):
+        abort(400)
     
-    clients = Client.query.filter_by(actif=True).order_by(Client.nom).all()
-    produits = Produit.query.filter_by(actif=True).order_by(Produit.nom).all()
+    annulees = reessayer_transaction(lambda: annuler_ventes(**criteres))
+    if annulees:
+        invalider_ventes()
+        invalider_stock()
     
-    return render_template('nouvelle_vente.html', clients=clients, produits=produits)
\ No newline at end of file
+    return jsonify({'annulees': len(annulees), 'ventes': annulees})
\ No newline at end of file